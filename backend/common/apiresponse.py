@@ -2,7 +2,7 @@ from http import HTTPStatus
 from rest_framework.response import Response
 
 class ApiResponse(Response):
-    def __init__(self, success=True, message='', status_code=200, code=None, data=None, **kwargs):
+    def __init__(self, success=True, message='', status_code=200, code=None, data=None, meta=None, **kwargs):
         response_data = {
             'success': success,
             'message': message,
@@ -11,5 +11,7 @@ class ApiResponse(Response):
             response_data['code'] = code
         if data is not None:
             response_data['data'] = data
+        if meta is not None:
+            response_data['meta'] = meta
 
         super().__init__(data=response_data, status=status_code, **kwargs)
\ No newline at end of file
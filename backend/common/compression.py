@@ -0,0 +1,148 @@
+import math
+import zlib
+from collections import Counter
+from django.conf import settings
+
+try:
+    import zstandard
+except ImportError:  # Optional: zlib is always available
+    zstandard = None
+
+# Codec ids as recorded in the EXT_COMPRESSION container header entry
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+CODEC_NAMES = {'zlib': CODEC_ZLIB, 'zstd': CODEC_ZSTD}
+
+# Bytes of the first chunk looked at to estimate how well a file compresses
+SAMPLE_SIZE = 64 * 1024
+
+# Most plaintext one decompression step may produce
+DECOMPRESS_OUTPUT_SIZE = 64 * 1024
+
+# Formats that are already compressed; sampling them would only confirm it
+INCOMPRESSIBLE_MIME_PREFIXES = ('image/', 'video/', 'audio/', 'font/woff')
+INCOMPRESSIBLE_MIME_TYPES = {
+    'application/zip',
+    'application/gzip',
+    'application/x-gzip',
+    'application/x-bzip2',
+    'application/x-xz',
+    'application/x-7z-compressed',
+    'application/x-rar-compressed',
+    'application/vnd.rar',
+    'application/zstd',
+    'application/pdf',
+    'application/epub+zip',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+}
+# Uncompressed raster and vector images do compress well
+COMPRESSIBLE_MIME_TYPES = {'image/bmp', 'image/svg+xml', 'image/x-ms-bmp', 'image/tiff'}
+
+class CompressionError(Exception):
+    pass
+
+def codec_available(codec):
+    return codec == CODEC_ZLIB or (codec == CODEC_ZSTD and zstandard is not None)
+
+def configured_codec():
+    """Codec id named by FILE_COMPRESSION, or None when compression is off or unavailable"""
+    codec = CODEC_NAMES.get(settings.FILE_COMPRESSION)
+    if codec == CODEC_ZSTD and zstandard is None:
+        # zstd is optional, fall back to zlib rather than storing everything raw
+        codec = CODEC_ZLIB
+    return codec
+
+def sample_entropy(sample):
+    """Shannon entropy of `sample` in bits per byte: 8 for random or compressed data"""
+    if not sample:
+        return 0.0
+    total = len(sample)
+    return -sum(count / total * math.log2(count / total) for count in Counter(sample).values())
+
+def compressible_mime(mime):
+    """Whether content of type `mime` may compress, i.e. it isn't a compressed format already"""
+    mime = (mime or '').split(';')[0].strip().lower()
+    return mime in COMPRESSIBLE_MIME_TYPES or not (
+        mime in INCOMPRESSIBLE_MIME_TYPES or mime.startswith(INCOMPRESSIBLE_MIME_PREFIXES)
+    )
+
+def choose_codec(mime, sample):
+    """
+    Pick the codec for a new file from its content type and the start of its plaintext,
+    or None to store it uncompressed.
+    """
+    codec = configured_codec()
+    if codec is None:
+        return None
+    if not compressible_mime(mime):
+        return None
+    if sample_entropy(sample[:SAMPLE_SIZE]) > settings.FILE_COMPRESSION_MAX_ENTROPY:
+        return None
+    return codec
+
+def compressor(codec):
+    """Streaming compressor with `compress(data)` and `flush()`"""
+    level = settings.FILE_COMPRESSION_LEVEL or None
+    if codec == CODEC_ZLIB:
+        return zlib.compressobj(level if level is not None else zlib.Z_DEFAULT_COMPRESSION)
+    if codec == CODEC_ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level if level is not None else 3).compressobj()
+    raise CompressionError(f"Unsupported compression codec: {codec}")
+
+class _ChunkReader:
+    """File-like read() over an iterable of byte strings, for zstandard's streaming API"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while not self._buffer:
+            self._buffer = next(self._chunks, None)
+            if self._buffer is None:
+                self._buffer = b''
+                return b''
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+def _inflate(chunks):
+    decompressor = zlib.decompressobj()
+    for chunk in chunks:
+        # max_length bounds each step; the input it didn't get to waits in unconsumed_tail
+        while chunk:
+            data = decompressor.decompress(chunk, DECOMPRESS_OUTPUT_SIZE)
+            if data:
+                yield data
+            chunk = decompressor.unconsumed_tail
+    data = decompressor.flush()
+    if data:
+        yield data
+    if not decompressor.eof:
+        raise CompressionError("Truncated compressed stream")
+
+def _unzstd(chunks):
+    yield from zstandard.ZstdDecompressor().read_to_iter(
+        _ChunkReader(chunks), read_size=DECOMPRESS_OUTPUT_SIZE, write_size=DECOMPRESS_OUTPUT_SIZE
+    )
+
+def decompress_chunks(codec, chunks):
+    """
+    Yield the decompressed stream of an iterable of compressed chunks, at most
+    DECOMPRESS_OUTPUT_SIZE bytes at a time however well a chunk compressed, so that
+    a decompression bomb costs time but not memory
+    """
+    if codec == CODEC_ZLIB:
+        stream = _inflate(chunks)
+    elif codec == CODEC_ZSTD and zstandard is not None:
+        stream = _unzstd(chunks)
+    else:
+        raise CompressionError(f"Unsupported compression codec: {codec}")
+    try:
+        yield from stream
+    except (zlib.error, getattr(zstandard, 'ZstdError', zlib.error)) as e:
+        raise CompressionError(f"Corrupt compressed stream: {str(e)}")
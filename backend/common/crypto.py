@@ -1,108 +1,927 @@
+import io
 import os
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
-from common.vault import get_vault_client
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from cryptography.exceptions import InvalidTag, UnsupportedAlgorithm
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from common.compression import CompressionError, choose_codec, compressor, decompress_chunks, SAMPLE_SIZE
+from common.keystore import KeyNotFound, get_key_store
 
 class CryptoError(Exception):
     pass
 
+# Chunked container format
+#
+#   header := magic | version (u8) | cipher (u8) | chunk_size (u32) | nonce_prefix (7) | ext_len (u16) | ext
+#   body   := chunk_0 | chunk_1 | ... | chunk_n
+#
+# Every chunk holds `chunk_size` bytes of plaintext (the last one may be shorter) and is
+# sealed on its own, with the AEAD named by `cipher` (see CIPHERS), using nonce = nonce_prefix | chunk index (u32) | final flag (u8) and the
+# header bytes as associated data. Reordered chunks fail on the index, a truncated file
+# fails because its new last chunk was not sealed with the final flag.
+#
+# `ext` is a list of tag (u8) | length (u16) | value entries. In envelope mode the file's
+# data key travels in the header, wrapped by a key-encryption key (KEK) from the key store:
+#
+#   EXT_WRAPPED_KEY := kek_version (u32) | nonce (12) | AES-GCM(kek, data key)
+#
+# When the plaintext was compressed before sealing, the chunks hold the compressed stream
+# and EXT_COMPRESSION names the codec (u8, see common.compression). The plaintext size then
+# can't be derived from the blob size and comes from `File.size`.
+MAGIC = b'SFSC'
+FORMAT_VERSION = 1
+CIPHER_AES_256_GCM = 1
+CIPHER_CHACHA20_POLY1305 = 2
+TAG_SIZE = 16
+NONCE_PREFIX_SIZE = 7
+MAX_CHUNK_INDEX = 2 ** 32 - 1
+
+EXT_WRAPPED_KEY = 1
+EXT_COMPRESSION = 2
+
+_KEK_WRAP_AAD = b'sfs data key'
+
+# All take a 256-bit key and a 96-bit nonce and append a 16 byte tag. AES-GCM-SIV is left
+# out on purpose: cryptography refuses to seal empty plaintexts with it, and the final
+# chunk of an empty file is empty.
+CIPHERS = {
+    CIPHER_AES_256_GCM: ('aes-256-gcm', AESGCM),
+    CIPHER_CHACHA20_POLY1305: ('chacha20-poly1305', ChaCha20Poly1305),
+}
+CIPHER_NAMES = {name: cipher for cipher, (name, _) in CIPHERS.items()}
+
+# Plaintext sealed per cipher when timing them, in chunks of the configured size
+CIPHER_BENCHMARK_BYTES = 4 * 1024 * 1024
+
+_HEADER = struct.Struct('>4sBBI7sH')
+_NONCE_SUFFIX = struct.Struct('>IB')
+_EXTENSION = struct.Struct('>BH')
+_KEK_VERSION = struct.Struct('>I')
+
+# KEKs by key store version, fetched once per process; only read and written under _kek_lock
+_key_encryption_keys = {}
+_current_kek_version = None
+_kek_lock = threading.Lock()
+
+def _new_aead(cipher, key):
+    if cipher not in CIPHERS:
+        raise CryptoError(f"Unsupported cipher: {cipher}")
+    try:
+        return CIPHERS[cipher][1](key)
+    except UnsupportedAlgorithm:
+        raise CryptoError(f"Cipher {CIPHERS[cipher][0]} is not supported by this OpenSSL build")
+
+def available_ciphers():
+    """Cipher ids this host's OpenSSL can seal and open"""
+    available = []
+    for cipher in CIPHERS:
+        try:
+            _new_aead(cipher, bytes(32)).encrypt(bytes(12), b'', None)
+        except CryptoError:
+            continue
+        available.append(cipher)
+    return available
+
+def benchmark_ciphers(chunk_size=None, total=CIPHER_BENCHMARK_BYTES):
+    """Seal `total` bytes with each available cipher and return {cipher: MB/s}"""
+    chunk_size = chunk_size or settings.FILE_ENCRYPTION_CHUNK_SIZE
+    chunk = bytes(chunk_size)
+    rounds = max(1, total // chunk_size)
+    results = {}
+    for cipher in available_ciphers():
+        aead = _new_aead(cipher, os.urandom(32))
+        aead.encrypt(bytes(12), chunk, None)  # warm up
+        started = time.perf_counter()
+        for i in range(rounds):
+            aead.encrypt(i.to_bytes(12, 'big'), chunk, None)
+        elapsed = time.perf_counter() - started
+        results[cipher] = rounds * chunk_size / 1e6 / max(elapsed, 1e-9)
+    return results
+
+_default_cipher = None
+_default_cipher_lock = threading.Lock()
+
+def default_cipher():
+    """
+    Cipher for new files: the one named by FILE_ENCRYPTION_CIPHER, or with "auto" the
+    fastest one on this host, measured once per process (at startup, by FilesConfig.ready()).
+    """
+    global _default_cipher
+    name = settings.FILE_ENCRYPTION_CIPHER
+    if name != 'auto':
+        if name not in CIPHER_NAMES:
+            raise CryptoError(f"Unknown FILE_ENCRYPTION_CIPHER: {name}")
+        return CIPHER_NAMES[name]
+    with _default_cipher_lock:
+        if _default_cipher is None:
+            results = benchmark_ciphers()
+            _default_cipher = max(results, key=results.get)
+        return _default_cipher
+
+class KeyCache:
+    """
+    In-process LRU cache of data keys from the key store, bounded by entry count, with a TTL.
+
+    Keys are held in bytearrays that are zeroed (best effort, callers keep their own
+    copies) when an entry is evicted, expires or is invalidated.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # file_id -> (expires_at, bytearray)
+        self._lock = threading.Lock()
+
+    def get(self, file_id):
+        with self._lock:
+            entry = self._entries.get(file_id)
+            if entry is not None and entry[0] <= time.monotonic():
+                self._discard(file_id)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(file_id)
+            self.hits += 1
+            return bytes(entry[1])
+
+    def put(self, file_id, key):
+        with self._lock:
+            if file_id in self._entries:
+                self._discard(file_id)
+            self._entries[file_id] = (time.monotonic() + self.ttl, bytearray(key))
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, file_id):
+        with self._lock:
+            if file_id in self._entries:
+                self._discard(file_id)
+
+    def clear(self):
+        with self._lock:
+            for file_id in list(self._entries):
+                self._discard(file_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _discard(self, file_id):
+        _, key = self._entries.pop(file_id)
+        key[:] = bytes(len(key))
+
+_key_cache = None
+_key_cache_lock = threading.Lock()
+
+def get_key_cache():
+    """The process-wide key cache, or None when FILE_KEY_CACHE_SIZE is 0"""
+    global _key_cache
+    if settings.FILE_KEY_CACHE_SIZE <= 0:
+        return None
+    with _key_cache_lock:
+        if _key_cache is None:
+            _key_cache = KeyCache(settings.FILE_KEY_CACHE_SIZE, settings.FILE_KEY_CACHE_TTL)
+        return _key_cache
+
+def key_cache_stats():
+    """Hit/miss/eviction counters of the key cache, for sizing it; None when disabled"""
+    cache = get_key_cache()
+    return cache.stats() if cache else None
+
+def invalidate_encryption_key(file_id):
+    """Forget any cached key of `file_id`; call when its file is deleted or its key replaced"""
+    cache = get_key_cache()
+    if cache:
+        cache.invalidate(str(file_id))
+
 def generate_encryption_key():
     """Generate a new AES-256 key for GCM"""
     return AESGCM.generate_key(bit_length=256)  # 32 bytes
 
 def store_encryption_key(file_id, key):
-    """Store the encryption key in Vault"""
-    vault_client = get_vault_client()
-    if not vault_client:
-        raise Exception("Could not connect to vault")
-    path = f'secret/data/file-encryption-key/{file_id}'
-    vault_client.secrets.kv.v2.create_or_update_secret(
-        path=path,
-        secret={'key': key.hex()}  # Store hex-encoded key
-    )
+    """Store the encryption key in the configured key store"""
+    get_key_store().store(file_id, key)
+    cache = get_key_cache()
+    if cache:
+        cache.put(str(file_id), key)
+
+def store_encryption_keys(items):
+    """Store many (file_id, key) pairs with the key store's batched write"""
+    items = list(items)
+    get_key_store().store_many(items)
+    cache = get_key_cache()
+    if cache:
+        for file_id, key in items:
+            cache.put(str(file_id), key)
 
 def get_encryption_key(file_id):
-    """Retrieve the encryption key from Vault"""
-    path = f'secret/data/file-encryption-key/{file_id}'
-    vault_client = get_vault_client()
-    if not vault_client:
-        raise Exception("Could not connect to vault")
-    response = get_vault_client().secrets.kv.v2.read_secret_version(path=path)
-    return bytes.fromhex(response['data']['data']['key'])
+    """Retrieve the encryption key from the key cache, or from the key store on a miss"""
+    cache = get_key_cache()
+    if cache:
+        key = cache.get(str(file_id))
+        if key is not None:
+            return key
+    key = get_key_store().get(file_id)
+    if cache:
+        cache.put(str(file_id), key)
+    return key
+
+def _fetch_key(file_id, item, needs_key):
+    if needs_key is not None and not needs_key(item):
+        return None
+    return get_encryption_key(file_id)
+
+def _prefetched(item, future):
+    try:
+        return item, future.result()
+    except Exception:
+        return item, None
+
+def prefetch_encryption_keys(items, workers=None, window=None, needs_key=None):
+    """
+    Yield (item, key) for each (file_id, item) pair of `items`, in order, while fetching
+    the keys of up to `window` later files on `workers` threads, so that the key store
+    round trips of a batch overlap. `items` may be lazy; only the window is held.
 
-def encrypt_file(file_id, file_path):
+    `needs_key(item)`, run on the same threads, can rule out fetching a key at all, e.g.
+    with needs_stored_key() for envelope-mode files, whose key is in their header.
+
+    key is None when it wasn't fetched or could not be; a real failure surfaces again
+    when the blob is opened with resolve_data_key().
+    """
+    workers = workers or settings.FILE_KEY_PREFETCH_WORKERS
+    window = window or workers * 4
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for file_id, item in items:
+                pending.append((item, pool.submit(_fetch_key, file_id, item, needs_key)))
+                if len(pending) >= window:
+                    yield _prefetched(*pending.popleft())
+            while pending:
+                yield _prefetched(*pending.popleft())
+        finally:
+            # Abandoned part way (e.g. the client went away): don't fetch the rest
+            for _, future in pending:
+                future.cancel()
+
+def delete_encryption_key(file_id):
+    """Delete the stored key of `file_id` from the key store and the key cache"""
+    invalidate_encryption_key(file_id)
+    get_key_store().delete(file_id)
+
+def envelope_enabled():
+    """Whether new files carry their data key wrapped in the header instead of in the key store"""
+    return settings.FILE_ENCRYPTION_ENVELOPE
+
+def get_key_encryption_key(version=None):
     """
-    Encrypt a file using AES-256-GCM
+    Return (version, kek) for the given KEK version, or the current one when `version` is
+    None. The key store is only asked the first time a version is needed in this process.
     """
-    # Get or generate key
+    global _current_kek_version
+    with _kek_lock:
+        if version is None:
+            version = _current_kek_version
+        if version in _key_encryption_keys:
+            return version, _key_encryption_keys[version]
+
+    version, kek = get_key_store().get_key_encryption_key(version)
+
+    with _kek_lock:
+        _key_encryption_keys[version] = kek
+        if _current_kek_version is None:
+            _current_kek_version = version
+    return version, kek
+
+def wrap_data_key(key):
+    """Seal a data key under the current KEK, as the value of an EXT_WRAPPED_KEY entry"""
+    version, kek = get_key_encryption_key()
+    nonce = os.urandom(12)
+    return _KEK_VERSION.pack(version) + nonce + AESGCM(kek).encrypt(nonce, key, _KEK_WRAP_AAD)
+
+def unwrap_data_key(wrapped):
+    """Recover a data key from an EXT_WRAPPED_KEY value"""
+    (version,) = _KEK_VERSION.unpack_from(wrapped)
+    _, kek = get_key_encryption_key(version)
+    nonce = wrapped[_KEK_VERSION.size:_KEK_VERSION.size + 12]
+    try:
+        return AESGCM(kek).decrypt(nonce, wrapped[_KEK_VERSION.size + 12:], _KEK_WRAP_AAD)
+    except InvalidTag:
+        raise CryptoError("Wrapped data key failed authentication")
+
+def pack_extensions(entries):
+    """Encode a {tag: value} dict as container header extensions"""
+    return b''.join(_EXTENSION.pack(tag, len(value)) + value for tag, value in entries.items())
+
+def envelope_extensions(key):
+    """Header extensions for a new file: its wrapped key in envelope mode, nothing otherwise"""
+    if not envelope_enabled():
+        return b''
+    return pack_extensions({EXT_WRAPPED_KEY: wrap_data_key(key)})
+
+def resolve_data_key(file_id, header=None, key=None):
+    """
+    Data key for a blob: unwrapped from its header when present, else `key` when the caller
+    already fetched it, else from the key store
+    """
+    wrapped = header.extension(EXT_WRAPPED_KEY) if header is not None else None
+    if wrapped is not None:
+        return unwrap_data_key(wrapped)
+    return key if key is not None else get_encryption_key(file_id)
+
+def needs_stored_key(fileobj):
+    """
+    Whether the blob open in `fileobj` is decrypted with a key from the key store, rather
+    than one wrapped in its header. Reads the header from the current position.
+    """
+    if not is_container(fileobj):
+        return True
+    return ContainerHeader.read(fileobj).extension(EXT_WRAPPED_KEY) is None
+
+class ContainerHeader:
+    """Header of a chunked container; its packed bytes are the AAD of every chunk"""
+
+    def __init__(self, chunk_size, nonce_prefix, cipher=CIPHER_AES_256_GCM, extensions=b''):
+        if chunk_size <= 0:
+            raise CryptoError(f"Invalid chunk size: {chunk_size}")
+        self.version = FORMAT_VERSION
+        self.cipher = cipher
+        self.chunk_size = chunk_size
+        self.nonce_prefix = nonce_prefix
+        self.extensions = extensions
+        self.packed = _HEADER.pack(
+            MAGIC, self.version, cipher, chunk_size, nonce_prefix, len(extensions)
+        ) + extensions
+
+    @property
+    def size(self):
+        return len(self.packed)
+
+    @property
+    def compression(self):
+        """Codec id the chunks were compressed with, or None"""
+        value = self.extension(EXT_COMPRESSION)
+        return value[0] if value else None
+
+    def extension(self, tag):
+        """Value of the first extension entry with `tag`, or None"""
+        offset = 0
+        while offset + _EXTENSION.size <= len(self.extensions):
+            entry_tag, length = _EXTENSION.unpack_from(self.extensions, offset)
+            offset += _EXTENSION.size
+            if entry_tag == tag:
+                return self.extensions[offset:offset + length]
+            offset += length
+        return None
+
+    @classmethod
+    def read(cls, fileobj):
+        """Read and validate a header from the current position of `fileobj`"""
+        fixed = fileobj.read(_HEADER.size)
+        if len(fixed) < _HEADER.size:
+            raise CryptoError("Truncated container header")
+        magic, version, cipher, chunk_size, nonce_prefix, ext_len = _HEADER.unpack(fixed)
+        if magic != MAGIC:
+            raise CryptoError("Not an encrypted container")
+        if version != FORMAT_VERSION:
+            raise CryptoError(f"Unsupported container version: {version}")
+        if cipher not in CIPHERS:
+            raise CryptoError(f"Unsupported cipher: {cipher}")
+        extensions = fileobj.read(ext_len)
+        if len(extensions) < ext_len:
+            raise CryptoError("Truncated container header")
+        return cls(chunk_size, nonce_prefix, cipher, extensions)
+
+    def nonce(self, index, final):
+        if index > MAX_CHUNK_INDEX:
+            raise CryptoError("File has too many chunks")
+        return self.nonce_prefix + _NONCE_SUFFIX.pack(index, 1 if final else 0)
+
+    def chunk_count(self, ciphertext_size):
+        """Number of sealed chunks in a container that is `ciphertext_size` bytes long"""
+        body = ciphertext_size - self.size
+        sealed_chunk = self.chunk_size + TAG_SIZE
+        chunks = max(1, -(-body // sealed_chunk))
+        if body - (chunks - 1) * sealed_chunk < TAG_SIZE:
+            raise CryptoError("Truncated container body")
+        return chunks
+
+    def plaintext_size(self, ciphertext_size):
+        """Plaintext length of a container that is `ciphertext_size` bytes long"""
+        return ciphertext_size - self.size - self.chunk_count(ciphertext_size) * TAG_SIZE
+
+def is_container(fileobj):
+    """Check whether `fileobj` starts with a container header, leaving its position unchanged"""
+    position = fileobj.tell()
+    try:
+        return fileobj.read(len(MAGIC)) == MAGIC
+    finally:
+        fileobj.seek(position)
+
+class ChunkEncryptor:
+    """
+    Seal everything written to it into the chunked container format on `fileobj`.
+
+    Memory use is bounded by the chunk size plus the largest single `write()`. With a
+    `compression` codec, writes are compressed before they are chunked and sealed. The
+    cipher defaults to default_cipher().
+    """
+
+    def __init__(self, key, fileobj, chunk_size=None, extensions=b'', compression=None, cipher=None):
+        self._compressor = None
+        if compression:
+            extensions += pack_extensions({EXT_COMPRESSION: bytes([compression])})
+            self._compressor = compressor(compression)
+        self.header = ContainerHeader(
+            chunk_size or settings.FILE_ENCRYPTION_CHUNK_SIZE,
+            os.urandom(NONCE_PREFIX_SIZE),
+            cipher or default_cipher(),
+            extensions
+        )
+        self.plaintext_size = 0
+        self._aead = _new_aead(self.header.cipher, key)
+        self._fileobj = fileobj
+        self._buffer = bytearray()
+        self._index = 0
+        self._closed = False
+        fileobj.write(self.header.packed)
+
+    def write(self, data):
+        if self._closed:
+            raise CryptoError("Encryptor is already closed")
+        self.plaintext_size += len(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._buffer += data
+        self._flush_full_chunks()
+
+    def _flush_full_chunks(self):
+        chunk_size = self.header.chunk_size
+        # Always hold back the tail: only close() knows which chunk is the final one
+        if len(self._buffer) > chunk_size:
+            view = memoryview(self._buffer)
+            offset = 0
+            while len(self._buffer) - offset > chunk_size:
+                self._seal(view[offset:offset + chunk_size], final=False)
+                offset += chunk_size
+            view.release()
+            del self._buffer[:offset]
+
+    def close(self):
+        if self._closed:
+            return
+        if self._compressor is not None:
+            self._buffer += self._compressor.flush()
+            self._flush_full_chunks()
+        self._seal(self._buffer, final=True)
+        self._buffer = bytearray()
+        self._closed = True
+
+    def _seal(self, chunk, final):
+        nonce = self.header.nonce(self._index, final)
+        self._fileobj.write(self._aead.encrypt(nonce, chunk, self.header.packed))
+        self._index += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+class ChunkDecryptor:
+    """
+    Read plaintext chunks back out of a container positioned at its header, or just past
+    it when the already parsed `header` is passed in.
+    """
+
+    def __init__(self, key, fileobj, header=None):
+        self.header = header or ContainerHeader.read(fileobj)
+        self._aead = _new_aead(self.header.cipher, key)
+        self._fileobj = fileobj
+
+    def _open(self, index, sealed, final):
+        try:
+            return self._aead.decrypt(self.header.nonce(index, final), sealed, self.header.packed)
+        except InvalidTag:
+            raise CryptoError(f"Chunk {index} failed authentication")
+
+    def __iter__(self):
+        """Yield plaintext chunks in order, reading one chunk ahead to spot the final one"""
+        sealed_chunk = self.header.chunk_size + TAG_SIZE
+        current = self._fileobj.read(sealed_chunk)
+        index = 0
+        while True:
+            following = self._fileobj.read(sealed_chunk) if len(current) == sealed_chunk else b''
+            final = not following
+            if len(current) < TAG_SIZE:
+                raise CryptoError("Truncated container body")
+            yield self._open(index, current, final)
+            if final:
+                return
+            current = following
+            index += 1
+
+    def iter_range(self, start, stop, chunk_count):
+        """
+        Yield plaintext bytes [start, stop), seeking to and decrypting only the chunks that
+        cover them. Needs a seekable file and the container's total `chunk_count`.
+        """
+        if start >= stop:
+            return
+        chunk_size = self.header.chunk_size
+        sealed_chunk = chunk_size + TAG_SIZE
+        first, last = start // chunk_size, (stop - 1) // chunk_size
+        for index in range(first, last + 1):
+            self._fileobj.seek(self.header.size + index * sealed_chunk)
+            chunk = self._open(index, self._fileobj.read(sealed_chunk), index == chunk_count - 1)
+            offset = index * chunk_size
+            yield chunk[max(start - offset, 0):stop - offset]
+
+# Chunks handed to a worker per task in the parallel pipeline, so per-task overhead stays
+# small next to the AES work even with small chunk sizes
+PARALLEL_SEGMENT_SIZE = 1024 * 1024
+
+def _read_exactly(source, size):
+    """Read `size` bytes unless EOF comes first; plain read() may return short on pipes"""
+    data = source.read(size)
+    if len(data) in (0, size):
+        return data
+    parts = [data]
+    remaining = size - len(data)
+    while remaining:
+        part = source.read(remaining)
+        if not part:
+            break
+        parts.append(part)
+        remaining -= len(part)
+    return b''.join(parts)
+
+def _source_size(source):
+    try:
+        return os.fstat(source.fileno()).st_size - source.tell()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+def _seal_segment(aead, header, first_index, segment, final):
+    """Seal one segment of consecutive chunks; `final` marks its last chunk as the file's last"""
+    chunk_size = header.chunk_size
+    view = memoryview(segment)
+    count = max(1, -(-len(segment) // chunk_size))
+    sealed = []
+    for i in range(count):
+        chunk = view[i * chunk_size:(i + 1) * chunk_size]
+        sealed.append(aead.encrypt(header.nonce(first_index + i, final and i == count - 1), chunk, header.packed))
+    return b''.join(sealed)
+
+def _encrypt_parallel(encryptor, source, workers, queue_depth):
+    """
+    Read ahead, seal segments on a thread pool (the AEADs release the GIL) and write them
+    back in order. At most `queue_depth` segments are in flight, which bounds memory.
+    """
+    header = encryptor.header
+    chunks_per_segment = max(1, PARALLEL_SEGMENT_SIZE // header.chunk_size)
+    segment_size = chunks_per_segment * header.chunk_size
+    destination = encryptor._fileobj
+    pending = deque()
+    index = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        current = _read_exactly(source, segment_size)
+        while True:
+            # A short segment is the last one; a full one might be followed by nothing
+            following = _read_exactly(source, segment_size) if len(current) == segment_size else b''
+            final = not following
+            pending.append(pool.submit(_seal_segment, encryptor._aead, header, index, current, final))
+            encryptor.plaintext_size += len(current)
+            while len(pending) >= queue_depth:
+                destination.write(pending.popleft().result())
+            if final:
+                break
+            current = following
+            index += chunks_per_segment
+        while pending:
+            destination.write(pending.popleft().result())
+
+    encryptor._closed = True
+
+def encrypt_stream(
+    key, source, destination, chunk_size=None, extensions=b'', workers=None, compression=None, cipher=None
+):
+    """
+    Encrypt `source` into `destination` in constant memory, return the plaintext size.
+
+    Uncompressed sources of at least FILE_ENCRYPTION_PARALLEL_THRESHOLD bytes are sealed
+    on `workers` threads (FILE_ENCRYPTION_WORKERS by default).
+    """
+    encryptor = ChunkEncryptor(key, destination, chunk_size, extensions, compression, cipher)
+    workers = workers or settings.FILE_ENCRYPTION_WORKERS
+    if workers > 1 and not compression:
+        size = _source_size(source)
+        if size is not None and size >= settings.FILE_ENCRYPTION_PARALLEL_THRESHOLD:
+            _encrypt_parallel(encryptor, source, workers, settings.FILE_ENCRYPTION_QUEUE_DEPTH or 2 * workers)
+            return encryptor.plaintext_size
+
+    read_size = encryptor.header.chunk_size
+    while True:
+        data = source.read(read_size)
+        if not data:
+            break
+        encryptor.write(data)
+    encryptor.close()
+    return encryptor.plaintext_size
+
+def iter_plaintext(decryptor):
+    """Yield the plaintext of a container, decompressing the chunks if they were compressed"""
+    codec = decryptor.header.compression
+    if codec is None:
+        return iter(decryptor)
+    return decompress_chunks(codec, decryptor)
+
+def decrypt_stream(key, source, destination, header=None):
+    """Decrypt the container in `source` into `destination` in constant memory"""
+    for chunk in iter_plaintext(ChunkDecryptor(key, source, header)):
+        destination.write(chunk)
+
+def _check_legacy_accepted():
+    if not settings.FILE_ENCRYPTION_ACCEPT_LEGACY:
+        raise CryptoError("Legacy single-shot blobs are no longer accepted, run migrate_legacy_blobs")
+
+def _decrypt_legacy(key, source, destination, file_path):
+    """Decrypt a `nonce || AES-GCM(whole file)` blob that used its path as AAD"""
+    file_data = source.read()
+    try:
+        decrypted_data = AESGCM(key).decrypt(file_data[:12], file_data[12:], file_path.encode())
+    except InvalidTag:
+        raise CryptoError("Legacy blob failed authentication")
+    destination.write(decrypted_data)
+
+def _iter_legacy_plaintext(key, source, file_path):
+    """
+    Yield the plaintext of a legacy `nonce || ciphertext || tag` blob a chunk at a time,
+    with the streaming GCM API, so that not even multi-GB blobs are held in memory.
+
+    Nothing yielded is authentic until the generator has finished: the tag is only
+    checked at the end, so callers must discard all output if it raises CryptoError.
+    """
+    size = source.seek(0, io.SEEK_END)
+    if size < 12 + TAG_SIZE:
+        raise CryptoError("Legacy blob failed authentication")
+    source.seek(size - TAG_SIZE)
+    tag = source.read(TAG_SIZE)
+    source.seek(0)
+    nonce = source.read(12)
+    decryptor = Cipher(algorithms.AES(key), modes.GCM(nonce, tag)).decryptor()
+    decryptor.authenticate_additional_data(file_path.encode())
+
+    remaining = size - 12 - TAG_SIZE
+    read_size = settings.FILE_ENCRYPTION_CHUNK_SIZE
+    while remaining:
+        data = source.read(min(read_size, remaining))
+        if not data:
+            raise CryptoError("Legacy blob is truncated")
+        remaining -= len(data)
+        yield decryptor.update(data)
+    try:
+        yield decryptor.finalize()
+    except InvalidTag:
+        raise CryptoError("Legacy blob failed authentication")
+
+def is_legacy_blob(file_id, file_path, fileobj=None):
+    """
+    Whether `file_path` (or the open `fileobj`) is a legacy single-shot blob that
+    authenticates under `file_id`'s stored key. Streams the blob. Key store errors other
+    than KeyNotFound propagate. Legacy blobs' AAD is their local path, so with no
+    `file_path` (object storage) there are none.
+    """
+    if fileobj is None:
+        with open(file_path, 'rb') as source:
+            return is_legacy_blob(file_id, file_path, source)
+    if file_path is None or is_container(fileobj):
+        return False
     try:
         key = get_encryption_key(file_id)
-    except Exception:
+    except KeyNotFound:
+        return False
+    try:
+        for _ in _iter_legacy_plaintext(key, fileobj, file_path):
+            pass
+    except (CryptoError, ValueError):
+        return False
+    return True
+
+class DecryptedFile:
+    """
+    Read-only plaintext view of an encrypted blob, decrypted chunk by chunk on iteration.
+
+    Legacy single-shot blobs can only be authenticated as a whole, so they are decrypted
+    into memory when opened. Compressed containers don't record their plaintext size, so
+    it must be passed in as `size`, and ranges are served by decompressing from the start.
+
+    Pass an already open, seekable `fileobj` to read a blob from somewhere other than the
+    local disk (e.g. object storage); `file_path` is then only the AAD of legacy blobs.
+    Pass `key` when the stored key was already fetched (see prefetch_encryption_keys()).
+    """
+
+    def __init__(self, file_id, file_path, size=None, fileobj=None, key=None):
+        self.file_path = file_path
+        self._fileobj = fileobj or open(file_path, 'rb')
+        try:
+            if is_container(self._fileobj):
+                header = ContainerHeader.read(self._fileobj)
+                key = resolve_data_key(file_id, header, key)
+                self._decryptor = ChunkDecryptor(key, self._fileobj, header)
+                self._legacy_data = None
+                ciphertext_size = self._fileobj.seek(0, io.SEEK_END)
+                self._chunk_count = header.chunk_count(ciphertext_size)
+                self.compressed = header.compression is not None
+                self.size = size if self.compressed else header.plaintext_size(ciphertext_size)
+            else:
+                _check_legacy_accepted()
+                if file_path is None:
+                    raise CryptoError("Legacy blobs can only be read from local disk")
+                buffer = io.BytesIO()
+                key = key if key is not None else get_encryption_key(file_id)
+                _decrypt_legacy(key, self._fileobj, buffer, file_path)
+                self._decryptor = None
+                self._legacy_data = buffer.getvalue()
+                self.compressed = False
+                self.size = len(self._legacy_data)
+                self._fileobj.close()
+        except Exception:
+            self._fileobj.close()
+            raise
+
+    def __iter__(self):
+        try:
+            if self._decryptor is None:
+                yield self._legacy_data
+            else:
+                self._fileobj.seek(self._decryptor.header.size)
+                yield from iter_plaintext(self._decryptor)
+        finally:
+            self.close()
+
+    def iter_range(self, start, stop):
+        """Yield plaintext bytes [start, stop) without decrypting the rest of the file"""
+        if self._decryptor is None:
+            yield self._legacy_data[start:stop]
+        elif self.compressed:
+            yield from self._iter_compressed_range(start, stop)
+        else:
+            yield from self._decryptor.iter_range(start, stop, self._chunk_count)
+
+    def _iter_compressed_range(self, start, stop):
+        # Compressed offsets don't map to chunks, so decrypt sequentially and skip ahead
+        self._fileobj.seek(self._decryptor.header.size)
+        offset = 0
+        for chunk in iter_plaintext(self._decryptor):
+            end = offset + len(chunk)
+            if end > start:
+                yield chunk[max(start - offset, 0):stop - offset]
+            if end >= stop:
+                return
+            offset = end
+
+    def close(self):
+        self._fileobj.close()
+
+def open_decrypted_file(file_id, file_path, size=None, fileobj=None, key=None):
+    """
+    Resolve the key for `file_id` (unless its stored `key` is given) and open `file_path`
+    (or `fileobj`) for streaming decryption. `size` is the recorded plaintext size, only
+    needed for compressed blobs.
+    """
+    try:
+        return DecryptedFile(file_id, file_path, size, fileobj, key)
+    except FileNotFoundError:
+        raise
+    except Exception as e:
+        raise CryptoError(f"Decryption failed: {str(e)}")
+
+def encrypt_file(file_id, file_path, mime=None):
+    """
+    Encrypt a file in place into the chunked container format, compressing it
+    first when its type and contents look compressible
+    """
+    # Envelope mode carries a fresh wrapped key in the header, otherwise get or generate one
+    if envelope_enabled():
         key = generate_encryption_key()
-        store_encryption_key(file_id, key)
+    else:
+        try:
+            key = get_encryption_key(file_id)
+        except KeyNotFound:
+            # Only when there is positively no key: replacing one the store failed to
+            # return would orphan whatever it encrypts
+            key = generate_encryption_key()
+            store_encryption_key(file_id, key)
 
-    # Initialize AESGCM
-    aesgcm = AESGCM(key)
-    
-    # Generate a random 96-bit (12 byte) nonce
-    nonce = os.urandom(12)
-    
-    # Read file
-    with open(file_path, 'rb') as file:
-        data = file.read()
-    
-    # File path as associated data for additional authentication
-    associated_data = file_path.encode()
-    
+    temp_path = f"{file_path}.tmp"
     try:
-        # Encrypt and authenticate data
-        encrypted_data = aesgcm.encrypt(nonce, data, associated_data)
-        
-        # Combine nonce and encrypted data
-        final_data = nonce + encrypted_data
-        
-        # Write to temp file and replace
-        temp_path = f"{file_path}.tmp"
-        with open(temp_path, 'wb') as file:
-            file.write(final_data)
+        with open(file_path, 'rb') as source, open(temp_path, 'wb') as destination:
+            codec = choose_codec(mime, source.read(SAMPLE_SIZE))
+            source.seek(0)
+            encrypt_stream(key, source, destination, extensions=envelope_extensions(key), compression=codec)
         os.replace(temp_path, file_path)
-            
     except Exception as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
         raise CryptoError(f"Encryption failed: {str(e)}")
 
-def decrypt_file(file_id, file_path, temp_output_path=None, vault_client=None):
-    """Decrypt a file using AES-256-GCM"""
-    if vault_client is None:
-        vault_client = get_vault_client()
-
-    key = get_encryption_key(file_id)
-    aesgcm = AESGCM(key)
-
-    try:
-        with open(file_path, 'rb') as file:
-            file_data = file.read()
+def reencrypt_legacy_file(file_id, file_path, mime=None):
+    """
+    Rewrite a legacy single-shot blob in place in the container format, whose AAD no longer
+    depends on the path. Returns False, without touching the file, if it is not legacy.
 
-        nonce = file_data[:12]
-        encrypted_data = file_data[12:]
-        associated_data = file_path.encode()
+    The plaintext is streamed from the old blob into a `.tmp` container, which only
+    replaces the blob once the old one has authenticated in full.
+    """
+    temp_path = f"{file_path}.tmp"
+    with open(file_path, 'rb') as source:
+        if is_container(source):
+            return False
+        key = get_encryption_key(file_id)
+        # Envelope mode moves the file to a fresh wrapped key, otherwise it keeps its stored one
+        new_key = generate_encryption_key() if envelope_enabled() else key
 
-        decrypted_data = aesgcm.decrypt(nonce, encrypted_data, associated_data)
+        try:
+            plaintext = _iter_legacy_plaintext(key, source, file_path)
+            # Hold back just enough of the start to choose a codec from
+            head = bytearray()
+            for chunk in plaintext:
+                head += chunk
+                if len(head) >= SAMPLE_SIZE:
+                    break
+            with open(temp_path, 'wb') as destination:
+                encryptor = ChunkEncryptor(
+                    new_key,
+                    destination,
+                    extensions=envelope_extensions(new_key),
+                    compression=choose_codec(mime, bytes(head[:SAMPLE_SIZE]))
+                )
+                encryptor.write(bytes(head))
+                for chunk in plaintext:
+                    encryptor.write(chunk)
+                encryptor.close()
+                destination.flush()
+                os.fsync(destination.fileno())
+        except Exception as e:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            if isinstance(e, CryptoError):
+                raise
+            raise CryptoError(f"Re-encryption failed: {str(e)}")
+    os.replace(temp_path, file_path)
+    return True
 
-        # Determine where to write the decrypted data
-        if temp_output_path:
-            output_path = temp_output_path
-        else:
-            temp_path = f"{file_path}.tmp"
-            output_path = temp_path
+def verify_file(file_id, file_path, fileobj=None):
+    """
+    Authenticate every chunk of a blob (and decompress it, if compressed) without keeping
+    any plaintext. Raises CryptoError if it is corrupt and FileNotFoundError if it is gone;
+    key store errors propagate as they are, since they say nothing about the blob. Pass
+    `fileobj` to read it from elsewhere than `file_path`, as for DecryptedFile.
+    """
+    try:
+        for _ in DecryptedFile(file_id, file_path, fileobj=fileobj):
+            pass
+    except (CryptoError, CompressionError, struct.error, ValueError) as e:
+        raise CryptoError(f"Verification failed: {str(e)}")
 
-        # Write to the determined output path
-        with open(output_path, 'wb') as file:
-            file.write(decrypted_data)
+def decrypt_file(file_id, file_path, temp_output_path=None):
+    """Decrypt a file, in place or into `temp_output_path`"""
+    # Determine where to write the decrypted data
+    output_path = temp_output_path or f"{file_path}.tmp"
+    try:
+        with open(file_path, 'rb') as source, open(output_path, 'wb') as destination:
+            if is_container(source):
+                header = ContainerHeader.read(source)
+                decrypt_stream(resolve_data_key(file_id, header), source, destination, header)
+            else:
+                _check_legacy_accepted()
+                _decrypt_legacy(get_encryption_key(file_id), source, destination, file_path)
 
         # If not using a temporary output path, replace the original file
         if not temp_output_path:
-            os.replace(temp_path, file_path)
+            os.replace(output_path, file_path)
 
     except Exception as e:
-        if not temp_output_path and os.path.exists(temp_path):
-            os.remove(temp_path)  # Clean up only if temp_path was used
-        raise CryptoError(f"Decryption failed: {str(e)}")
\ No newline at end of file
+        if not temp_output_path and os.path.exists(output_path):
+            os.remove(output_path)  # Clean up only if temp_path was used
+        raise CryptoError(f"Decryption failed: {str(e)}")
@@ -0,0 +1,349 @@
+import base64
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from hvac.exceptions import InvalidPath, InvalidRequest
+from common import vault
+
+class KeyNotFound(Exception):
+    pass
+
+class KeyStoreError(Exception):
+    """
+    A stored key exists but can't be opened (e.g. a wrong master key or a tampered row).
+    Never a KeyNotFound: callers would take the file as keyless and replace its key.
+    """
+
+class KeyStore:
+    """
+    Where per-file data keys and the envelope key-encryption key (KEK) are kept.
+
+    Pick the backend with the KEY_STORE_BACKEND setting (a dotted class path).
+    """
+
+    def store(self, file_id, key):
+        raise NotImplementedError
+
+    def store_many(self, items):
+        """
+        Store the (file_id, key) pairs of `items`. Backends override this to batch the
+        writes; either way, when it raises, any of the keys may or may not have been stored.
+        """
+        for file_id, key in items:
+            self.store(file_id, key)
+
+    def get(self, file_id):
+        """Return the data key of `file_id`, raising KeyNotFound if there is none"""
+        raise NotImplementedError
+
+    def delete(self, file_id):
+        """Forget the data key of `file_id`; deleting a key that doesn't exist is not an error"""
+        raise NotImplementedError
+
+    def list_ids(self):
+        """Yield the ids (as strings) of every file that has a data key stored"""
+        raise NotImplementedError
+
+    def get_key_encryption_key(self, version=None):
+        """
+        Return (version, kek) for `version`, or for the current KEK when it is None.
+        The first call ever creates the KEK, safely against concurrent callers.
+        """
+        raise NotImplementedError
+
+class VaultKVKeyStore(KeyStore):
+    """Data keys and the KEK as hex secrets in Vault's KV v2 engine"""
+    KEY_PATH = 'secret/data/file-encryption-key/{file_id}'
+    KEK_PATH = 'secret/data/file-encryption-kek'
+
+    def _write(self, file_id, secret):
+        path = self.KEY_PATH.format(file_id=file_id)
+        vault.call_vault(lambda client: client.secrets.kv.v2.create_or_update_secret(path=path, secret=secret))
+
+    def _write_many(self, items):
+        # KV has no batch write: overlap the round trips instead
+        items = list(items)
+        workers = min(settings.FILE_KEY_PREFETCH_WORKERS, len(items))
+        if workers <= 1:
+            for file_id, secret in items:
+                self._write(file_id, secret)
+            return
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for future in [pool.submit(self._write, file_id, secret) for file_id, secret in items]:
+                future.result()
+
+    def _read(self, file_id):
+        path = self.KEY_PATH.format(file_id=file_id)
+        try:
+            response = vault.call_vault(lambda client: client.secrets.kv.v2.read_secret_version(path=path))
+        except InvalidPath:
+            # Only a 404 means there is no key: an outage or a denied read must not look like one
+            raise KeyNotFound(f"No key for file {file_id}")
+        return response['data']['data']
+
+    def store(self, file_id, key):
+        self._write(file_id, {'key': key.hex()})  # Store hex-encoded key
+
+    def store_many(self, items):
+        self._write_many((file_id, {'key': key.hex()}) for file_id, key in items)
+
+    def get(self, file_id):
+        return bytes.fromhex(self._read(file_id)['key'])
+
+    def delete(self, file_id):
+        path = self.KEY_PATH.format(file_id=file_id)
+        vault.call_vault(lambda client: client.secrets.kv.v2.delete_metadata_and_all_versions(path=path))
+
+    def list_ids(self):
+        path = self.KEY_PATH.rsplit('/', 1)[0]
+        try:
+            response = vault.call_vault(lambda client: client.secrets.kv.v2.list_secrets(path=path))
+        except InvalidPath:
+            return  # Nothing stored yet
+        yield from sorted(response['data']['keys'])
+
+    def _read_key_encryption_key(self, version=None):
+        try:
+            response = vault.call_vault(
+                lambda client: client.secrets.kv.v2.read_secret_version(path=self.KEK_PATH, version=version)
+            )
+        except InvalidPath:
+            raise KeyNotFound(f"No key-encryption key version {version}" if version else "No key-encryption key")
+        kek = bytes.fromhex(response['data']['data']['key'])
+        return response['data'].get('metadata', {}).get('version', version or 1), kek
+
+    def get_key_encryption_key(self, version=None):
+        if version is not None:
+            return self._read_key_encryption_key(version)
+        try:
+            return self._read_key_encryption_key()
+        except KeyNotFound:
+            # cas=0 only writes if no KEK exists yet, so racing workers agree on one
+            try:
+                vault.call_vault(lambda client: client.secrets.kv.v2.create_or_update_secret(
+                    path=self.KEK_PATH,
+                    secret={'key': AESGCM.generate_key(bit_length=256).hex()},
+                    cas=0
+                ))
+            except InvalidRequest:
+                pass  # check-and-set mismatch: another worker created it first
+            return self._read_key_encryption_key()
+
+class SQLiteKeyTable:
+    """
+    Tiny SQLite table of opaque key blobs, for LocalKeyStore.
+
+    Connections are per thread and per process, so it is safe under gunicorn workers.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS data_keys (file_id TEXT PRIMARY KEY, blob BLOB NOT NULL)'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS key_encryption_keys (version INTEGER PRIMARY KEY, blob BLOB NOT NULL)'
+            )
+
+    def _connection(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.connection = sqlite3.connect(self.path, timeout=30)
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def put(self, file_id, blob):
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO data_keys (file_id, blob) VALUES (?, ?)', (str(file_id), blob)
+            )
+
+    def put_many(self, items):
+        """Store (file_id, blob) pairs in one transaction"""
+        with self._connection() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO data_keys (file_id, blob) VALUES (?, ?)',
+                [(str(file_id), blob) for file_id, blob in items]
+            )
+
+    def get(self, file_id):
+        row = self._connection().execute(
+            'SELECT blob FROM data_keys WHERE file_id = ?', (str(file_id),)
+        ).fetchone()
+        if row is None:
+            raise KeyNotFound(f"No key for file {file_id}")
+        return row[0]
+
+    def delete(self, file_id):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM data_keys WHERE file_id = ?', (str(file_id),))
+
+    def list_ids(self, page_size=1000):
+        # Paged, so callers may delete keys while they iterate
+        last = ''
+        while True:
+            rows = self._connection().execute(
+                'SELECT file_id FROM data_keys WHERE file_id > ? ORDER BY file_id LIMIT ?', (last, page_size)
+            ).fetchall()
+            if not rows:
+                return
+            for (file_id,) in rows:
+                yield file_id
+            last = rows[-1][0]
+
+    def get_kek(self, version=None):
+        """Return (version, blob) of `version` or of the newest KEK, or None"""
+        if version is None:
+            query, params = 'SELECT version, blob FROM key_encryption_keys ORDER BY version DESC LIMIT 1', ()
+        else:
+            query, params = 'SELECT version, blob FROM key_encryption_keys WHERE version = ?', (version,)
+        return self._connection().execute(query, params).fetchone()
+
+    def add_kek_if_missing(self, blob):
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT OR IGNORE INTO key_encryption_keys (version, blob) VALUES (1, ?)', (blob,)
+            )
+
+class LocalKeyStore(KeyStore):
+    """
+    Keys in a local SQLite file, each sealed with AES-GCM under KEY_STORE_MASTER_KEY.
+
+    Needs no Vault, which suits single-box load tests, CI and small deployments.
+    """
+
+    def __init__(self):
+        master_key = settings.KEY_STORE_MASTER_KEY
+        if not master_key:
+            raise ImproperlyConfigured("KEY_STORE_MASTER_KEY is required for the local key store")
+        self._aead = AESGCM(bytes.fromhex(master_key))
+        self._table = SQLiteKeyTable(settings.KEY_STORE_SQLITE_PATH)
+
+    def _seal(self, key, label):
+        nonce = os.urandom(12)
+        return nonce + self._aead.encrypt(nonce, key, label.encode())
+
+    def _unseal(self, blob, label):
+        try:
+            return self._aead.decrypt(blob[:12], blob[12:], label.encode())
+        except InvalidTag:
+            raise KeyStoreError(f"Key {label} failed authentication under the master key")
+
+    def store(self, file_id, key):
+        self._table.put(file_id, self._seal(key, f'file:{file_id}'))
+
+    def store_many(self, items):
+        self._table.put_many((file_id, self._seal(key, f'file:{file_id}')) for file_id, key in items)
+
+    def get(self, file_id):
+        return self._unseal(self._table.get(file_id), f'file:{file_id}')
+
+    def delete(self, file_id):
+        self._table.delete(file_id)
+
+    def list_ids(self):
+        return self._table.list_ids()
+
+    def get_key_encryption_key(self, version=None):
+        row = self._table.get_kek(version)
+        if row is None and version is None:
+            self._table.add_kek_if_missing(self._seal(AESGCM.generate_key(bit_length=256), 'kek:1'))
+            row = self._table.get_kek()
+        if row is None:
+            raise KeyNotFound(f"No key-encryption key version {version}")
+        return row[0], self._unseal(row[1], f'kek:{row[0]}')
+
+class VaultTransitKeyStore(VaultKVKeyStore):
+    """
+    Data keys wrapped by Vault's Transit engine (the wrapping key never leaves Vault).
+    Only the wrapped form is kept, in KV at the same paths as VaultKVKeyStore, so it is
+    as durable as Vault itself and every host reads the same keys. The KEK stays in KV.
+    """
+
+    def __init__(self):
+        self.transit_key = settings.KEY_STORE_TRANSIT_KEY
+
+    def _wrap(self, keys):
+        """Transit ciphertexts of `keys`, wrapped in one call"""
+        response = vault.call_vault(lambda client: client.secrets.transit.encrypt_data(
+            name=self.transit_key,
+            batch_input=[{'plaintext': base64.b64encode(key).decode()} for key in keys]
+        ))
+        results = response['data']['batch_results']
+        errors = [result['error'] for result in results if result.get('error')]
+        if errors:
+            raise Exception(f"Transit failed to wrap {len(errors)} keys: {errors[0]}")
+        return [result['ciphertext'] for result in results]
+
+    def store(self, file_id, key):
+        self.store_many([(file_id, key)])
+
+    def store_many(self, items):
+        items = list(items)
+        if not items:
+            return
+        wrapped = self._wrap([key for _, key in items])
+        self._write_many((file_id, {'wrapped': ciphertext}) for (file_id, _), ciphertext in zip(items, wrapped))
+
+    def get(self, file_id):
+        ciphertext = self._read(file_id)['wrapped']
+        response = vault.call_vault(lambda client: client.secrets.transit.decrypt_data(
+            name=self.transit_key,
+            ciphertext=ciphertext
+        ))
+        return base64.b64decode(response['data']['plaintext'])
+
+class MemoryKeyStore(KeyStore):
+    """Keys in process memory only, gone on restart; for tests and benchmarks"""
+
+    def __init__(self):
+        self._keys = {}
+        self._key_encryption_key = AESGCM.generate_key(bit_length=256)
+
+    def store(self, file_id, key):
+        self._keys[str(file_id)] = key
+
+    def store_many(self, items):
+        self._keys.update((str(file_id), key) for file_id, key in items)
+
+    def get(self, file_id):
+        try:
+            return self._keys[str(file_id)]
+        except KeyError:
+            raise KeyNotFound(f"No key for file {file_id}")
+
+    def delete(self, file_id):
+        self._keys.pop(str(file_id), None)
+
+    def list_ids(self):
+        return iter(sorted(self._keys))
+
+    def get_key_encryption_key(self, version=None):
+        if version not in (None, 1):
+            raise KeyNotFound(f"No key-encryption key version {version}")
+        return 1, self._key_encryption_key
+
+_key_store = None
+_key_store_lock = threading.Lock()
+
+def get_key_store():
+    """The configured key store, built once per process"""
+    global _key_store
+    with _key_store_lock:
+        if _key_store is None:
+            _key_store = import_string(settings.KEY_STORE_BACKEND)()
+        return _key_store
+
+def reset_key_store():
+    """Forget the configured key store so the next call rebuilds it from settings"""
+    global _key_store
+    with _key_store_lock:
+        _key_store = None
@@ -0,0 +1,109 @@
+import hashlib
+import time
+from http import HTTPStatus
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.cache import get_conditional_response
+from rest_framework.response import Response
+
+# Scope of the lists admins see: everyone's rows, so any change invalidates it
+ALL = 'all'
+
+def _cache():
+    return caches[settings.LIST_CACHE_ALIAS]
+
+def _version_key(namespace, scope):
+    return f'listcache:{namespace}:version:{scope}'
+
+def _seed(cache, key):
+    # Seeded from the clock, not 1: a counter evicted from a shared cache must not restart
+    # at a version whose entries may still be cached
+    cache.add(key, time.time_ns(), timeout=None)
+
+def _version(cache, namespace, scope):
+    key = _version_key(namespace, scope)
+    version = cache.get(key)
+    if version is None:
+        _seed(cache, key)
+        version = cache.get(key)
+    return version
+
+def _increment(cache, key):
+    try:
+        cache.incr(key)
+    except ValueError:  # Not cached (yet, or any more)
+        _seed(cache, key)
+
+def _bump_now(namespace, user_ids):
+    cache = _cache()
+    for scope in (*user_ids, ALL):
+        _increment(cache, _version_key(namespace, scope))
+
+def invalidate(namespace, *user_ids):
+    """
+    Make the cached `namespace` lists of `user_ids`, and the lists admins see, stale.
+
+    Bumped straight away, so the writer's own transaction reads fresh lists, and again on
+    commit, so a list another request cached from the pre-commit rows in between is not served.
+    """
+    _bump_now(namespace, user_ids)
+    transaction.on_commit(lambda: _bump_now(namespace, user_ids))
+
+def _count(cache, namespace, outcome):
+    key = f'listcache:{namespace}:{outcome}'
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+def stats(namespaces):
+    """{namespace: {'hits': n, 'misses': n}} as counted by every process sharing the cache"""
+    cache = _cache()
+    counts = cache.get_many([f'listcache:{namespace}:{outcome}' for namespace in namespaces for outcome in ('hits', 'misses')])
+    return {
+        namespace: {outcome: counts.get(f'listcache:{namespace}:{outcome}', 0) for outcome in ('hits', 'misses')}
+        for namespace in namespaces
+    }
+
+def cached_list_response(namespace, request, build):
+    """
+    Serve a list response from the cache, or `build()` it and cache it when it is a 200.
+
+    Entries are keyed by the user's scope (their id, or ALL for admins), the scope's
+    version counter and the query string, so invalidate() drops them without deleting any
+    key and no cache backend feature beyond get/add/incr is needed. The X-Cache header
+    tells whether the response came from the cache.
+    """
+    user = request.user
+    if not settings.LIST_CACHE_TIMEOUT or not user.is_authenticated:
+        return build()
+
+    cache = _cache()
+    scope = ALL if user.is_admin else user.id
+    query = hashlib.sha256(request.META.get('QUERY_STRING', '').encode()).hexdigest()
+    version = _version(cache, namespace, scope)
+    key = f'listcache:{namespace}:{scope}:{version}:{query}'
+    headers = {'ETag': f'W/"{namespace}-{scope}-{version}-{query[:16]}"', 'Cache-Control': 'private, no-cache'}
+
+    not_modified = get_conditional_response(request, etag=headers['ETag'])
+    if not_modified is not None:
+        _count(cache, namespace, 'hits')
+        for header, value in headers.items():
+            not_modified[header] = value
+        return not_modified
+
+    data = cache.get(key)
+    if data is not None:
+        _count(cache, namespace, 'hits')
+        return Response(data, headers={**headers, 'X-Cache': 'HIT'})
+
+    _count(cache, namespace, 'misses')
+    response = build()
+    if response.status_code == HTTPStatus.OK:
+        cache.set(key, response.data, timeout=settings.LIST_CACHE_TIMEOUT)
+        for header, value in headers.items():
+            response[header] = value
+    response['X-Cache'] = 'MISS'
+    return response
@@ -0,0 +1,50 @@
+import os
+import zlib
+from django.test import TestCase, override_settings
+from common.compression import (
+    CODEC_ZLIB,
+    DECOMPRESS_OUTPUT_SIZE,
+    CompressionError,
+    choose_codec,
+    decompress_chunks,
+    sample_entropy
+)
+
+@override_settings(FILE_COMPRESSION='zlib')
+class ChooseCodecTests(TestCase):
+    def setUp(self):
+        self.text = b"id,name,email\n" + b"".join(f"{i},user{i},user{i}@example.com\n".encode() for i in range(2000))
+
+    def test_text_is_compressed(self):
+        self.assertEqual(choose_codec('text/csv', self.text), CODEC_ZLIB)
+        self.assertEqual(choose_codec('application/json; charset=utf-8', self.text), CODEC_ZLIB)
+
+    def test_compressed_formats_are_skipped_by_type(self):
+        self.assertIsNone(choose_codec('image/jpeg', self.text))
+        self.assertIsNone(choose_codec('application/zip', self.text))
+        self.assertEqual(choose_codec('image/svg+xml', self.text), CODEC_ZLIB)
+
+    def test_high_entropy_sample_is_skipped(self):
+        self.assertGreater(sample_entropy(os.urandom(65536)), 7.9)
+        self.assertIsNone(choose_codec('application/octet-stream', os.urandom(65536)))
+
+    @override_settings(FILE_COMPRESSION='none')
+    def test_disabled(self):
+        self.assertIsNone(choose_codec('text/csv', self.text))
+
+class DecompressChunksTests(TestCase):
+    def test_truncated_stream_fails(self):
+        compressed = zlib.compress(os.urandom(1000))
+        with self.assertRaises(CompressionError):
+            b''.join(decompress_chunks(CODEC_ZLIB, [compressed[:-10]]))
+
+    def test_output_is_bounded_per_step(self):
+        # 64 MiB of zeros deflate to ~64 KiB: one sealed chunk's worth
+        compressor = zlib.compressobj()
+        bomb = b''.join(compressor.compress(bytes(1024 * 1024)) for _ in range(64)) + compressor.flush()
+
+        total = 0
+        for data in decompress_chunks(CODEC_ZLIB, [bomb]):
+            self.assertLessEqual(len(data), DECOMPRESS_OUTPUT_SIZE)
+            total += len(data)
+        self.assertEqual(total, 64 * 1024 * 1024)
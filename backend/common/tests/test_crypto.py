@@ -1,17 +1,40 @@
 from unittest.mock import patch, MagicMock
+import io
 import os
 import tempfile
 import shutil
-from django.test import TestCase
+from django.apps import apps
+from django.test import TestCase, override_settings
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from hvac.exceptions import InvalidPath, InvalidRequest
+from common.keystore import VaultKVKeyStore
 from common.crypto import (
     generate_encryption_key,
     store_encryption_key,
     get_encryption_key,
     encrypt_file,
     decrypt_file,
-    CryptoError
+    encrypt_stream,
+    decrypt_stream,
+    ChunkEncryptor,
+    ChunkDecryptor,
+    ContainerHeader,
+    CryptoError,
+    EXT_WRAPPED_KEY,
+    CIPHER_AES_256_GCM,
+    CIPHER_CHACHA20_POLY1305,
+    available_ciphers,
+    default_cipher,
+    TAG_SIZE,
+    open_decrypted_file,
+    is_legacy_blob,
+    reencrypt_legacy_file,
+    KeyCache,
+    invalidate_encryption_key,
+    key_cache_stats,
+    prefetch_encryption_keys
 )
+from common.compression import CODEC_ZLIB
 import base64
 
 class CryptoTests(TestCase):
@@ -39,7 +62,7 @@ class CryptoTests(TestCase):
             self.stored_keys[path] = secret
         def mock_read_secret(path):
             if path not in self.stored_keys:
-                raise Exception("Key not found")
+                raise InvalidPath("Key not found")
             return {'data': {'data': self.stored_keys[path]}}
             
         self.mock_client.secrets.kv.v2.create_or_update_secret.side_effect = mock_store_secret
@@ -156,4 +179,380 @@ class CryptoTests(TestCase):
         # Verify content
         with open(large_file_path, 'rb') as f:
             decrypted_content = f.read()
-        self.assertEqual(decrypted_content, large_data) 
\ No newline at end of file
+        self.assertEqual(decrypted_content, large_data)
+
+    def test_legacy_blob_still_decrypts(self):
+        store_encryption_key(self.file_id, self.key)
+
+        # Write a blob in the old single-shot format
+        nonce = os.urandom(12)
+        legacy = nonce + AESGCM(self.key).encrypt(nonce, self.test_data, self.test_file_path.encode())
+        with open(self.test_file_path, 'wb') as f:
+            f.write(legacy)
+
+        decrypt_file(self.file_id, self.test_file_path)
+
+        with open(self.test_file_path, 'rb') as f:
+            self.assertEqual(f.read(), self.test_data)
+
+    def test_legacy_blob_rejected_once_migration_is_done(self):
+        store_encryption_key(self.file_id, self.key)
+        nonce = os.urandom(12)
+        legacy = nonce + AESGCM(self.key).encrypt(nonce, self.test_data, self.test_file_path.encode())
+        with open(self.test_file_path, 'wb') as f:
+            f.write(legacy)
+
+        with override_settings(FILE_ENCRYPTION_ACCEPT_LEGACY=False):
+            with self.assertRaises(CryptoError):
+                decrypt_file(self.file_id, self.test_file_path)
+
+    @override_settings(FILE_ENCRYPTION_CHUNK_SIZE=64)
+    def test_legacy_blob_is_reencrypted_in_chunks(self):
+        data = os.urandom(1000)
+        store_encryption_key(self.file_id, self.key)
+        nonce = os.urandom(12)
+        with open(self.test_file_path, 'wb') as f:
+            f.write(nonce + AESGCM(self.key).encrypt(nonce, data, self.test_file_path.encode()))
+        self.assertTrue(is_legacy_blob(self.file_id, self.test_file_path))
+
+        with patch('common.crypto.AESGCM.decrypt') as single_shot:
+            self.assertTrue(reencrypt_legacy_file(self.file_id, self.test_file_path))
+        single_shot.assert_not_called()
+        self.assertEqual(b''.join(open_decrypted_file(self.file_id, self.test_file_path)), data)
+
+    def test_tampered_legacy_blob_is_left_alone(self):
+        store_encryption_key(self.file_id, self.key)
+        nonce = os.urandom(12)
+        legacy = bytearray(nonce + AESGCM(self.key).encrypt(nonce, self.test_data, self.test_file_path.encode()))
+        legacy[-1] ^= 1
+        with open(self.test_file_path, 'wb') as f:
+            f.write(legacy)
+
+        self.assertFalse(is_legacy_blob(self.file_id, self.test_file_path))
+        with self.assertRaises(CryptoError):
+            reencrypt_legacy_file(self.file_id, self.test_file_path)
+        with open(self.test_file_path, 'rb') as f:
+            self.assertEqual(f.read(), legacy)
+        self.assertFalse(os.path.exists(self.test_file_path + '.tmp'))
+
+class ChunkedContainerTests(TestCase):
+    def setUp(self):
+        self.key = generate_encryption_key()
+        self.chunk_size = 16
+
+    def encrypt(self, data):
+        destination = io.BytesIO()
+        encrypt_stream(self.key, io.BytesIO(data), destination, chunk_size=self.chunk_size)
+        return destination.getvalue()
+
+    def decrypt(self, blob):
+        destination = io.BytesIO()
+        decrypt_stream(self.key, io.BytesIO(blob), destination)
+        return destination.getvalue()
+
+    def test_round_trip_across_chunk_boundaries(self):
+        for size in [0, 1, 15, 16, 17, 32, 33, 100]:
+            data = os.urandom(size)
+            blob = self.encrypt(data)
+            self.assertEqual(self.decrypt(blob), data)
+
+            # Header says how big the plaintext is without decrypting anything
+            header = ContainerHeader.read(io.BytesIO(blob))
+            self.assertEqual(header.plaintext_size(len(blob)), size)
+
+    def test_incremental_writes(self):
+        data = os.urandom(100)
+        destination = io.BytesIO()
+        with ChunkEncryptor(self.key, destination, chunk_size=self.chunk_size) as encryptor:
+            for i in range(0, len(data), 7):
+                encryptor.write(data[i:i + 7])
+        self.assertEqual(encryptor.plaintext_size, len(data))
+
+        chunks = list(ChunkDecryptor(self.key, io.BytesIO(destination.getvalue())))
+        self.assertTrue(all(len(chunk) <= self.chunk_size for chunk in chunks))
+        self.assertEqual(b''.join(chunks), data)
+
+    @override_settings(FILE_ENCRYPTION_PARALLEL_THRESHOLD=0, FILE_ENCRYPTION_QUEUE_DEPTH=2)
+    def test_parallel_encryption_matches_sequential_format(self):
+        chunk_size = 3000  # doesn't divide the 1 MiB parallel segment
+        segment = (1024 * 1024 // chunk_size) * chunk_size
+        for size in [0, 10, segment, segment + 1, 3 * segment, 3 * segment + 1234]:
+            data = os.urandom(size)
+            with tempfile.TemporaryFile() as source:
+                source.write(data)
+                source.seek(0)
+                destination = io.BytesIO()
+                written = encrypt_stream(self.key, source, destination, chunk_size=chunk_size, workers=4)
+
+            self.assertEqual(written, size)
+            blob = destination.getvalue()
+            header = ContainerHeader.read(io.BytesIO(blob))
+            self.assertEqual(header.plaintext_size(len(blob)), size)
+            self.assertEqual(self.decrypt(blob), data)
+
+    def test_truncation_at_chunk_boundary_fails(self):
+        blob = self.encrypt(os.urandom(48))
+        sealed_chunk = self.chunk_size + TAG_SIZE
+        with self.assertRaises(CryptoError):
+            self.decrypt(blob[:-sealed_chunk])
+
+    def test_reordered_chunks_fail(self):
+        blob = self.encrypt(os.urandom(48))
+        header_size = ContainerHeader.read(io.BytesIO(blob)).size
+        sealed_chunk = self.chunk_size + TAG_SIZE
+        first = blob[header_size:header_size + sealed_chunk]
+        second = blob[header_size + sealed_chunk:header_size + 2 * sealed_chunk]
+        swapped = blob[:header_size] + second + first + blob[header_size + 2 * sealed_chunk:]
+        with self.assertRaises(CryptoError):
+            self.decrypt(swapped)
+
+    def test_tampered_header_fails(self):
+        blob = bytearray(self.encrypt(os.urandom(20)))
+        blob[12] ^= 1  # inside the nonce prefix, which is authenticated as AAD
+        with self.assertRaises(CryptoError):
+            self.decrypt(bytes(blob))
+
+class CipherAgilityTests(TestCase):
+    def setUp(self):
+        self.key = generate_encryption_key()
+        self.data = os.urandom(1000)
+
+    def encrypt(self, cipher=None):
+        destination = io.BytesIO()
+        encrypt_stream(self.key, io.BytesIO(self.data), destination, chunk_size=256, cipher=cipher)
+        return destination.getvalue()
+
+    def decrypt(self, blob):
+        destination = io.BytesIO()
+        decrypt_stream(self.key, io.BytesIO(blob), destination)
+        return destination.getvalue()
+
+    def test_every_available_cipher_round_trips(self):
+        self.assertIn(CIPHER_AES_256_GCM, available_ciphers())
+        self.assertIn(CIPHER_CHACHA20_POLY1305, available_ciphers())
+        for cipher in available_ciphers():
+            blob = self.encrypt(cipher)
+            self.assertEqual(ContainerHeader.read(io.BytesIO(blob)).cipher, cipher)
+            self.assertEqual(self.decrypt(blob), self.data)
+
+    def test_old_files_stay_readable_after_default_changes(self):
+        with override_settings(FILE_ENCRYPTION_CIPHER='aes-256-gcm'):
+            blob = self.encrypt()
+        with override_settings(FILE_ENCRYPTION_CIPHER='chacha20-poly1305'):
+            self.assertEqual(default_cipher(), CIPHER_CHACHA20_POLY1305)
+            self.assertEqual(ContainerHeader.read(io.BytesIO(blob)).cipher, CIPHER_AES_256_GCM)
+            self.assertEqual(self.decrypt(blob), self.data)
+
+    @override_settings(FILE_ENCRYPTION_CIPHER='auto')
+    def test_auto_picks_fastest_once(self):
+        speeds = {CIPHER_AES_256_GCM: 100.0, CIPHER_CHACHA20_POLY1305: 400.0}
+        with patch('common.crypto._default_cipher', None), \
+                patch('common.crypto.benchmark_ciphers', return_value=speeds) as benchmark:
+            self.assertEqual(default_cipher(), CIPHER_CHACHA20_POLY1305)
+            self.assertEqual(default_cipher(), CIPHER_CHACHA20_POLY1305)
+        benchmark.assert_called_once()
+
+    def test_auto_is_measured_at_startup(self):
+        speeds = {CIPHER_AES_256_GCM: 100.0, CIPHER_CHACHA20_POLY1305: 400.0}
+        with patch('common.crypto._default_cipher', None), \
+                patch('common.crypto.benchmark_ciphers', return_value=speeds) as benchmark:
+            apps.get_app_config('files').ready()
+            benchmark.assert_called_once()
+            self.assertEqual(ContainerHeader.read(io.BytesIO(self.encrypt())).cipher, CIPHER_CHACHA20_POLY1305)
+        benchmark.assert_called_once()
+
+    def test_unknown_cipher_is_rejected(self):
+        blob = bytearray(self.encrypt())
+        blob[5] = 99  # cipher byte
+        with self.assertRaises(CryptoError):
+            self.decrypt(bytes(blob))
+
+class CompressedContainerTests(TestCase):
+    def setUp(self):
+        self.key = generate_encryption_key()
+        self.data = b"".join(f"{i},row {i},{i * 7 % 13}\n".encode() for i in range(5000))
+        self.test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_dir)
+        self.path = os.path.join(self.test_dir, 'blob')
+
+    def write_blob(self, data, compression):
+        with open(self.path, 'wb') as destination:
+            encrypt_stream(self.key, io.BytesIO(data), destination, chunk_size=1024, compression=compression)
+        return os.path.getsize(self.path)
+
+    def test_round_trip_is_smaller(self):
+        stored = self.write_blob(self.data, CODEC_ZLIB)
+        self.assertLess(stored, len(self.data) / 3)
+
+        with open(self.path, 'rb') as f:
+            self.assertEqual(ContainerHeader.read(f).compression, CODEC_ZLIB)
+        with patch('common.crypto.get_encryption_key', return_value=self.key):
+            decrypted = open_decrypted_file('compressed', self.path, len(self.data))
+            self.assertEqual(decrypted.size, len(self.data))
+            self.assertEqual(b''.join(decrypted), self.data)
+
+    def test_range_of_compressed_file(self):
+        self.write_blob(self.data, CODEC_ZLIB)
+        with patch('common.crypto.get_encryption_key', return_value=self.key):
+            decrypted = open_decrypted_file('compressed', self.path, len(self.data))
+            for start, stop in [(0, 10), (5000, 5100), (len(self.data) - 3, len(self.data))]:
+                self.assertEqual(b''.join(decrypted.iter_range(start, stop)), self.data[start:stop])
+            decrypted.close()
+
+    def test_empty_file(self):
+        self.write_blob(b'', CODEC_ZLIB)
+        with patch('common.crypto.get_encryption_key', return_value=self.key):
+            self.assertEqual(b''.join(open_decrypted_file('compressed', self.path, 0)), b'')
+
+    @override_settings(FILE_COMPRESSION='zlib')
+    def test_encrypt_file_compresses_by_type(self):
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        with patch('common.crypto.get_encryption_key', return_value=self.key):
+            encrypt_file('compressed', self.path, 'image/png')
+            with open(self.path, 'rb') as f:
+                self.assertIsNone(ContainerHeader.read(f).compression)
+
+            decrypt_file('compressed', self.path)
+            encrypt_file('compressed', self.path, 'text/csv')
+            with open(self.path, 'rb') as f:
+                self.assertEqual(ContainerHeader.read(f).compression, CODEC_ZLIB)
+            decrypt_file('compressed', self.path)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+@override_settings(FILE_ENCRYPTION_ENVELOPE=True)
+class EnvelopeEncryptionTests(TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.test_data = os.urandom(1000)
+        self.test_file_path = os.path.join(self.test_dir, "test_file.bin")
+        with open(self.test_file_path, 'wb') as f:
+            f.write(self.test_data)
+
+        # Every test starts with an empty in-process KEK cache
+        patch.dict('common.crypto._key_encryption_keys', clear=True).start()
+        patch('common.crypto._current_kek_version', None).start()
+        self.addCleanup(patch.stopall)
+
+        self.mock_client = MagicMock()
+        patch('common.vault.get_vault_client', return_value=self.mock_client).start()
+
+        # KV v2 with versions and check-and-set
+        self.secrets = {}
+        def mock_store_secret(path, secret, cas=None):
+            versions = self.secrets.setdefault(path, [])
+            if cas is not None and cas != len(versions):
+                raise InvalidRequest("check-and-set parameter did not match")
+            versions.append(secret)
+        def mock_read_secret(path, version=None):
+            if not self.secrets.get(path):
+                raise InvalidPath("Key not found")
+            version = version or len(self.secrets[path])
+            return {'data': {'data': self.secrets[path][version - 1], 'metadata': {'version': version}}}
+        self.mock_client.secrets.kv.v2.create_or_update_secret.side_effect = mock_store_secret
+        self.mock_client.secrets.kv.v2.read_secret_version.side_effect = mock_read_secret
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_wrapped_key_lives_in_header(self):
+        encrypt_file(1, self.test_file_path)
+
+        # Only the KEK is in Vault, no per-file key
+        self.assertEqual(list(self.secrets), [VaultKVKeyStore.KEK_PATH])
+        with open(self.test_file_path, 'rb') as f:
+            header = ContainerHeader.read(f)
+        self.assertIsNotNone(header.extension(EXT_WRAPPED_KEY))
+
+        decrypt_file(1, self.test_file_path)
+        with open(self.test_file_path, 'rb') as f:
+            self.assertEqual(f.read(), self.test_data)
+
+    def test_downloads_make_no_vault_calls_once_kek_is_cached(self):
+        encrypt_file(1, self.test_file_path)
+        self.mock_client.reset_mock()
+
+        for _ in range(3):
+            self.assertEqual(b''.join(open_decrypted_file(1, self.test_file_path)), self.test_data)
+        self.mock_client.secrets.kv.v2.read_secret_version.assert_not_called()
+
+    def test_files_under_older_kek_version_stay_readable(self):
+        encrypt_file(1, self.test_file_path)
+
+        # Rotate: a new KEK version appears in Vault and a fresh process picks it up
+        self.secrets[VaultKVKeyStore.KEK_PATH].append({'key': generate_encryption_key().hex()})
+        patch.dict('common.crypto._key_encryption_keys', clear=True).start()
+        patch('common.crypto._current_kek_version', None).start()
+
+        self.assertEqual(b''.join(open_decrypted_file(1, self.test_file_path)), self.test_data)
+
+class KeyCacheTests(TestCase):
+    def test_hit_and_miss_counters(self):
+        cache = KeyCache(max_entries=2, ttl=60)
+        self.assertIsNone(cache.get('1'))
+        cache.put('1', b'k' * 32)
+        self.assertEqual(cache.get('1'), b'k' * 32)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_least_recently_used_entry_is_evicted_and_zeroed(self):
+        cache = KeyCache(max_entries=2, ttl=60)
+        cache.put('1', b'1' * 32)
+        cache.put('2', b'2' * 32)
+        evicted_buffer = cache._entries['2'][1]
+        cache.get('1')  # '2' is now the least recently used
+        cache.put('3', b'3' * 32)
+
+        self.assertIsNone(cache.get('2'))
+        self.assertEqual(cache.get('1'), b'1' * 32)
+        self.assertEqual(evicted_buffer, bytearray(32))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_entries_expire(self):
+        cache = KeyCache(max_entries=2, ttl=60)
+        cache.put('1', b'1' * 32)
+        with patch('common.crypto.time.monotonic', return_value=10 ** 9):
+            self.assertIsNone(cache.get('1'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    @override_settings(FILE_KEY_CACHE_SIZE=10)
+    def test_get_encryption_key_uses_cache(self):
+        mock_client = MagicMock()
+        key = generate_encryption_key()
+        mock_client.secrets.kv.v2.read_secret_version.return_value = {'data': {'data': {'key': key.hex()}}}
+
+        with patch('common.crypto._key_cache', None), \
+                patch('common.vault.get_vault_client', return_value=mock_client):
+            self.assertEqual(get_encryption_key(7), key)
+            self.assertEqual(get_encryption_key(7), key)
+            self.assertEqual(mock_client.secrets.kv.v2.read_secret_version.call_count, 1)
+
+            invalidate_encryption_key(7)
+            self.assertEqual(get_encryption_key(7), key)
+            self.assertEqual(mock_client.secrets.kv.v2.read_secret_version.call_count, 2)
+            self.assertEqual(key_cache_stats()['hits'], 1)
+
+    def test_prefetch_yields_keys_in_order(self):
+        keys = {file_id: generate_encryption_key() for file_id in range(10)}
+
+        def fetch(file_id):
+            if file_id == 3:
+                raise Exception("no stored key")
+            return keys[file_id]
+
+        with patch('common.crypto.get_encryption_key', side_effect=fetch):
+            results = list(prefetch_encryption_keys(((file_id, f'item-{file_id}') for file_id in keys), workers=3, window=4))
+
+        self.assertEqual([item for item, _ in results], [f'item-{file_id}' for file_id in keys])
+        self.assertEqual([key for _, key in results], [None if file_id == 3 else keys[file_id] for file_id in keys])
+
+    def test_prefetch_skips_files_that_need_no_stored_key(self):
+        keys = {file_id: generate_encryption_key() for file_id in range(6)}
+        with patch('common.crypto.get_encryption_key', side_effect=keys.__getitem__) as get_key:
+            results = list(prefetch_encryption_keys(
+                ((file_id, file_id) for file_id in keys), workers=2, needs_key=lambda file_id: file_id % 2 == 0
+            ))
+
+        self.assertEqual(results, [(file_id, keys[file_id] if file_id % 2 == 0 else None) for file_id in keys])
+        self.assertEqual(sorted(call.args[0] for call in get_key.call_args_list), [0, 2, 4])
@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+from unittest.mock import patch, MagicMock
+from django.test import SimpleTestCase, override_settings
+from hvac.exceptions import InternalServerError, InvalidPath
+from common.crypto import generate_encryption_key
+from common.keystore import (
+    LocalKeyStore,
+    VaultKVKeyStore,
+    VaultTransitKeyStore,
+    KeyNotFound,
+    KeyStoreError,
+    SQLiteKeyTable,
+    get_key_store,
+    reset_key_store
+)
+
+class LocalKeyStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.master_key = generate_encryption_key().hex()
+        self.settings_override = override_settings(
+            KEY_STORE_MASTER_KEY=self.master_key,
+            KEY_STORE_SQLITE_PATH=os.path.join(self.test_dir, 'keys.sqlite3')
+        )
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.test_dir)
+
+    def test_store_and_get(self):
+        key = generate_encryption_key()
+        LocalKeyStore().store(1, key)
+        # A fresh instance (e.g. another worker) reads the same file
+        self.assertEqual(LocalKeyStore().get(1), key)
+
+    def test_missing_key(self):
+        with self.assertRaises(KeyNotFound):
+            LocalKeyStore().get(404)
+
+    def test_delete_and_list(self):
+        store = LocalKeyStore()
+        for file_id in range(5):
+            store.store(file_id, generate_encryption_key())
+        store.delete(3)
+        store.delete(404)
+
+        self.assertEqual(list(store._table.list_ids(page_size=2)), ['0', '1', '2', '4'])
+        with self.assertRaises(KeyNotFound):
+            store.get(3)
+
+    def test_store_many(self):
+        keys = {file_id: generate_encryption_key() for file_id in range(3)}
+        LocalKeyStore().store_many(keys.items())
+        store = LocalKeyStore()
+        self.assertEqual({file_id: store.get(file_id) for file_id in keys}, keys)
+
+    def test_keys_are_sealed_under_master_key(self):
+        key = generate_encryption_key()
+        LocalKeyStore().store(1, key)
+        LocalKeyStore().get_key_encryption_key()
+        table = SQLiteKeyTable(os.path.join(self.test_dir, 'keys.sqlite3'))
+        self.assertNotIn(key, table.get(1))
+
+        # A blob moved to another file id doesn't authenticate
+        table.put(2, table.get(1))
+        with self.assertRaises(KeyStoreError):
+            LocalKeyStore().get(2)
+
+        # A wrong master key is an error, not a missing key
+        with override_settings(KEY_STORE_MASTER_KEY=generate_encryption_key().hex()):
+            with self.assertRaises(KeyStoreError):
+                LocalKeyStore().get(1)
+            with self.assertRaises(KeyStoreError):
+                LocalKeyStore().get_key_encryption_key()
+
+    def test_key_encryption_key_is_created_once(self):
+        version, kek = LocalKeyStore().get_key_encryption_key()
+        self.assertEqual(LocalKeyStore().get_key_encryption_key(), (version, kek))
+        self.assertEqual(LocalKeyStore().get_key_encryption_key(version), (version, kek))
+
+    def test_configured_backend(self):
+        with override_settings(KEY_STORE_BACKEND='common.keystore.LocalKeyStore'):
+            reset_key_store()
+            self.addCleanup(reset_key_store)
+            self.assertIsInstance(get_key_store(), LocalKeyStore)
+
+class VaultKVKeyStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.mock_client = MagicMock()
+        patcher = patch('common.vault.get_vault_client', return_value=self.mock_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_only_a_missing_secret_is_key_not_found(self):
+        self.mock_client.secrets.kv.v2.read_secret_version.side_effect = InvalidPath()
+        with self.assertRaises(KeyNotFound):
+            VaultKVKeyStore().get(1)
+
+        # An outage is not an absent key; callers would replace the real one
+        self.mock_client.secrets.kv.v2.read_secret_version.side_effect = InternalServerError()
+        with self.assertRaises(InternalServerError):
+            VaultKVKeyStore().get(1)
+        with self.assertRaises(InternalServerError):
+            VaultKVKeyStore().get_key_encryption_key()
+        self.mock_client.secrets.kv.v2.create_or_update_secret.assert_not_called()
+
+    def test_key_encryption_key_is_created_when_missing(self):
+        kek = generate_encryption_key()
+        self.mock_client.secrets.kv.v2.read_secret_version.side_effect = [
+            InvalidPath(), {'data': {'data': {'key': kek.hex()}, 'metadata': {'version': 1}}}
+        ]
+        self.assertEqual(VaultKVKeyStore().get_key_encryption_key(), (1, kek))
+        self.assertEqual(self.mock_client.secrets.kv.v2.create_or_update_secret.call_args.kwargs['cas'], 0)
+
+class VaultTransitKeyStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.mock_client = MagicMock()
+        self.mock_client.secrets.transit.encrypt_data.side_effect = lambda name, batch_input: {
+            'data': {'batch_results': [{'ciphertext': f'vault:v1:{item["plaintext"]}'} for item in batch_input]}
+        }
+        self.mock_client.secrets.transit.decrypt_data.side_effect = lambda name, ciphertext: {
+            'data': {'plaintext': ciphertext[len('vault:v1:'):]}
+        }
+        # KV as a dict, shared by every store like Vault is by every host
+        self.kv = {}
+        self.mock_client.secrets.kv.v2.create_or_update_secret.side_effect = (
+            lambda path, secret: self.kv.__setitem__(path, secret)
+        )
+
+        def read_secret_version(path):
+            if path not in self.kv:
+                raise InvalidPath()
+            return {'data': {'data': self.kv[path]}}
+        self.mock_client.secrets.kv.v2.read_secret_version.side_effect = read_secret_version
+        patcher = patch('common.vault.get_vault_client', return_value=self.mock_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_store_and_get(self):
+        key = generate_encryption_key()
+        VaultTransitKeyStore().store(1, key)
+        # Another host reads the same wrapped key; only the wrapped form was kept
+        self.assertEqual(VaultTransitKeyStore().get(1), key)
+        self.assertNotIn(key.hex(), str(self.kv))
+        self.assertEqual(
+            self.mock_client.secrets.transit.encrypt_data.call_args.kwargs['name'], 'file-encryption'
+        )
+        with self.assertRaises(KeyNotFound):
+            VaultTransitKeyStore().get(2)
+
+    def test_store_many_wraps_the_batch_in_one_call(self):
+        keys = {file_id: generate_encryption_key() for file_id in range(3)}
+        store = VaultTransitKeyStore()
+        store.store_many(keys.items())
+        self.assertEqual({file_id: store.get(file_id) for file_id in keys}, keys)
+        self.assertEqual(self.mock_client.secrets.transit.encrypt_data.call_count, 1)
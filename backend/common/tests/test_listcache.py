@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory
+
+from common import listcache
+
+class ListCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = APIRequestFactory()
+        self.builds = 0
+
+    def request(self, user_id=1, admin=False, query=''):
+        request = self.factory.get(f'/list/?{query}')
+        request.user = SimpleNamespace(id=user_id, is_admin=admin, is_authenticated=True)
+        return request
+
+    def build(self, status=200):
+        self.builds += 1
+        return Response({'build': self.builds}, status=status)
+
+    def get(self, request, status=200):
+        return listcache.cached_list_response('things', request, lambda: self.build(status))
+
+    def test_serves_repeated_lists_from_cache(self):
+        first = self.get(self.request())
+        second = self.get(self.request())
+        self.assertEqual((first['X-Cache'], second['X-Cache']), ('MISS', 'HIT'))
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(self.builds, 1)
+
+        # Other users and other query strings have entries of their own
+        self.get(self.request(user_id=2))
+        self.get(self.request(query='limit=10'))
+        self.assertEqual(self.builds, 3)
+        self.assertEqual(listcache.stats(['things']), {'things': {'hits': 1, 'misses': 3}})
+
+    def test_invalidate_drops_the_users_and_admins_lists(self):
+        self.get(self.request(user_id=1))
+        self.get(self.request(user_id=2))
+        self.get(self.request(user_id=3, admin=True))
+
+        listcache.invalidate('things', 1)
+        self.assertEqual(self.get(self.request(user_id=1))['X-Cache'], 'MISS')
+        self.assertEqual(self.get(self.request(user_id=2))['X-Cache'], 'HIT')
+        self.assertEqual(self.get(self.request(user_id=3, admin=True))['X-Cache'], 'MISS')
+
+        # Bumped again once the transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            listcache.invalidate('things', 2)
+        self.assertEqual(self.get(self.request(user_id=2))['X-Cache'], 'MISS')
+
+    def test_evicted_version_counter_does_not_revive_old_entries(self):
+        self.get(self.request())
+        listcache.invalidate('things', 1)
+        self.get(self.request())
+        cache.delete(listcache._version_key('things', 1))
+        self.assertEqual(self.get(self.request())['X-Cache'], 'MISS')
+
+    def test_only_successful_responses_are_cached(self):
+        self.get(self.request(), status=400)
+        self.assertEqual(self.get(self.request())['X-Cache'], 'MISS')
+
+    @override_settings(LIST_CACHE_TIMEOUT=0)
+    def test_disabled_by_zero_timeout(self):
+        self.get(self.request())
+        response = self.get(self.request())
+        self.assertNotIn('X-Cache', response)
+        self.assertEqual(self.builds, 2)
@@ -0,0 +1,58 @@
+from unittest.mock import patch, MagicMock
+from django.test import SimpleTestCase
+from hvac.exceptions import Forbidden
+from common import vault
+
+class VaultClientTests(SimpleTestCase):
+    def setUp(self):
+        vault.reset_vault_client()
+        self.addCleanup(vault.reset_vault_client)
+        self.client_patcher = patch('common.vault.hvac.Client')
+        self.mock_client_class = self.client_patcher.start()
+        self.addCleanup(self.client_patcher.stop)
+        self.mock_client_class.side_effect = lambda **kwargs: MagicMock()
+
+    def test_client_is_reused(self):
+        first = vault.get_vault_client()
+        second = vault.get_vault_client()
+        self.assertIs(first, second)
+        self.assertEqual(self.mock_client_class.call_count, 1)
+
+    def test_token_check_is_cached(self):
+        client = vault.get_vault_client()
+        vault.get_vault_client()
+        vault.get_vault_client()
+        self.assertEqual(client.is_authenticated.call_count, 1)
+
+    def test_token_is_rechecked_after_interval(self):
+        with patch.dict('os.environ', {'VAULT_TOKEN_CHECK_INTERVAL': '0'}):
+            client = vault.get_vault_client()
+            vault.get_vault_client()
+        self.assertEqual(client.is_authenticated.call_count, 2)
+
+    def test_rejected_token_returns_none(self):
+        self.mock_client_class.side_effect = None
+        self.mock_client_class.return_value.is_authenticated.return_value = False
+        self.assertIsNone(vault.get_vault_client())
+
+    def test_connection_pool_is_sized_from_environment(self):
+        with patch.dict('os.environ', {'VAULT_POOL_SIZE': '32'}):
+            vault.get_vault_client()
+        session = self.mock_client_class.call_args.kwargs['session']
+        self.assertEqual(session.get_adapter('http://vault:8200')._pool_maxsize, 32)
+
+    def test_forbidden_rebuilds_client_and_retries(self):
+        stale = vault.get_vault_client()
+        operation = MagicMock(side_effect=[Forbidden(), 'ok'])
+
+        self.assertEqual(vault.call_vault(operation), 'ok')
+
+        fresh = operation.call_args_list[1][0][0]
+        self.assertIs(operation.call_args_list[0][0][0], stale)
+        self.assertIsNot(fresh, stale)
+        self.assertIs(vault.get_vault_client(), fresh)
+
+    def test_fork_drops_inherited_client(self):
+        parent = vault.get_vault_client()
+        vault._reset_after_fork()
+        self.assertIsNot(vault.get_vault_client(), parent)
@@ -1,15 +1,90 @@
 import os
+import threading
+import time
 import hvac
+import requests
+from hvac.exceptions import Forbidden
+from requests.adapters import HTTPAdapter
 
-def get_vault_client():
-    """Initialize and return a vault client only when needed"""
+# One client per process: its requests session keeps a keep-alive pool of Vault connections
+_client = None
+_token_checked_at = None
+_lock = threading.Lock()
+
+def _build_client():
     vault_addr = os.environ.get('VAULT_ADDR', 'http://localhost:8200')
     vault_token = os.environ.get('VAULT_TOKEN', 'your_root_token')
+    pool_size = int(os.environ.get('VAULT_POOL_SIZE', 10))
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
 
-    client = hvac.Client(
+    return hvac.Client(
         url=vault_addr,
         token=vault_token,
-        verify=False  # Disable SSL verification (only for development without TLS)
+        verify=False,  # Disable SSL verification (only for development without TLS)
+        session=session
     )
-    
-    return client if client.is_authenticated() else None 
\ No newline at end of file
+
+def get_vault_client():
+    """
+    Return this process's shared Vault client, creating it on first use.
+
+    The token is only re-validated every VAULT_TOKEN_CHECK_INTERVAL seconds; returns None
+    if Vault rejects it.
+    """
+    global _client, _token_checked_at
+    with _lock:
+        if _client is None:
+            _client = _build_client()
+            _token_checked_at = None
+        client = _client
+        checked_at = _token_checked_at
+
+    check_interval = int(os.environ.get('VAULT_TOKEN_CHECK_INTERVAL', 300))
+    now = time.monotonic()
+    if checked_at is not None and now - checked_at < check_interval:
+        return client
+
+    if not client.is_authenticated():
+        return None
+    with _lock:
+        if _client is client:
+            _token_checked_at = now
+    return client
+
+def reset_vault_client():
+    """Drop the shared client so the next call rebuilds it and re-reads the token"""
+    global _client, _token_checked_at
+    with _lock:
+        _client = None
+        _token_checked_at = None
+
+def call_vault(operation):
+    """
+    Run `operation(client)` against the shared client. A 403 means the token went stale,
+    so the client is rebuilt from the environment and the call retried once.
+    """
+    vault_client = get_vault_client()
+    if not vault_client:
+        raise Exception("Could not connect to vault")
+    try:
+        return operation(vault_client)
+    except Forbidden:
+        reset_vault_client()
+        vault_client = get_vault_client()
+        if not vault_client:
+            raise Exception("Could not connect to vault")
+        return operation(vault_client)
+
+def _reset_after_fork():
+    # The lock may have been held by another thread at fork time, so replace it too
+    global _client, _token_checked_at, _lock
+    _lock = threading.Lock()
+    _client = None
+    _token_checked_at = None
+
+# A gunicorn --preload fork inherits the parent's sockets; children must open their own
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -177,10 +177,43 @@ STATIC_URL = "/static/"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# Cache; the default in-process memory cache, or a shared one for several workers, e.g.
+# CACHE_BACKEND=django.core.cache.backends.redis.RedisCache CACHE_LOCATION=redis://redis:6379
+CACHES = {
+    "default": {
+        "BACKEND": os.getenv("CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": os.getenv("CACHE_LOCATION", ""),
+    }
+}
+LIST_CACHE_ALIAS = os.getenv("LIST_CACHE_ALIAS", "default")
+LIST_CACHE_TIMEOUT = int(
+    os.getenv("LIST_CACHE_TIMEOUT", 300)
+)  # seconds a file or user list response is cached, 0 disables the cache
+
 # Media files (User uploads)
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 
+# Where blobs are stored: local disk under MEDIA_ROOT, or files.storage.S3Storage
+FILE_STORAGE_BACKEND = os.getenv("FILE_STORAGE_BACKEND", "django.core.files.storage.FileSystemStorage")
+STORAGES = {
+    "default": {"BACKEND": FILE_STORAGE_BACKEND},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+}
+S3_BUCKET = os.getenv("S3_BUCKET", "")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL", "")  # e.g. http://minio:9000, empty for AWS
+S3_REGION = os.getenv("S3_REGION", "")
+S3_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID", "")
+S3_SECRET_ACCESS_KEY = os.getenv("S3_SECRET_ACCESS_KEY", "")
+S3_PART_SIZE = int(
+    os.getenv("S3_PART_SIZE", 8 * 1024 * 1024)
+)  # multipart upload part and ranged GET window; bounds memory per transfer
+S3_POOL_SIZE = int(os.getenv("S3_POOL_SIZE", 10))  # keep-alive connections per process
+
+# The change feed cursor never moves past changes younger than this, so a change whose
+# transaction commits after a later one was already polled is still delivered
+FILE_CHANGES_SETTLE_SECONDS = float(os.getenv("FILE_CHANGES_SETTLE_SECONDS", 5))
+
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": ("users.auth.JWTAuthentication",),
     "DEFAULT_PERMISSION_CLASSES": ("users.permissions.IsAdmin",),
@@ -201,3 +234,62 @@ AUTHENTICATION_BACKENDS = [
     "users.auth.JWTAuthentication",
     "django.contrib.auth.backends.ModelBackend",
 ]
+
+# File encryption settings
+FILE_ENCRYPTION_CHUNK_SIZE = int(
+    os.getenv("FILE_ENCRYPTION_CHUNK_SIZE", 64 * 1024)
+)  # plaintext bytes per sealed chunk, bounds memory per encrypt/decrypt
+FILE_ENCRYPTION_WORKERS = int(
+    os.getenv("FILE_ENCRYPTION_WORKERS", 1)
+)  # threads sealing chunks of large files; 1 keeps encryption single-threaded
+FILE_ENCRYPTION_QUEUE_DEPTH = int(
+    os.getenv("FILE_ENCRYPTION_QUEUE_DEPTH", 0)
+)  # 1 MiB segments in flight per file, 0 means twice the worker count
+FILE_ENCRYPTION_PARALLEL_THRESHOLD = int(
+    os.getenv("FILE_ENCRYPTION_PARALLEL_THRESHOLD", 8 * 1024 * 1024)
+)  # smaller files are not worth the thread hand-off
+FILE_ENCRYPTION_CIPHER = os.getenv(
+    "FILE_ENCRYPTION_CIPHER", "auto"
+)  # aes-256-gcm, chacha20-poly1305, or auto: the fastest of them on this host
+FILE_ENCRYPTION_ENVELOPE = (
+    os.getenv("FILE_ENCRYPTION_ENVELOPE", "False") == "True"
+)  # wrap per-file keys with a cached KEK and keep them in the file header
+FILE_ENCRYPTION_ACCEPT_LEGACY = (
+    os.getenv("FILE_ENCRYPTION_ACCEPT_LEGACY", "True") == "True"
+)  # still read pre-container blobs; turn off once migrate_legacy_blobs has finished
+FILE_COMPRESSION = os.getenv(
+    "FILE_COMPRESSION", "none"
+)  # compress compressible uploads before encryption: none, zlib or zstd (needs zstandard)
+FILE_COMPRESSION_LEVEL = int(
+    os.getenv("FILE_COMPRESSION_LEVEL", 0)
+)  # 0 means the codec's default level
+FILE_COMPRESSION_MAX_ENTROPY = float(
+    os.getenv("FILE_COMPRESSION_MAX_ENTROPY", 7.5)
+)  # bits per byte of the first chunk above which a file is stored uncompressed
+FILE_KEY_CACHE_SIZE = int(
+    os.getenv("FILE_KEY_CACHE_SIZE", 0)
+)  # max data keys cached in process memory, 0 disables the cache
+FILE_KEY_CACHE_TTL = int(os.getenv("FILE_KEY_CACHE_TTL", 300))  # seconds
+FILE_KEY_PREFETCH_WORKERS = int(
+    os.getenv("FILE_KEY_PREFETCH_WORKERS", 8)
+)  # concurrent key store calls for batches of files (archives, bulk uploads to Vault KV)
+FILE_ARCHIVE_MAX_FILES = int(
+    os.getenv("FILE_ARCHIVE_MAX_FILES", 10000)
+)  # files one archive download may name
+FILE_BULK_UPLOAD_MAX_FILES = int(
+    os.getenv("FILE_BULK_UPLOAD_MAX_FILES", 500)
+)  # parts one bulk upload request may carry
+FILE_BULK_UPLOAD_WORKERS = int(
+    os.getenv("FILE_BULK_UPLOAD_WORKERS", 4)
+)  # files of a bulk upload encrypted at the same time
+FILE_BULK_UPLOAD_QUEUE_DEPTH = int(
+    os.getenv("FILE_BULK_UPLOAD_QUEUE_DEPTH", 16)
+)  # upload chunks buffered per file ahead of its encryption thread
+# Django's own cap on files per request, raised to let bulk uploads through
+DATA_UPLOAD_MAX_NUMBER_FILES = FILE_BULK_UPLOAD_MAX_FILES
+
+# Key store for per-file data keys: VaultKVKeyStore, VaultTransitKeyStore or LocalKeyStore
+KEY_STORE_BACKEND = os.getenv("KEY_STORE_BACKEND", "common.keystore.VaultKVKeyStore")
+KEY_STORE_SQLITE_PATH = os.getenv("KEY_STORE_SQLITE_PATH", BASE_DIR / "keys.sqlite3")  # local store only
+KEY_STORE_MASTER_KEY = os.getenv("KEY_STORE_MASTER_KEY", "")  # hex AES-256 key, local store only
+KEY_STORE_TRANSIT_KEY = os.getenv("KEY_STORE_TRANSIT_KEY", "file-encryption")
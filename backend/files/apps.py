@@ -0,0 +1,20 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+def _install_search_index(using, **kwargs):
+    from files.search import install_search_index
+    install_search_index(using)
+
+class FilesConfig(AppConfig):
+    name = 'files'
+
+    def ready(self):
+        from files import signals  # noqa: F401 (connects the change feed receivers)
+
+        # The search index lives outside the models (virtual table, triggers, GIN index)
+        post_migrate.connect(_install_search_index, sender=self)
+
+        # With FILE_ENCRYPTION_CIPHER=auto, benchmark the ciphers now rather than inside the
+        # first upload; workers forked from a preloaded app inherit the result
+        from common.crypto import default_cipher
+        default_cipher()
@@ -0,0 +1,107 @@
+import io
+import logging
+import os
+import zipfile
+from django.utils import timezone
+
+from common.compression import compressible_mime
+from common.crypto import needs_stored_key, open_decrypted_file, prefetch_encryption_keys
+from .storage import local_path, open_blob
+
+logger = logging.getLogger(__name__)
+
+# Name of the entry listing the files that could not be added
+ERRORS_ENTRY = 'ERRORS.txt'
+
+# Earliest timestamp a ZIP entry can carry
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+class ZipStream(io.RawIOBase):
+    """
+    Write-only, unseekable sink for zipfile that hands back what was written so far.
+    Being unseekable makes zipfile write data descriptors after each entry instead of
+    seeking back to patch the local headers, so the archive can be sent as it is built.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        return len(data)
+
+    def drain(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+def entry_name(name, taken, default='file'):
+    """`name` made flat and unique in the archive; `taken` collects the names used"""
+    name = os.path.basename(name.replace('\\', '/'))
+    if name in ('', '.', '..'):
+        name = default
+    stem, ext = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate.lower() in taken:
+        n += 1
+        candidate = f'{stem} ({n}){ext}'
+    taken.add(candidate.lower())
+    return candidate
+
+def _entry_info(file, name, size):
+    date_time = timezone.localtime(file.uploaded_at).timetuple()[:6]
+    info = zipfile.ZipInfo(name, date_time=max(date_time, ZIP_EPOCH))
+    info.compress_type = zipfile.ZIP_DEFLATED if compressible_mime(file.mime) else zipfile.ZIP_STORED
+    # Declaring the size up front lets zipfile pick ZIP64 headers for entries over 4 GiB
+    info.file_size = size
+    info.external_attr = 0o644 << 16
+    return info
+
+def _needs_stored_key(file):
+    with open_blob(file.file) as blob:
+        return needs_stored_key(blob)
+
+def iter_zip_archive(files):
+    """
+    Yield a ZIP archive of the plaintext of `files`, built as it is sent: each file is
+    decrypted chunk by chunk straight into its (deflated, unless already compressed)
+    entry, so no file, and not the archive, is ever held whole in memory or on disk.
+    ZIP64 extensions are used where sizes or offsets need them.
+
+    The keys of upcoming files are prefetched concurrently, except for envelope-mode files,
+    whose key is in their header. Files whose blob or key can't be opened are skipped and
+    listed in an ERRORS.txt entry; a blob that fails authentication part way through
+    aborts the archive, which then arrives truncated.
+    """
+    stream = ZipStream()
+    taken, failed = set(), []
+    with zipfile.ZipFile(stream, 'w', allowZip64=True) as archive:
+        entries = prefetch_encryption_keys(((file.id, file) for file in files), needs_key=_needs_stored_key)
+        for file, key in entries:
+            try:
+                decrypted = open_decrypted_file(
+                    file.id, local_path(file.file), file.size, open_blob(file.file), key=key
+                )
+            except Exception as e:
+                logger.warning("Leaving file %s out of an archive: %s", file.id, str(e))
+                failed.append(file)
+                continue
+            name = entry_name(file.filename or '', taken, default=f'file-{file.id}')
+            with archive.open(_entry_info(file, name, decrypted.size), 'w') as entry:
+                for chunk in decrypted:
+                    entry.write(chunk)
+                    data = stream.drain()
+                    if data:
+                        yield data
+            # The entry's data descriptor
+            yield stream.drain()
+
+        if failed:
+            archive.writestr(
+                entry_name(ERRORS_ENTRY, taken),
+                ''.join(f'Could not add {file.filename or file.id} (id {file.id})\n' for file in failed)
+            )
+    yield stream.drain()
@@ -0,0 +1,12 @@
+class ChangeKind:
+    CREATED = 'created'
+    UPDATED = 'updated'
+    DELETED = 'deleted'
+    SHARED = 'shared'
+
+    CHOICES = [
+        (CREATED, 'Created'),
+        (UPDATED, 'Updated'),
+        (DELETED, 'Deleted'),
+        (SHARED, 'Shared')
+    ]
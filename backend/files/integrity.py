@@ -0,0 +1,12 @@
+class IntegrityStatus:
+    OK = 'ok'
+    CORRUPT = 'corrupt'
+    MISSING = 'missing'
+    ERROR = 'error'  # Could not be checked, e.g. its key was unavailable
+
+    CHOICES = [
+        (OK, 'OK'),
+        (CORRUPT, 'Corrupt'),
+        (MISSING, 'Missing'),
+        (ERROR, 'Error')
+    ]
@@ -0,0 +1,25 @@
+import re
+import secrets
+
+# Blobs live at uploads/<2 hex>/<2 hex>/<32 hex opaque id>: 65536 leaf directories keep
+# each listing small, and names never collide or leak the user's filename, which is
+# kept in File.filename only
+BLOB_DIR = 'uploads'
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+
+SHARDED_NAME_RE = re.compile(
+    rf'^{BLOB_DIR}/' + rf'[0-9a-f]{{{SHARD_WIDTH}}}/' * SHARD_LEVELS + r'([0-9a-f]{32})$'
+)
+
+def sharded_name(blob_id):
+    """Storage name of the blob with opaque id `blob_id`"""
+    shards = [blob_id[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_LEVELS)]
+    return '/'.join([BLOB_DIR, *shards, blob_id])
+
+def blob_upload_path(instance, filename):
+    """`upload_to` for File.file: a fresh random id, so the id's prefix is an even hash spread"""
+    return sharded_name(secrets.token_hex(16))
+
+def is_sharded(name):
+    return SHARDED_NAME_RE.match(name) is not None
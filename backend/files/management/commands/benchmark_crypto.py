@@ -0,0 +1,222 @@
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import cryptography
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from common import keystore
+from common.crypto import (
+    CIPHER_NAMES,
+    CIPHERS,
+    available_ciphers,
+    default_cipher,
+    encrypt_stream,
+    generate_encryption_key,
+    open_decrypted_file,
+    store_encryption_key
+)
+
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+PATTERN_SIZE = 1024 * 1024
+
+def parse_size(value):
+    """'64K' -> 65536"""
+    value = value.strip().upper().rstrip('B')
+    unit = value[-1] if value and value[-1] in UNITS else ''
+    try:
+        return int(float(value[:len(value) - len(unit)]) * UNITS[unit])
+    except ValueError:
+        raise CommandError(f"Invalid size: {value}")
+
+def _rss_bytes(maxrss):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def _run_case(plaintext_path, work_dir, chunk_size, threads, cipher, results):
+    """Runs in a forked child so ru_maxrss is the peak of this one case"""
+    baseline_rss = _rss_bytes(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    encrypted_path = os.path.join(work_dir, f'encrypted-{chunk_size}-{threads}-{cipher}')
+
+    with override_settings(
+        KEY_STORE_BACKEND='common.keystore.MemoryKeyStore',
+        FILE_ENCRYPTION_PARALLEL_THRESHOLD=0,
+        FILE_ENCRYPTION_QUEUE_DEPTH=0
+    ):
+        keystore.reset_key_store()
+        key = generate_encryption_key()
+        store_encryption_key('benchmark', key)
+        started = time.perf_counter()
+        with open(plaintext_path, 'rb') as source, open(encrypted_path, 'wb') as destination:
+            size = encrypt_stream(key, source, destination, chunk_size=chunk_size, workers=threads, cipher=cipher)
+        encrypt_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for _ in open_decrypted_file('benchmark', encrypted_path):
+            pass
+        decrypt_seconds = time.perf_counter() - started
+    os.remove(encrypted_path)
+
+    results.put({
+        'size': size,
+        'chunk_size': chunk_size,
+        'threads': threads,
+        'cipher': CIPHERS[cipher][0],
+        'encrypt_seconds': encrypt_seconds,
+        'decrypt_seconds': decrypt_seconds,
+        'encrypt_mb_s': size / 1e6 / encrypt_seconds if encrypt_seconds else None,
+        'decrypt_mb_s': size / 1e6 / decrypt_seconds if decrypt_seconds else None,
+        'peak_rss_bytes': _rss_bytes(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+        'baseline_rss_bytes': baseline_rss,
+    })
+
+def _write_plaintext(path, size):
+    """Fill `path` with `size` bytes without ever holding more than one pattern in memory"""
+    pattern = os.urandom(PATTERN_SIZE)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            part = pattern[:min(remaining, PATTERN_SIZE)]
+            f.write(part)
+            remaining -= len(part)
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark chunked encryption and streaming decryption throughput and peak RSS per cipher "
+        "with an in-memory key store (no Vault), and write the results as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1K,1M,64M,1G,4G', help="Comma separated plaintext sizes")
+        parser.add_argument('--chunk-sizes', default='16K,64K,1M', help="Comma separated chunk sizes")
+        parser.add_argument(
+            '--threads', default=None,
+            help="Comma separated encryption thread counts (default: powers of two up to the CPU count)"
+        )
+        parser.add_argument(
+            '--ciphers', default=None,
+            help="Comma separated ciphers, or 'all' (default: the one new files get on this host)"
+        )
+        parser.add_argument('--repeat', type=int, default=1, help="Runs per case, the fastest is kept")
+        parser.add_argument('--tmp-dir', default=None, help="Where to write the benchmark files")
+        parser.add_argument('--output', default=None, help="JSON file to write (default: stdout)")
+        parser.add_argument('--compare', default=None, help="Earlier JSON results to check for regressions")
+        parser.add_argument(
+            '--tolerance', type=float, default=0.1,
+            help="Allowed throughput drop against --compare before failing (0.1 = 10%%)"
+        )
+
+    def handle(self, *args, **options):
+        sizes = [parse_size(size) for size in options['sizes'].split(',')]
+        chunk_sizes = [parse_size(size) for size in options['chunk_sizes'].split(',')]
+        if options['threads']:
+            threads = [int(count) for count in options['threads'].split(',')]
+        else:
+            cpus = os.cpu_count() or 1
+            threads = sorted({2 ** i for i in range(cpus.bit_length()) if 2 ** i <= cpus} | {cpus})
+        ciphers = self._ciphers(options['ciphers'])
+
+        context = multiprocessing.get_context('fork')
+        work_dir = tempfile.mkdtemp(prefix='crypto-benchmark-', dir=options['tmp_dir'])
+        results = []
+        try:
+            for size in sizes:
+                plaintext_path = os.path.join(work_dir, 'plaintext')
+                _write_plaintext(plaintext_path, size)
+                for chunk_size in chunk_sizes:
+                    for thread_count in threads:
+                        for cipher in ciphers:
+                            runs = [
+                                self._run(context, plaintext_path, work_dir, chunk_size, thread_count, cipher)
+                                for _ in range(max(options['repeat'], 1))
+                            ]
+                            best = min(runs, key=lambda run: run['encrypt_seconds'] + run['decrypt_seconds'])
+                            results.append(best)
+                            self.stderr.write(
+                                f"size={size} chunk={chunk_size} threads={thread_count} cipher={best['cipher']} "
+                                f"encrypt={best['encrypt_mb_s'] or 0:.1f}MB/s "
+                                f"decrypt={best['decrypt_mb_s'] or 0:.1f}MB/s "
+                                f"peak_rss={best['peak_rss_bytes'] // 1024}KiB"
+                            )
+                os.remove(plaintext_path)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        report = {
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'host': {
+                'platform': platform.platform(),
+                'machine': platform.machine(),
+                'cpu_count': os.cpu_count(),
+                'python': platform.python_version(),
+                'cryptography': cryptography.__version__,
+            },
+            'results': results,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+        if options['compare']:
+            self._compare(options['compare'], results, options['tolerance'])
+
+    def _ciphers(self, value):
+        if not value:
+            return [default_cipher()]
+        if value == 'all':
+            return available_ciphers()
+        try:
+            return [CIPHER_NAMES[name.strip()] for name in value.split(',')]
+        except KeyError as e:
+            raise CommandError(f"Unknown cipher: {e.args[0]}")
+
+    def _run(self, context, plaintext_path, work_dir, chunk_size, threads, cipher):
+        results = context.Queue()
+        process = context.Process(
+            target=_run_case, args=(plaintext_path, work_dir, chunk_size, threads, cipher, results)
+        )
+        process.start()
+        while True:
+            try:
+                result = results.get(timeout=1)
+                break
+            except queue.Empty:
+                if not process.is_alive():
+                    raise CommandError(f"Benchmark case failed with exit code {process.exitcode}")
+        process.join()
+        return result
+
+    def _compare(self, path, results, tolerance):
+        with open(path) as f:
+            # Reports from before cipher agility were all AES-256-GCM
+            previous = {
+                (run['size'], run['chunk_size'], run['threads'], run.get('cipher', 'aes-256-gcm')): run
+                for run in json.load(f)['results']
+            }
+        regressions = []
+        for run in results:
+            before = previous.get((run['size'], run['chunk_size'], run['threads'], run['cipher']))
+            if not before:
+                continue
+            for metric in ('encrypt_mb_s', 'decrypt_mb_s'):
+                if before[metric] and run[metric] and run[metric] < before[metric] * (1 - tolerance):
+                    regressions.append(
+                        f"{metric} size={run['size']} chunk={run['chunk_size']} threads={run['threads']} "
+                        f"cipher={run['cipher']}: "
+                        f"{before[metric]:.1f} -> {run[metric]:.1f}"
+                    )
+        if regressions:
+            raise CommandError("Throughput regressions:\n" + "\n".join(regressions))
+        self.stderr.write("No throughput regressions")
@@ -0,0 +1,91 @@
+import json
+import time
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from files.models import File
+from files.serializers import FILE_LIST_FIELDS, FileSerializer, file_list_data
+
+def _serializer_page(files):
+    # The list as it was built before the fast path, owner looked up row by row
+    return FileSerializer(files, many=True).data
+
+def _fast_page(files):
+    return file_list_data(files.values(*FILE_LIST_FIELDS))
+
+PATHS = {'serializer': _serializer_page, 'values': _fast_page}
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the file list response: rows per second and queries per page built through "
+        "FileSerializer versus the values() fast path. Rows are created in a transaction that "
+        "is rolled back, so the database is left as it was."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help="File rows to list")
+        parser.add_argument('--owners', type=int, default=10, help="Distinct owners of those rows")
+        parser.add_argument('--page-size', type=int, default=200, help="Rows per listed page")
+        parser.add_argument('--repeat', type=int, default=3, help="Runs per path, the fastest is kept")
+        parser.add_argument('--output', default=None, help="JSON file to write (default: stdout)")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            owners = self._create_rows(options['rows'], max(options['owners'], 1))
+            results = [
+                self._run(name, build, options['page_size'], max(options['repeat'], 1))
+                for name, build in PATHS.items()
+            ]
+            transaction.set_rollback(True)
+
+        for result in results:
+            self.stderr.write(
+                f"{result['path']}: {result['rows_per_second']:.0f} rows/s, "
+                f"{result['queries_per_page']} queries per page"
+            )
+        output = json.dumps({'rows': options['rows'], 'owners': len(owners), 'results': results}, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+    def _create_rows(self, rows, owner_count):
+        User = get_user_model()
+        owners = [
+            User.objects.create_user(username=f'benchmark-{i}', email=f'benchmark-{i}@example.invalid')
+            for i in range(owner_count)
+        ]
+        File.objects.bulk_create(
+            (
+                File(
+                    owner=owners[i % owner_count], file=f'uploads/benchmark-{i}', filename=f'benchmark-{i}.txt',
+                    size=i, mime='text/plain', digest='0' * 64
+                )
+                for i in range(rows)
+            ),
+            batch_size=1000
+        )
+        return owners
+
+    def _run(self, name, build, page_size, repeat):
+        files = File.objects.filter(filename__startswith='benchmark-').order_by('uploaded_at', 'id')
+        pages = [files[offset:offset + page_size] for offset in range(0, files.count(), page_size)]
+        best = None
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                listed = sum(len(build(page)) for page in pages)
+                seconds = time.perf_counter() - started
+            if best is None or seconds < best[0]:
+                best = (seconds, listed, len(queries))
+        seconds, listed, query_count = best
+        return {
+            'path': name,
+            'rows': listed,
+            'seconds': seconds,
+            'rows_per_second': listed / seconds if seconds else None,
+            'queries_per_page': query_count / max(len(pages), 1),
+        }
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from common.listcache import stats
+
+NAMESPACES = ('files', 'users')
+
+class Command(BaseCommand):
+    help = (
+        "Show hit and miss counts of the cached file and user lists, summed over every worker "
+        "sharing the cache. With the local-memory cache each process counts on its own, so this "
+        "only reports on a shared cache backend."
+    )
+
+    def handle(self, *args, **options):
+        for namespace, counts in stats(NAMESPACES).items():
+            total = counts['hits'] + counts['misses']
+            rate = counts['hits'] / total if total else 0
+            self.stdout.write(f"{namespace}: {counts['hits']} hits, {counts['misses']} misses ({rate:.0%} hit rate)")
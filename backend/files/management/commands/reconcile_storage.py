@@ -0,0 +1,217 @@
+import json
+import os
+import time
+from collections import Counter
+from itertools import islice
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from common.crypto import (
+    EXT_WRAPPED_KEY,
+    ContainerHeader,
+    delete_encryption_key,
+    is_container,
+    is_legacy_blob
+)
+from common.keystore import get_key_store
+from files.layout import BLOB_DIR
+from files.models import File
+from files.storage import blob_path
+
+PHASES = ('blobs', 'rows', 'keys', 'done')
+
+def _scan(storage, root, relative=(), after=()):
+    """
+    Yield the relative path tuple of every blob under `root` in `storage`, depth first in
+    name order, skipping everything up to and including `after`. Only one directory
+    listing is held in memory at a time.
+    """
+    try:
+        directories, files = storage.listdir('/'.join((root,) + relative))
+    except FileNotFoundError:
+        return
+    entries = sorted([(name, True) for name in directories] + [(name, False) for name in files])
+    for name, is_directory in entries:
+        path = relative + (name,)
+        if is_directory:
+            if path >= after[:len(path)]:
+                yield from _scan(storage, root, path, after)
+        elif path > after:
+            yield path
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+class Command(BaseCommand):
+    help = (
+        "Cross-check the stored blobs, File rows and the key store. Reports (and with --fix "
+        "repairs) orphaned blobs, leftover .tmp files and dangling keys. Missing blobs, missing keys and "
+        "unidentified blobs are only reported."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help="Repair what can be repaired safely")
+        parser.add_argument(
+            '--grace', type=float, default=3600,
+            help=(
+                "Seconds a blob or .tmp file must be untouched, or a key must have been seen "
+                "dangling by an earlier pass, before it counts as abandoned"
+            )
+        )
+        parser.add_argument('--batch-size', type=int, default=1000, help="Entries checked per database query")
+        parser.add_argument(
+            '--checkpoint', default=os.path.join(settings.MEDIA_ROOT, '.reconcile_storage.checkpoint'),
+            help="File recording the phase and position reached"
+        )
+        parser.add_argument(
+            '--report', default=os.path.join(settings.MEDIA_ROOT, '.reconcile_storage.jsonl'),
+            help="Findings are appended here as JSON lines"
+        )
+        parser.add_argument('--restart', action='store_true', help="Ignore the checkpoint and start a new pass")
+
+    def handle(self, *args, **options):
+        self.fix = options['fix']
+        self.grace = options['grace']
+        self.batch_size = options['batch_size']
+        self.checkpoint_path = options['checkpoint']
+        self.storage = File.file.field.storage
+        self.key_store = get_key_store()
+
+        previous = self._read_checkpoint()
+        state = None if options['restart'] else previous
+        if state is None or state['phase'] == 'done':
+            state = {
+                'phase': 'blobs', 'cursor': None, 'counts': {}, 'started': time.time(),
+                # Outlives passes, even --restart ones: it is what the grace of keys counts from
+                'dangling_keys': (previous or {}).get('dangling_keys', {})
+            }
+            open(options['report'], 'w').close()
+        else:
+            self.stdout.write(f"Resuming {state['phase']} after {state['cursor']}")
+        self.counts = Counter(state['counts'])
+        self.started = state.get('started', time.time())
+        self.dangling_keys = state.get('dangling_keys', {})
+
+        with open(options['report'], 'a') as self.report:
+            for phase in PHASES[PHASES.index(state['phase']):-1]:
+                getattr(self, f'_reconcile_{phase}')(state['cursor'] if phase == state['phase'] else None)
+                self._write_checkpoint(PHASES[PHASES.index(phase) + 1], None)
+
+        summary = ', '.join(f"{count} {kind}" for kind, count in sorted(self.counts.items())) or "nothing to report"
+        self.stdout.write(self.style.SUCCESS(f"Reconciled: {summary}"))
+
+    def _record(self, kind, fixed=False, **details):
+        self.counts[kind] += 1
+        if fixed:
+            self.counts[f'{kind}_fixed'] += 1
+        self.report.write(json.dumps({'kind': kind, 'fixed': fixed, **details}) + '\n')
+
+    def _abandoned(self, name):
+        return time.time() - self.storage.get_modified_time(name).timestamp() > self.grace
+
+    def _reconcile_blobs(self, cursor):
+        """Temp files and blobs no File row points at"""
+        after = tuple(cursor.split('/')) if cursor else ()
+
+        for batch in _batches(_scan(self.storage, BLOB_DIR, after=after), self.batch_size):
+            names = ['/'.join((BLOB_DIR,) + path) for path in batch]
+            known = set(File.objects.filter(file__in=names).values_list('file', flat=True))
+            for name in names:
+                if name in known:
+                    continue
+                kind = 'temp_file' if name.endswith('.tmp') else 'orphan_blob'
+                try:
+                    size = self.storage.size(name)
+                    # Young files may belong to an upload or encryption still in progress
+                    fixed = self.fix and self._abandoned(name)
+                except FileNotFoundError:
+                    continue  # Gone since the listing, e.g. a finished encryption's .tmp
+                if fixed:
+                    self.storage.delete(name)
+                self._record(kind, fixed, path=name, size=size)
+            self._write_checkpoint('blobs', '/'.join(batch[-1]))
+
+    def _reconcile_rows(self, cursor):
+        """Rows whose blob is gone, whose key is gone, or whose blob is in no format we can read"""
+        # One listing up front instead of a key store round trip per row
+        key_ids = set(self.key_store.list_ids())
+        last_id = cursor or 0
+
+        while True:
+            batch = list(
+                File.objects.filter(id__gt=last_id).order_by('id').values_list('id', 'file')[:self.batch_size]
+            )
+            if not batch:
+                break
+            for file_id, name in batch:
+                try:
+                    with self.storage.open(name, 'rb') as f:
+                        container = is_container(f)
+                        wrapped = container and ContainerHeader.read(f).extension(EXT_WRAPPED_KEY) is not None
+                        legacy = not container and is_legacy_blob(file_id, blob_path(self.storage, name), f)
+                except FileNotFoundError:
+                    self._record('missing_blob', file_id=file_id, path=name)
+                    continue
+
+                if container:
+                    if not wrapped and str(file_id) not in key_ids:
+                        # Unreadable, but a restored key would bring it back: report only
+                        self._record('missing_key', file_id=file_id, path=name)
+                elif not legacy:
+                    # Plaintext, or legacy ciphertext that no longer authenticates (its path
+                    # moved, or its key is gone): never rewritten, encrypting ciphertext as if
+                    # it were plaintext would lose the file for good. Key store outages raise
+                    # rather than land here.
+                    self._record('unidentified_blob', file_id=file_id, path=name)
+            last_id = batch[-1][0]
+            self._write_checkpoint('rows', last_id)
+
+    def _reconcile_keys(self, cursor):
+        """
+        Stored keys whose File row no longer exists.
+
+        Keys are written before their row commits (bulk uploads store them inside the
+        transaction), so one listing can't tell a dangling key from one about to be
+        needed, and the key stores keep no creation time. A key is only deleted once an
+        earlier pass, at least --grace seconds ago, already found it dangling.
+        """
+        key_ids = (key_id for key_id in self.key_store.list_ids() if cursor is None or key_id > cursor)
+        for batch in _batches(key_ids, self.batch_size):
+            numeric = [int(key_id) for key_id in batch if key_id.isdigit()]
+            existing = {str(file_id) for file_id in File.objects.filter(id__in=numeric).values_list('id', flat=True)}
+            now = time.time()
+            for key_id in batch:
+                if key_id in existing:
+                    self.dangling_keys.pop(key_id, None)
+                    continue
+                first_seen = self.dangling_keys.get(key_id, [now])[0]
+                self.dangling_keys[key_id] = [first_seen, now]
+                fixed = self.fix and now - first_seen > self.grace
+                if fixed:
+                    delete_encryption_key(key_id)
+                    del self.dangling_keys[key_id]
+                self._record('dangling_key', fixed, file_id=key_id)
+            self._write_checkpoint('keys', batch[-1])
+        # Forget keys that were deleted some other way since they were first seen
+        self.dangling_keys = {
+            key_id: seen for key_id, seen in self.dangling_keys.items() if seen[1] >= self.started
+        }
+
+    def _read_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_checkpoint(self, phase, cursor):
+        self.report.flush()
+        temp_path = f"{self.checkpoint_path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({
+                'phase': phase, 'cursor': cursor, 'counts': self.counts,
+                'started': self.started, 'dangling_keys': self.dangling_keys
+            }, f)
+        os.replace(temp_path, self.checkpoint_path)
@@ -0,0 +1,152 @@
+import json
+import multiprocessing
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from common.crypto import CryptoError, verify_file
+from common.keystore import KeyStoreError
+from common.listcache import invalidate
+from common.ratelimit import RateLimiter
+from files.integrity import IntegrityStatus
+from files.models import File
+from files.storage import blob_path
+
+# Set in each pool process by _init_worker
+_limiter = None
+
+def _init_worker(rate, niceness):
+    global _limiter
+    if niceness:
+        os.nice(niceness)
+    _limiter = RateLimiter(rate)
+
+def _verify(job):
+    """Returns (file_id, status, blob bytes read, error)"""
+    file_id, name = job
+    storage = File.file.field.storage
+    try:
+        size = storage.size(name)
+        _limiter.consume(size)
+        with storage.open(name, 'rb') as blob:
+            verify_file(file_id, blob_path(storage, name), blob)
+        return file_id, IntegrityStatus.OK, size, None
+    except FileNotFoundError:
+        return file_id, IntegrityStatus.MISSING, 0, "Blob not found"
+    except CryptoError as e:
+        return file_id, IntegrityStatus.CORRUPT, size, str(e)
+    except KeyStoreError:
+        # Not this blob's fault, and it would be every blob's: stop the run
+        raise
+    except Exception as e:
+        return file_id, IntegrityStatus.ERROR, 0, str(e)
+
+class Command(BaseCommand):
+    help = (
+        "Verify the authentication tags of every stored blob on a process pool, record each "
+        "file's integrity status and verification time, and write a summary report."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Verifier processes")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Files verified between database writes")
+        parser.add_argument(
+            '--max-mb-per-second', type=float, default=0,
+            help="Cap on blob bytes read per second across all workers (0 = unlimited)"
+        )
+        parser.add_argument(
+            '--older-than', type=float, default=0,
+            help="Only check files not verified in this many hours (0 = every file)"
+        )
+        parser.add_argument('--nice', type=int, default=10, help="Niceness added to the verifier processes")
+        parser.add_argument('--report', default=None, help="JSON report file to write (default: stdout)")
+
+    def handle(self, *args, **options):
+        workers = max(options['workers'], 1)
+
+        files = File.objects.all()
+        if options['older_than']:
+            cutoff = datetime.now(timezone.utc) - timedelta(hours=options['older_than'])
+            files = files.filter(Q(verified_at__isnull=True) | Q(verified_at__lt=cutoff))
+        total = files.count()
+
+        try:
+            self._scrub(files, total, workers, options)
+        except KeyStoreError as e:
+            raise CommandError(f"The key store can't open stored keys: {e}")
+
+    def _scrub(self, files, total, workers, options):
+        started_at = datetime.now(timezone.utc)
+        started = time.monotonic()
+        counts = Counter()
+        problems = []
+        read_bytes = 0
+        last_id = 0
+
+        # Workers never touch the database (only this process does), so forking is safe
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_worker,
+            initargs=(options['max_mb_per_second'] * 1024 * 1024 / workers, options['nice'])
+        ) as pool:
+            while True:
+                batch = list(
+                    files.filter(id__gt=last_id).order_by('id')
+                    .values_list('id', 'file', 'owner_id')[:options['batch_size']]
+                )
+                if not batch:
+                    break
+                jobs = [(file_id, name) for file_id, name, _ in batch]
+                names = dict(jobs)
+                chunksize = max(1, len(jobs) // (workers * 4))
+                verified_at = datetime.now(timezone.utc)
+                updates = []
+                for file_id, status, size, error in pool.map(_verify, jobs, chunksize=chunksize):
+                    counts[status] += 1
+                    read_bytes += size
+                    if status != IntegrityStatus.OK:
+                        problems.append({'id': file_id, 'path': names[file_id], 'status': status, 'error': error})
+                    # Errors say nothing about the blob, so it stays due for the next run
+                    updates.append(File(
+                        id=file_id,
+                        integrity_status=status,
+                        verified_at=None if status == IntegrityStatus.ERROR else verified_at
+                    ))
+                File.objects.bulk_update(updates, ['integrity_status', 'verified_at'])
+                # bulk_update sends no post_save, and file lists show the integrity status
+                invalidate('files', *{owner_id for _, _, owner_id in batch})
+
+                last_id = batch[-1][0]
+                elapsed = max(time.monotonic() - started, 1e-9)
+                self.stderr.write(
+                    f"{sum(counts.values())}/{total} files: {counts[IntegrityStatus.CORRUPT]} corrupt, "
+                    f"{counts[IntegrityStatus.MISSING]} missing, {counts[IntegrityStatus.ERROR]} errors "
+                    f"({read_bytes / elapsed / 1e6:.1f} MB/s)"
+                )
+
+        elapsed = time.monotonic() - started
+        report = {
+            'started_at': started_at.isoformat(),
+            'finished_at': datetime.now(timezone.utc).isoformat(),
+            'elapsed_seconds': elapsed,
+            'files': sum(counts.values()),
+            'bytes': read_bytes,
+            'mb_per_second': read_bytes / 1e6 / elapsed if elapsed else None,
+            'statuses': {status: counts[status] for status, _ in IntegrityStatus.CHOICES},
+            'problems': problems,
+        }
+        output = json.dumps(report, indent=2)
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+        damaged = counts[IntegrityStatus.CORRUPT] + counts[IntegrityStatus.MISSING]
+        if damaged:
+            raise CommandError(f"{damaged} blobs are corrupt or missing")
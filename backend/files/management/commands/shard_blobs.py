@@ -0,0 +1,116 @@
+import os
+import shutil
+import time
+from collections import Counter, deque
+from django.core.files import File as DjangoFile
+from django.core.management.base import BaseCommand
+
+from common.crypto import is_container
+from common.listcache import invalidate
+from common.ratelimit import RateLimiter
+from files.layout import blob_upload_path, is_sharded
+from files.models import File
+from files.storage import blob_path
+
+class Command(BaseCommand):
+    help = (
+        "Move blobs from the flat uploads/ directory into the hash-sharded layout, online: "
+        "each blob is linked at its new name, the row is switched over, and the old name is "
+        "removed once in-flight downloads have had time to open it. Safe to interrupt and rerun; "
+        "an old name left behind by a crash shows up as an orphan in reconcile_storage."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="File rows read per query")
+        parser.add_argument(
+            '--max-files-per-second', type=float, default=0, help="Throttle for busy hosts (0 = unlimited)"
+        )
+        parser.add_argument(
+            '--unlink-delay', type=float, default=5,
+            help="Seconds an old name is kept after its row moved, for requests that already read the row"
+        )
+
+    def handle(self, *args, **options):
+        storage = File.file.field.storage
+        limiter = RateLimiter(options['max_files_per_second'])
+        counts = Counter()
+        retired = deque()  # (moved_at, old name)
+        last_id = 0
+
+        while True:
+            batch = list(
+                File.objects.filter(id__gt=last_id).order_by('id')
+                .values_list('id', 'file', 'owner_id')[:options['batch_size']]
+            )
+            if not batch:
+                break
+            moved_owners = set()
+            for file_id, name, owner_id in batch:
+                if is_sharded(name):
+                    counts['sharded'] += 1
+                    continue
+                limiter.consume(1)
+                outcome, old_name = self._move(storage, file_id, name)
+                counts[outcome] += 1
+                if old_name:
+                    retired.append((time.monotonic(), old_name))
+                    moved_owners.add(owner_id)
+            if moved_owners:
+                # update() sends no post_save, and file lists show the blob name
+                invalidate('files', *moved_owners)
+            last_id = batch[-1][0]
+            self._unlink_retired(storage, retired, options['unlink_delay'])
+            self.stdout.write(
+                f"Up to file {last_id}: {counts['moved']} moved, {counts['sharded']} already sharded, "
+                f"{counts['legacy']} legacy, {counts['missing']} missing, {counts['changed']} changed meanwhile"
+            )
+
+        if retired:
+            time.sleep(max(0, retired[-1][0] + options['unlink_delay'] - time.monotonic()))
+            self._unlink_retired(storage, retired, 0)
+
+        if counts['legacy']:
+            self.stdout.write(self.style.WARNING(
+                f"{counts['legacy']} legacy blobs use their path as AAD and were left in place; "
+                "run migrate_legacy_blobs, then this command again"
+            ))
+        self.stdout.write(self.style.SUCCESS(f"Moved {counts['moved']} blobs"))
+
+    def _move(self, storage, file_id, name):
+        """Returns (outcome, old name to delete later or None)"""
+        try:
+            with storage.open(name, 'rb') as f:
+                if not is_container(f):
+                    return 'legacy', None
+        except FileNotFoundError:
+            return 'missing', None
+
+        new_name = blob_upload_path(None, os.path.basename(name))
+        self._copy(storage, name, new_name)
+
+        # Only switch rows nobody changed since the batch was read
+        if not File.objects.filter(id=file_id, file=name).update(file=new_name):
+            storage.delete(new_name)
+            return 'changed', None
+        return 'moved', name
+
+    def _copy(self, storage, name, new_name):
+        old_path, new_path = blob_path(storage, name), blob_path(storage, new_name)
+        if old_path is None:
+            # Object storage: stream it across, never holding the whole blob
+            with storage.open(name, 'rb') as source:
+                storage.save(new_name, DjangoFile(source))
+            return
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        try:
+            os.link(old_path, new_path)
+        except OSError:
+            # No hard links on this filesystem; a copy costs I/O but is just as safe
+            shutil.copy2(old_path, new_path)
+
+    def _unlink_retired(self, storage, retired, delay):
+        now = time.monotonic()
+        while retired and now - retired[0][0] >= delay:
+            _, name = retired.popleft()
+            # Deleting a blob that is already gone is not an error
+            storage.delete(name)
@@ -3,15 +3,42 @@ from django.conf import settings
 
 import secrets
 
+from files.changes import ChangeKind
+from files.integrity import IntegrityStatus
+from files.layout import blob_upload_path
+
 class File(models.Model):
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    file = models.FileField(upload_to='uploads/')
+    file = models.FileField(upload_to=blob_upload_path)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     filename = models.CharField(max_length=255, null=True)
     size = models.PositiveIntegerField(null=True)
     mime = models.CharField(max_length=50, null=True)
+    digest = models.CharField(max_length=64, null=True)  # SHA-256 of the plaintext
+    integrity_status = models.CharField(max_length=16, choices=IntegrityStatus.CHOICES, null=True)
+    verified_at = models.DateTimeField(null=True, db_index=True)  # last scrub_blobs check
+
+    class Meta:
+        # Keyset pagination of the file list (files.pagination), per owner and for admins
+        indexes = [
+            models.Index(fields=['owner', 'uploaded_at', 'id']),
+            models.Index(fields=['uploaded_at', 'id']),
+        ]
 
 class SharedFile(models.Model):
     file = models.ForeignKey(File, on_delete=models.CASCADE)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='shared_files')
-    share_hash = models.CharField(max_length=64, unique=True, default=secrets.token_urlsafe)
\ No newline at end of file
+    share_hash = models.CharField(max_length=64, unique=True, default=secrets.token_urlsafe)
+
+class FileChange(models.Model):
+    """
+    Append-only log behind the change feed; its id is the feed's sequence number. Written
+    by files.signals, and kept for deleted files, so `file_id` is not a foreign key.
+    """
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    file_id = models.BigIntegerField()
+    kind = models.CharField(max_length=16, choices=ChangeKind.CHOICES)
+    changed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['owner', 'id'])]
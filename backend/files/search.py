@@ -0,0 +1,151 @@
+import logging
+import re
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+from files.models import File
+
+logger = logging.getLogger(__name__)
+
+FTS5 = 'fts5'
+TRIGRAM = 'trigram'
+
+# Trigram indexes can only narrow down terms of at least three characters
+MIN_TERM_LENGTH = 3
+
+_backends = {}
+
+def _search_table():
+    return f'{File._meta.db_table}_search'
+
+def _install_sqlite(cursor):
+    table, search = File._meta.db_table, _search_table()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [search])
+    exists = cursor.fetchone() is not None
+    # External content table: filenames are not stored twice, only the trigram index is.
+    # The trigram tokenizer matches any substring, the way users expect a filename search to.
+    cursor.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {search} USING fts5("
+        f"filename, content='{table}', content_rowid='id', tokenize='trigram')"
+    )
+    # Triggers rather than model signals, so bulk_create, update() and queryset deletes are covered
+    cursor.execute(
+        f"CREATE TRIGGER IF NOT EXISTS {search}_insert AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {search}(rowid, filename) VALUES (new.id, new.filename); END"
+    )
+    cursor.execute(
+        f"CREATE TRIGGER IF NOT EXISTS {search}_delete AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {search}({search}, rowid, filename) VALUES ('delete', old.id, old.filename); END"
+    )
+    cursor.execute(
+        f"CREATE TRIGGER IF NOT EXISTS {search}_rename AFTER UPDATE OF filename ON {table} BEGIN "
+        f"INSERT INTO {search}({search}, rowid, filename) VALUES ('delete', old.id, old.filename); "
+        f"INSERT INTO {search}(rowid, filename) VALUES (new.id, new.filename); END"
+    )
+    if not exists:
+        # Index the files uploaded before search existed
+        cursor.execute(f"INSERT INTO {search}({search}) VALUES ('rebuild')")
+
+def _install_postgresql(cursor):
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    cursor.execute(
+        f"CREATE INDEX IF NOT EXISTS {_search_table()}_trgm "
+        f"ON {File._meta.db_table} USING gin (filename gin_trgm_ops)"
+    )
+
+def install_search_index(using=DEFAULT_DB_ALIAS):
+    """
+    Create the filename index for the database engine in use: an FTS5 trigram table kept in
+    sync by triggers on SQLite, a pg_trgm GIN index on PostgreSQL. Idempotent; run after
+    every migrate. Other engines, or a database that lacks the extension, fall back to an
+    unindexed substring scan.
+    """
+    connection = connections[using]
+    installers = {'sqlite': (FTS5, _install_sqlite), 'postgresql': (TRIGRAM, _install_postgresql)}
+    if connection.vendor not in installers:
+        _backends[using] = None
+        return None
+    backend, install = installers[connection.vendor]
+    try:
+        with connection.cursor() as cursor:
+            install(cursor)
+    except DatabaseError as e:
+        logger.warning("Filename search index unavailable, falling back to substring scans: %s", str(e))
+        backend = None
+    _backends[using] = backend
+    return backend
+
+def search_backend(using=DEFAULT_DB_ALIAS):
+    if using not in _backends:
+        connection = connections[using]
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s", [_search_table()])
+                _backends[using] = FTS5 if cursor.fetchone() else None
+            elif connection.vendor == 'postgresql':
+                cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+                _backends[using] = TRIGRAM if cursor.fetchone() else None
+            else:
+                _backends[using] = None
+    return _backends[using]
+
+def _like_pattern(term):
+    return '%' + re.sub(r'([\\%_])', r'\\\1', term) + '%'
+
+def _fts5_ids(cursor, terms, owner_id, limit, offset):
+    table, search = File._meta.db_table, _search_table()
+    indexed = [term for term in terms if len(term) >= MIN_TERM_LENGTH]
+    # Each term quoted so that FTS5 syntax in a filename is taken literally; terms too
+    # short for a trigram only filter the rows the index found
+    match = ' '.join('"{}"'.format(term.replace('"', '""')) for term in indexed)
+    conditions, params = [f"{search} MATCH %s"], [match]
+    for term in terms:
+        if len(term) < MIN_TERM_LENGTH:
+            conditions.append(f"{table}.filename LIKE %s ESCAPE '\\'")
+            params.append(_like_pattern(term))
+    if owner_id is not None:
+        conditions.append(f"{table}.owner_id = %s")
+        params.append(owner_id)
+    cursor.execute(
+        f"SELECT {search}.rowid FROM {search} JOIN {table} ON {table}.id = {search}.rowid "
+        f"WHERE {' AND '.join(conditions)} "
+        f"ORDER BY {search}.rank, {search}.rowid LIMIT %s OFFSET %s",
+        params + [limit, offset]
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+def _trigram_ids(cursor, terms, owner_id, limit, offset):
+    table = File._meta.db_table
+    query = ' '.join(terms)
+    substrings = ' AND '.join(["filename ILIKE %s"] * len(terms))
+    owner_clause = "AND owner_id = %s" if owner_id is not None else ''
+    # ILIKE finds exact substrings, <% near misses; both are served by the GIN index
+    cursor.execute(
+        f"SELECT id FROM {table} "
+        f"WHERE (({substrings}) OR %s <%% filename) {owner_clause} "
+        f"ORDER BY word_similarity(%s, filename) DESC, id LIMIT %s OFFSET %s",
+        [_like_pattern(term) for term in terms] + [query] + ([owner_id] if owner_id is not None else [])
+        + [query, limit, offset]
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+def search_file_ids(query, owner_id=None, limit=50, offset=0, using=DEFAULT_DB_ALIAS):
+    """
+    Ids of the files whose filename matches `query`, best match first. Every whitespace
+    separated term must occur in the filename, case-insensitively; PostgreSQL also returns
+    near misses, ranked below. `owner_id` limits the search to one user's files.
+    """
+    terms = query.split()
+    if not terms:
+        return []
+    backend = search_backend(using)
+    if backend == TRIGRAM or (backend == FTS5 and any(len(term) >= MIN_TERM_LENGTH for term in terms)):
+        with connections[using].cursor() as cursor:
+            search = _fts5_ids if backend == FTS5 else _trigram_ids
+            return search(cursor, terms, owner_id, limit, offset)
+
+    files = File.objects.using(using).all()
+    if owner_id is not None:
+        files = files.filter(owner_id=owner_id)
+    for term in terms:
+        files = files.filter(filename__icontains=term)
+    return list(files.order_by('id').values_list('id', flat=True)[offset:offset + limit])
@@ -1,6 +1,64 @@
+import hashlib
 import secrets
 from rest_framework import serializers
+from common.crypto import store_encryption_key, encrypt_file
 from .models import File, SharedFile
+from .uploadhandlers import EncryptedUploadedFile
+
+# Columns of the file list, read in one query joined to the owner
+FILE_LIST_FIELDS = (
+    'id', 'file', 'uploaded_at', 'filename', 'size', 'digest', 'integrity_status', 'verified_at', 'mime',
+    'owner__username'
+)
+
+_datetime_field = serializers.DateTimeField()
+
+def mime_subtype(mime):
+    """'image/png' -> 'png'; None when the type is unknown or malformed"""
+    if not mime or '/' not in mime:
+        return None
+    return mime.split('/', 1)[1]
+
+def _blob_url(storage, name):
+    if not name:
+        return None
+    try:
+        return storage.url(name)
+    except NotImplementedError:
+        # Remote blobs have no URL; they are only served decrypted through the API
+        return None
+
+def file_list_data(rows):
+    """
+    FileSerializer's representation of File rows fetched as `values(*FILE_LIST_FIELDS)`.
+
+    The list endpoint builds its response here rather than through the ModelSerializer,
+    whose per-row field binding and to_representation cost more than the query itself
+    on long listings.
+    """
+    storage = File.file.field.storage
+    datetime_representation = _datetime_field.to_representation
+    return [
+        {
+            'id': row['id'],
+            'file': _blob_url(storage, row['file']),
+            'uploaded_at': datetime_representation(row['uploaded_at']),
+            'filename': row['filename'],
+            'size': row['size'],
+            'digest': row['digest'],
+            'integrity_status': row['integrity_status'],
+            'verified_at': datetime_representation(row['verified_at']) if row['verified_at'] else None,
+            'type': mime_subtype(row['mime']),
+            'owner': row['owner__username'],
+        }
+        for row in rows
+    ]
+
+def _plaintext_digest(file):
+    hasher = hashlib.sha256()
+    for chunk in file.chunks():
+        hasher.update(chunk)
+    return hasher.hexdigest()
 
 class FileSerializer(serializers.ModelSerializer):
     owner = serializers.HiddenField(default=serializers.CurrentUserDefault())
@@ -8,18 +66,38 @@ class FileSerializer(serializers.ModelSerializer):
     class Meta:
         model = File
         fields = '__all__'
+        read_only_fields = ['digest', 'integrity_status', 'verified_at']
 
     def create(self, validated_data):
         file = validated_data.get('file')
         validated_data['filename'] = file.name
         validated_data['size'] = file.size
         validated_data['mime'] = file.content_type
+        if isinstance(file, EncryptedUploadedFile):
+            validated_data['digest'] = file.digest
+        else:
+            validated_data['digest'] = _plaintext_digest(file)
 
-        return super().create(validated_data)
+        instance = super().create(validated_data)
+        if not isinstance(file, EncryptedUploadedFile):
+            # Plaintext upload (no EncryptingUploadHandler installed): encrypt in place
+            encrypt_file(instance.id, instance.file.path, instance.mime)
+            return instance
+        if file.key_in_header:
+            return instance
+
+        try:
+            store_encryption_key(instance.id, file.encryption_key)
+        except Exception:
+            # Without its key the blob is unreadable, don't keep a row pointing at it
+            instance.file.delete(save=False)
+            instance.delete()
+            raise
+        return instance
 
     def to_representation(self, instance):
         representation = super().to_representation(instance)
-        representation['type'] = representation.pop('mime').split('/')[1]
+        representation['type'] = mime_subtype(representation.pop('mime'))
         representation['owner'] = instance.owner.username
         return representation
     
@@ -0,0 +1,35 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from common.listcache import invalidate
+from files.changes import ChangeKind
+from files.models import File, FileChange, SharedFile
+
+@receiver(post_save, sender=File)
+def record_file_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    FileChange.objects.create(
+        owner_id=instance.owner_id, file_id=instance.id, kind=ChangeKind.CREATED if created else ChangeKind.UPDATED
+    )
+    invalidate('files', instance.owner_id)
+
+@receiver(post_delete, sender=File)
+def record_file_deleted(sender, instance, **kwargs):
+    FileChange.objects.create(owner_id=instance.owner_id, file_id=instance.id, kind=ChangeKind.DELETED)
+    invalidate('files', instance.owner_id)
+
+@receiver(post_save, sender=SharedFile)
+def record_file_shared(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        FileChange.objects.create(owner_id=instance.file.owner_id, file_id=instance.file_id, kind=ChangeKind.SHARED)
+    invalidate('files', instance.file.owner_id)
+
+@receiver(post_delete, sender=SharedFile)
+def record_share_deleted(sender, instance, **kwargs):
+    # Deleted along with its file the File row may be gone already; the file's own
+    # post_delete invalidates its owner's lists then
+    owner_id = File.objects.filter(id=instance.file_id).values_list('owner_id', flat=True).first()
+    invalidate('files', *([owner_id] if owner_id is not None else []))
@@ -0,0 +1,305 @@
+import io
+import os
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import Storage
+from django.utils.deconstruct import deconstructible
+
+try:
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:  # Optional: only needed with FILE_STORAGE_BACKEND=files.storage.S3Storage
+    boto3 = None
+
+# S3 refuses multipart parts under 5 MiB, except the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+def local_path(field_file):
+    """Local filesystem path of a stored blob, or None when its storage is remote"""
+    try:
+        return field_file.path
+    except NotImplementedError:
+        return None
+
+def blob_path(storage, name):
+    """local_path() for a blob known only by its `name` in `storage`"""
+    try:
+        return storage.path(name)
+    except NotImplementedError:
+        return None
+
+def _not_found(error):
+    return error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound')
+
+def open_blob(field_file):
+    """Open a stored blob for reading; seekable whichever storage it lives in"""
+    return field_file.storage.open(field_file.name, 'rb')
+
+class S3MultipartWriter(io.RawIOBase):
+    """
+    Write-only stream into one S3 object. Bytes are sent as multipart upload parts of
+    `part_size` as soon as a part is full, so at most one part is held in memory; objects
+    smaller than one part are sent with a single PUT.
+
+    The object only appears on close(); leaving a `with` block on an exception aborts the
+    upload instead.
+    """
+
+    def __init__(self, client, bucket, key, part_size):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed S3 upload")
+        self._buffer += data
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def _upload_part(self, body):
+        if self._upload_id is None:
+            self._upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        number = len(self._parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id, PartNumber=number, Body=body
+        )
+        self._parts.append({'ETag': response['ETag'], 'PartNumber': number})
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._upload_part(bytes(self._buffer))
+                self.client.complete_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                    MultipartUpload={'Parts': self._parts}
+                )
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+        super().close()
+
+    def abort(self):
+        """Drop the upload and every part sent so far"""
+        if self._upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            self._upload_id = None
+        self._buffer = bytearray()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def __del__(self):
+        # IOBase would close() and so publish a half-written object; drop it instead
+        if not self.closed:
+            try:
+                self.abort()
+            except Exception:
+                pass
+
+class S3RangeReader(io.RawIOBase):
+    """
+    Seekable read-only view of an S3 object. Reads are served from ranged GETs of up to
+    `window` bytes that are consumed as they stream in, so sequential reads cost one
+    request per window and a seek only fetches from where it lands.
+    """
+
+    def __init__(self, client, bucket, key, window, size=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.window = window
+        self._size = size
+        self._position = 0
+        self._body = None
+        self._body_end = 0  # offset just past the current GET's range
+
+    @property
+    def size(self):
+        if self._size is None:
+            try:
+                self._size = self.client.head_object(Bucket=self.bucket, Key=self.key)['ContentLength']
+            except ClientError as e:
+                if _not_found(e):
+                    raise FileNotFoundError(f"No S3 object {self.key}") from e
+                raise
+        return self._size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError("Negative seek position")
+        if position != self._position:
+            self._close_body()
+            self._position = position
+        return position
+
+    def read(self, size=-1):
+        remaining = self.size - self._position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        parts = []
+        while size > 0:
+            if self._body is None:
+                self._body_end = min(self.size, self._position + max(size, self.window))
+                self._body = self.client.get_object(
+                    Bucket=self.bucket, Key=self.key, Range=f'bytes={self._position}-{self._body_end - 1}'
+                )['Body']
+            data = self._body.read(min(size, self._body_end - self._position))
+            if not data:
+                raise IOError(f"S3 object {self.key} ended early at byte {self._position}")
+            parts.append(data)
+            self._position += len(data)
+            size -= len(data)
+            if self._position >= self._body_end:
+                self._close_body()
+        return b''.join(parts)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def _close_body(self):
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+
+    def close(self):
+        self._close_body()
+        super().close()
+
+@deconstructible
+class S3Storage(Storage):
+    """
+    Blobs in an S3-compatible bucket (AWS, MinIO, Ceph, ...), configured with the S3_*
+    settings. Needs boto3.
+
+    Writes are streamed as multipart uploads and reads as ranged GETs, so no blob is ever
+    held in memory as a whole. Blobs have no local path: callers must use open().
+    """
+
+    def __init__(self, bucket=None, endpoint_url=None, region=None, access_key=None, secret_key=None,
+                 part_size=None):
+        if boto3 is None:
+            raise ImproperlyConfigured("S3Storage requires boto3")
+        self.bucket = bucket or settings.S3_BUCKET
+        self.endpoint_url = endpoint_url or settings.S3_ENDPOINT_URL or None
+        self.region = region or settings.S3_REGION or None
+        self.access_key = access_key or settings.S3_ACCESS_KEY_ID or None
+        self.secret_key = secret_key or settings.S3_SECRET_ACCESS_KEY or None
+        self.part_size = part_size or settings.S3_PART_SIZE
+        self._client = None
+        self._client_pid = None
+
+    @property
+    def client(self):
+        # boto3 clients are thread-safe but not fork-safe (the maintenance commands fork
+        # workers); one per storage and process keeps a pool of keep-alive connections
+        if self._client_pid != os.getpid():
+            self._client = boto3.client(
+                's3',
+                endpoint_url=self.endpoint_url,
+                region_name=self.region,
+                aws_access_key_id=self.access_key,
+                aws_secret_access_key=self.secret_key,
+                config=Config(max_pool_connections=settings.S3_POOL_SIZE, retries={'mode': 'standard'})
+            )
+            self._client_pid = os.getpid()
+        return self._client
+
+    def _open(self, name, mode='rb'):
+        if 'w' in mode:
+            return S3MultipartWriter(self.client, self.bucket, name, self.part_size)
+        if mode not in ('r', 'rb'):
+            raise ValueError(f"Unsupported mode for S3 blobs: {mode}")
+        return S3RangeReader(self.client, self.bucket, name, self.part_size)
+
+    def _save(self, name, content):
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        with S3MultipartWriter(self.client, self.bucket, name, self.part_size) as writer:
+            for chunk in content.chunks(self.part_size):
+                writer.write(chunk)
+        return name
+
+    def get_available_name(self, name, max_length=None):
+        # Blob names are random ids (files.layout), so the existence check per save that
+        # Storage does to dodge collisions would be a wasted round trip
+        return name
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=name)
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=name)
+        except ClientError as e:
+            if _not_found(e):
+                return False
+            raise
+        return True
+
+    def _head(self, name):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=name)
+        except ClientError as e:
+            if _not_found(e):
+                raise FileNotFoundError(f"No S3 object {name}") from e
+            raise
+
+    def size(self, name):
+        return self._head(name)['ContentLength']
+
+    def get_modified_time(self, name):
+        return self._head(name)['LastModified']
+
+    def listdir(self, path):
+        prefix = f"{path.rstrip('/')}/" if path else ''
+        directories, files = [], []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter='/'):
+            directories += [entry['Prefix'][len(prefix):].rstrip('/') for entry in page.get('CommonPrefixes', [])]
+            files += [entry['Key'][len(prefix):] for entry in page.get('Contents', [])]
+        return directories, files
+
+    def url(self, name):
+        # Blobs are ciphertext, only ever served decrypted through the API
+        raise NotImplementedError("S3 blobs have no public URL")
@@ -0,0 +1,191 @@
+import re
+import secrets
+from http import HTTPStatus
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date
+
+from common.apiresponse import ApiResponse
+from common.crypto import open_decrypted_file
+from .storage import local_path, open_blob
+
+RANGE_HEADER_RE = re.compile(r'^bytes=\s*(.+)$')
+RANGE_SPEC_RE = re.compile(r'^(\d*)-(\d*)$')
+MAX_RANGES = 16
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+def parse_range_header(header, size):
+    """
+    Parse a `Range: bytes=...` header against a body of `size` bytes.
+
+    Returns a list of half-open (start, stop) pairs, or None when the header is absent or
+    malformed and the whole body should be sent. Raises RangeNotSatisfiable when no
+    requested range overlaps the body.
+    """
+    if not header:
+        return None
+    match = RANGE_HEADER_RE.match(header.strip())
+    if not match:
+        return None
+
+    specs = [spec.strip() for spec in match.group(1).split(',')]
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        spec_match = RANGE_SPEC_RE.match(spec)
+        if not spec_match:
+            return None
+        first, last = spec_match.groups()
+        if not first and not last:
+            return None
+        if not first:
+            # Suffix range: the final `last` bytes
+            length = int(last)
+            if length == 0:
+                continue
+            ranges.append((max(size - length, 0), size))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start >= size:
+            continue
+        stop = min(int(last) + 1, size) if last else size
+        ranges.append((start, stop))
+
+    if not ranges:
+        raise RangeNotSatisfiable()
+    return ranges
+
+class ClosingIterator:
+    """Iterable that lets StreamingHttpResponse close the underlying file when it is done"""
+
+    def __init__(self, iterable, close):
+        self._iterable = iterable
+        self.close = close
+
+    def __iter__(self):
+        return iter(self._iterable)
+
+def _multipart_byteranges(decrypted, ranges, boundary, content_type):
+    """Yield a multipart/byteranges body, decrypting each part on demand"""
+    for start, stop in ranges:
+        yield _part_header(boundary, content_type, start, stop, decrypted.size)
+        yield from decrypted.iter_range(start, stop)
+        yield b'\r\n'
+    yield f'--{boundary}--\r\n'.encode()
+
+def _part_header(boundary, content_type, start, stop, size):
+    return (
+        f'--{boundary}\r\n'
+        f'Content-Type: {content_type}\r\n'
+        f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n'
+    ).encode()
+
+def file_validators(file):
+    """
+    (ETag, Last-Modified timestamp) of a file's plaintext. The ETag is strong, the plaintext
+    SHA-256, for files with a digest; files stored before digests were kept get a weak one,
+    which is still safe since a file's content never changes after upload.
+    """
+    if file.digest:
+        etag = f'"{file.digest}"'
+    else:
+        etag = f'W/"{file.id}-{file.size}-{int(file.uploaded_at.timestamp())}"'
+    return etag, int(file.uploaded_at.timestamp())
+
+def _set_validators(response, file):
+    etag, last_modified = file_validators(file)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    # Per-user content: browsers may keep it, but must revalidate and proxies must not share it
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+def conditional_file_response(request, file):
+    """
+    The 304 Not Modified (or 412 Precondition Failed) answer to a conditional request for
+    `file`, or None when the body has to be sent. Only needs the File row: call it before
+    anything reaches for the key store or the blob.
+    """
+    etag, last_modified = file_validators(file)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        _set_validators(response, file)
+    return response
+
+def _if_range_matches(request, file):
+    """Whether a Range request may be served: If-Range absent, or naming this exact content"""
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    etag, last_modified = file_validators(file)
+    if if_range.startswith(('"', 'W/')):
+        # Weak validators never satisfy If-Range
+        return not etag.startswith('W/') and if_range == etag
+    return if_range == http_date(last_modified)
+
+def encrypted_file_response(request, file):
+    """
+    Stream the plaintext of `file` to the client, decrypting one chunk at a time.
+
+    Honors `Range` requests by decrypting only the chunks that cover the requested bytes
+    (compressed files are decrypted up to the end of the range instead), unless an
+    `If-Range` validator no longer matches. Sends ETag and Last-Modified; conditional
+    requests are answered beforehand by conditional_file_response().
+    The stored blob is only ever read, from whichever storage holds it, so concurrent
+    downloads of the same file are safe and nothing is written to disk.
+    """
+    decrypted = open_decrypted_file(file.id, local_path(file.file), file.size, open_blob(file.file))
+    content_type = file.mime or 'application/octet-stream'
+
+    try:
+        range_header = request.headers.get('Range') if _if_range_matches(request, file) else None
+        ranges = parse_range_header(range_header, decrypted.size)
+    except RangeNotSatisfiable:
+        decrypted.close()
+        response = ApiResponse(
+            success=False,
+            message='Requested range not satisfiable',
+            status_code=HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+        )
+        response['Content-Range'] = f'bytes */{decrypted.size}'
+        return response
+
+    if ranges is None:
+        response = StreamingHttpResponse(decrypted, content_type=content_type)
+        response['Content-Length'] = str(decrypted.size)
+    elif len(ranges) == 1:
+        start, stop = ranges[0]
+        response = StreamingHttpResponse(
+            ClosingIterator(decrypted.iter_range(start, stop), decrypted.close),
+            content_type=content_type,
+            status=HTTPStatus.PARTIAL_CONTENT
+        )
+        response['Content-Length'] = str(stop - start)
+        response['Content-Range'] = f'bytes {start}-{stop - 1}/{decrypted.size}'
+    else:
+        boundary = secrets.token_hex(16)
+        length = sum(
+            len(_part_header(boundary, content_type, start, stop, decrypted.size)) + (stop - start) + 2
+            for start, stop in ranges
+        ) + len(f'--{boundary}--\r\n')
+        response = StreamingHttpResponse(
+            ClosingIterator(
+                _multipart_byteranges(decrypted, ranges, boundary, content_type),
+                decrypted.close
+            ),
+            content_type=f'multipart/byteranges; boundary={boundary}',
+            status=HTTPStatus.PARTIAL_CONTENT
+        )
+        response['Content-Length'] = str(length)
+
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = content_disposition_header(
+        True, file.filename or file.file.name
+    )
+    return _set_validators(response, file)
@@ -0,0 +1,464 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+from io import StringIO
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+from common import keystore
+from common.crypto import encrypt_file, generate_encryption_key, store_encryption_key, is_container, open_decrypted_file
+from files.integrity import IntegrityStatus
+from files.layout import is_sharded
+from files.models import File
+
+User = get_user_model()
+
+class BenchmarkCryptoCommandTests(TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.test_dir, 'results.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def run_benchmark(self, **options):
+        options.setdefault('threads', '1,2')
+        call_command(
+            'benchmark_crypto',
+            sizes='1K,100K',
+            chunk_sizes='16K',
+            tmp_dir=self.test_dir,
+            output=self.output,
+            stderr=StringIO(),
+            **options
+        )
+        with open(self.output) as f:
+            return json.load(f)
+
+    def test_writes_json_results(self):
+        report = self.run_benchmark()
+        self.assertIn('cpu_count', report['host'])
+        self.assertEqual(
+            [(run['size'], run['threads']) for run in report['results']],
+            [(1024, 1), (1024, 2), (102400, 1), (102400, 2)]
+        )
+        for run in report['results']:
+            self.assertGreater(run['encrypt_mb_s'], 0)
+            self.assertGreater(run['decrypt_mb_s'], 0)
+            self.assertGreater(run['peak_rss_bytes'], 0)
+
+    def test_benchmarks_each_cipher(self):
+        report = self.run_benchmark(ciphers='aes-256-gcm,chacha20-poly1305', threads='1')
+        self.assertEqual(
+            [run['cipher'] for run in report['results']],
+            ['aes-256-gcm', 'chacha20-poly1305'] * 2
+        )
+
+    def test_compare_flags_regressions(self):
+        report = self.run_benchmark()
+        for run in report['results']:
+            run['encrypt_mb_s'] *= 1000
+        baseline = os.path.join(self.test_dir, 'baseline.json')
+        with open(baseline, 'w') as f:
+            json.dump(report, f)
+
+        with self.assertRaises(CommandError):
+            self.run_benchmark(compare=baseline)
+
+class BenchmarkFileListCommandTests(TestCase):
+    def test_reports_rows_per_second_and_rolls_back(self):
+        stdout = StringIO()
+        call_command('benchmark_file_list', rows=30, owners=3, page_size=10, repeat=1, stdout=stdout, stderr=StringIO())
+        report = json.loads(stdout.getvalue())
+
+        results = {result['path']: result for result in report['results']}
+        self.assertEqual(results['values']['rows'], 30)
+        self.assertGreater(results['values']['rows_per_second'], 0)
+        self.assertEqual(results['values']['queries_per_page'], 1)
+        self.assertGreater(results['serializer']['queries_per_page'], 1)
+        self.assertFalse(File.objects.exists())
+        self.assertFalse(User.objects.exists())
+
+class ListCacheStatsCommandTests(TestCase):
+    def test_reports_hit_rate(self):
+        cache.clear()
+        cache.set('listcache:files:hits', 3)
+        cache.set('listcache:files:misses', 1)
+        out = StringIO()
+        call_command('list_cache_stats', stdout=out)
+        self.assertIn('files: 3 hits, 1 misses (75% hit rate)', out.getvalue())
+        self.assertIn('users: 0 hits, 0 misses', out.getvalue())
+
+@override_settings(KEY_STORE_BACKEND='common.keystore.MemoryKeyStore')
+class MigrateLegacyBlobsCommandTests(TestCase):
+    def setUp(self):
+        keystore.reset_key_store()
+        self.addCleanup(keystore.reset_key_store)
+        self.test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_dir)
+        self.checkpoint = os.path.join(self.test_dir, 'checkpoint')
+        # Blobs go under the test directory, not the real MEDIA_ROOT
+        media_override = override_settings(MEDIA_ROOT=self.test_dir)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+
+    def create_legacy_file(self, content):
+        file = File.objects.create(
+            owner=self.user,
+            file=SimpleUploadedFile("legacy.txt", b"placeholder"),
+            filename='legacy.txt',
+            size=len(content)
+        )
+        key = generate_encryption_key()
+        store_encryption_key(file.id, key)
+        nonce = os.urandom(12)
+        with open(file.file.path, 'wb') as f:
+            f.write(nonce + AESGCM(key).encrypt(nonce, content, file.file.path.encode()))
+        return file
+
+    def migrate(self, **options):
+        out = StringIO()
+        call_command(
+            'migrate_legacy_blobs', checkpoint=self.checkpoint, workers=2, batch_size=2,
+            stdout=out, stderr=StringIO(), **options
+        )
+        return out.getvalue()
+
+    def test_converts_legacy_blobs(self):
+        contents = [os.urandom(100 * i) for i in range(1, 6)]
+        files = [self.create_legacy_file(content) for content in contents]
+
+        output = self.migrate()
+
+        self.assertIn('5 converted', output)
+        for file, content in zip(files, contents):
+            with open(file.file.path, 'rb') as f:
+                self.assertTrue(is_container(f))
+            with override_settings(FILE_ENCRYPTION_ACCEPT_LEGACY=False):
+                self.assertEqual(b''.join(open_decrypted_file(file.id, file.file.path)), content)
+
+    def test_resumes_from_checkpoint(self):
+        self.create_legacy_file(b"first")
+        self.migrate()
+        self.create_legacy_file(b"second")
+
+        output = self.migrate()
+        self.assertIn('1/1 files: 1 converted', output)
+
+        # A full rescan only finds already migrated blobs
+        output = self.migrate(restart=True)
+        self.assertIn('2/2 files: 0 converted, 2 already migrated', output)
+
+@override_settings(KEY_STORE_BACKEND='common.keystore.MemoryKeyStore')
+class ScrubBlobsCommandTests(TestCase):
+    def setUp(self):
+        keystore.reset_key_store()
+        self.addCleanup(keystore.reset_key_store)
+        self.test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_dir)
+        self.report = os.path.join(self.test_dir, 'report.json')
+        # Blobs go under the test directory, not the real MEDIA_ROOT
+        media_override = override_settings(MEDIA_ROOT=self.test_dir)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+
+    def create_file(self, content):
+        file = File.objects.create(
+            owner=self.user,
+            file=SimpleUploadedFile("test.txt", content),
+            filename='test.txt',
+            size=len(content)
+        )
+        encrypt_file(file.id, file.file.path)
+        return file
+
+    def scrub(self, **options):
+        call_command('scrub_blobs', workers=2, batch_size=2, report=self.report, stderr=StringIO(), **options)
+        with open(self.report) as f:
+            return json.load(f)
+
+    def test_records_status_of_every_file(self):
+        healthy = [self.create_file(os.urandom(1000)) for _ in range(3)]
+        corrupt = self.create_file(os.urandom(1000))
+        with open(corrupt.file.path, 'r+b') as f:
+            f.seek(-1, io.SEEK_END)
+            f.write(b'\x00' if f.read(1) != b'\x00' else b'\x01')
+        missing = self.create_file(b"gone")
+        os.remove(missing.file.path)
+
+        with self.assertRaises(CommandError):
+            self.scrub()
+
+        with open(self.report) as f:
+            report = json.load(f)
+        self.assertEqual(report['files'], 5)
+        self.assertEqual(report['statuses'], {'ok': 3, 'corrupt': 1, 'missing': 1, 'error': 0})
+        self.assertEqual({problem['id'] for problem in report['problems']}, {corrupt.id, missing.id})
+
+        for file in healthy:
+            file.refresh_from_db()
+            self.assertEqual(file.integrity_status, IntegrityStatus.OK)
+            self.assertIsNotNone(file.verified_at)
+        corrupt.refresh_from_db()
+        self.assertEqual(corrupt.integrity_status, IntegrityStatus.CORRUPT)
+
+    def test_older_than_skips_recently_verified_files(self):
+        self.create_file(b"checked")
+        self.scrub()
+        self.create_file(b"new")
+
+        report = self.scrub(older_than=24)
+        self.assertEqual(report['files'], 1)
+
+    def test_cached_file_lists_show_the_new_status(self):
+        self.create_file(b"listed")
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        listed = lambda: client.get(reverse('handle_file_requests')).data['data'][0]['integrity_status']
+        self.assertIsNone(listed())
+
+        self.scrub()
+        self.assertEqual(listed(), IntegrityStatus.OK)
+
+    def test_wrong_master_key_stops_the_run(self):
+        local_store = override_settings(
+            KEY_STORE_BACKEND='common.keystore.LocalKeyStore',
+            KEY_STORE_MASTER_KEY=generate_encryption_key().hex(),
+            KEY_STORE_SQLITE_PATH=os.path.join(self.test_dir, 'keys.sqlite3')
+        )
+        with local_store:
+            keystore.reset_key_store()
+            file = self.create_file(b"sealed")
+            with override_settings(KEY_STORE_MASTER_KEY=generate_encryption_key().hex()):
+                keystore.reset_key_store()
+                with self.assertRaisesMessage(CommandError, "key store can't open stored keys"):
+                    self.scrub()
+
+        # Not recorded as an error of the blob
+        file.refresh_from_db()
+        self.assertIsNone(file.integrity_status)
+
+class ReconcileStorageCommandTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(
+            MEDIA_ROOT=self.media_root,
+            KEY_STORE_BACKEND='common.keystore.MemoryKeyStore'
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        keystore.reset_key_store()
+        self.addCleanup(keystore.reset_key_store)
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+
+    def create_file(self, content, encrypt=True):
+        file = File.objects.create(
+            owner=self.user,
+            file=SimpleUploadedFile("test.txt", content),
+            filename='test.txt',
+            size=len(content),
+            mime='text/plain'
+        )
+        if encrypt:
+            encrypt_file(file.id, file.file.path)
+        return file
+
+    def write_upload(self, name, age=7200):
+        path = os.path.join(self.media_root, 'uploads', name)
+        with open(path, 'wb') as f:
+            f.write(b"leftover")
+        os.utime(path, (time.time() - age, time.time() - age))
+        return path
+
+    def age_dangling_keys(self, seconds):
+        checkpoint = os.path.join(self.media_root, '.reconcile_storage.checkpoint')
+        with open(checkpoint) as f:
+            state = json.load(f)
+        for seen in state['dangling_keys'].values():
+            seen[0] -= seconds
+        with open(checkpoint, 'w') as f:
+            json.dump(state, f)
+
+    def reconcile(self, **options):
+        out = StringIO()
+        call_command('reconcile_storage', batch_size=2, stdout=out, **options)
+        with open(os.path.join(self.media_root, '.reconcile_storage.jsonl')) as f:
+            return [json.loads(line) for line in f]
+
+    def test_finds_and_fixes_inconsistencies(self):
+        healthy = self.create_file(b"healthy")
+        plaintext = self.create_file(b"never encrypted", encrypt=False)
+        keyless = self.create_file(b"lost its key")
+        keystore.get_key_store().delete(keyless.id)
+        orphan = self.write_upload('orphan.bin')
+        temp = self.write_upload('healthy.txt.tmp')
+        young = self.write_upload('in-flight.bin', age=0)
+        store_encryption_key(999999, generate_encryption_key())
+
+        findings = self.reconcile()
+        kinds = sorted(finding['kind'] for finding in findings)
+        self.assertEqual(
+            kinds,
+            ['dangling_key', 'missing_key', 'orphan_blob', 'orphan_blob', 'temp_file', 'unidentified_blob']
+        )
+        self.assertFalse(any(finding['fixed'] for finding in findings))
+        self.assertTrue(os.path.exists(orphan))
+
+        findings = self.reconcile(fix=True, grace=60)
+        self.assertFalse(os.path.exists(orphan))
+        self.assertFalse(os.path.exists(temp))
+        self.assertTrue(os.path.exists(young))
+        # Only seen dangling moments ago: its row may still be about to commit
+        self.assertEqual(list(keystore.get_key_store().list_ids()), sorted([str(healthy.id), '999999']))
+
+        self.age_dangling_keys(120)
+        self.reconcile(fix=True, grace=60)
+        self.assertEqual(list(keystore.get_key_store().list_ids()), [str(healthy.id)])
+        # A blob that can't be identified is never rewritten
+        with open(plaintext.file.path, 'rb') as f:
+            self.assertEqual(f.read(), b"never encrypted")
+
+        # Only what can't be fixed is left
+        findings = self.reconcile(grace=60)
+        self.assertEqual(
+            sorted(finding['kind'] for finding in findings), ['missing_key', 'orphan_blob', 'unidentified_blob']
+        )
+
+    def test_key_whose_row_commits_later_is_kept(self):
+        key = generate_encryption_key()
+        store_encryption_key(999999, key)
+        self.reconcile()
+
+        # The row commits in between passes
+        File.objects.create(id=999999, owner=self.user, file='uploads/late', filename='late.txt', size=1)
+        self.age_dangling_keys(120)
+        self.reconcile(fix=True, grace=60)
+        self.assertEqual(keystore.get_key_store().get(999999), key)
+        with open(os.path.join(self.media_root, '.reconcile_storage.checkpoint')) as f:
+            self.assertEqual(json.load(f)['dangling_keys'], {})
+
+    def test_legacy_blob_that_no_longer_authenticates_is_left_alone(self):
+        file = self.create_file(b"placeholder", encrypt=False)
+        key = generate_encryption_key()
+        store_encryption_key(file.id, key)
+        nonce = os.urandom(12)
+        # Sealed under its path before a MEDIA_ROOT move
+        blob = nonce + AESGCM(key).encrypt(nonce, b"legacy", b"/old/media/root/blob")
+        with open(file.file.path, 'wb') as f:
+            f.write(blob)
+
+        findings = self.reconcile(fix=True, grace=60)
+
+        self.assertIn({'kind': 'unidentified_blob', 'fixed': False, 'file_id': file.id, 'path': file.file.name}, findings)
+        with open(file.file.path, 'rb') as f:
+            self.assertEqual(f.read(), blob)
+        self.assertEqual(keystore.get_key_store().get(file.id), key)
+
+    def test_resumes_from_checkpoint(self):
+        self.create_file(b"one")
+        checkpoint = os.path.join(self.media_root, '.reconcile_storage.checkpoint')
+        with open(checkpoint, 'w') as f:
+            json.dump({'phase': 'keys', 'cursor': None, 'counts': {'orphan_blob': 3}}, f)
+        store_encryption_key(999999, generate_encryption_key())
+
+        out = StringIO()
+        call_command('reconcile_storage', stdout=out)
+        self.assertIn('Resuming keys', out.getvalue())
+        self.assertIn('1 dangling_key, 3 orphan_blob', out.getvalue())
+        with open(checkpoint) as f:
+            self.assertEqual(json.load(f)['phase'], 'done')
+
+class ShardBlobsCommandTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(
+            MEDIA_ROOT=self.media_root,
+            KEY_STORE_BACKEND='common.keystore.MemoryKeyStore'
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        keystore.reset_key_store()
+        self.addCleanup(keystore.reset_key_store)
+        os.makedirs(os.path.join(self.media_root, 'uploads'))
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+
+    def create_flat_file(self, name, content):
+        path = os.path.join(self.media_root, 'uploads', name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        file = File.objects.create(owner=self.user, file=f'uploads/{name}', filename=name, size=len(content))
+        encrypt_file(file.id, path)
+        return file
+
+    def test_moves_blobs_into_shards(self):
+        contents = {f'report_{i}.csv': os.urandom(100) for i in range(5)}
+        files = [self.create_flat_file(name, content) for name, content in contents.items()]
+        sharded = File.objects.create(owner=self.user, file=SimpleUploadedFile("new.txt", b"new"), filename='new.txt')
+
+        out = StringIO()
+        call_command('shard_blobs', batch_size=2, unlink_delay=0, stdout=out)
+        self.assertIn('Moved 5 blobs', out.getvalue())
+
+        for file in files:
+            file.refresh_from_db()
+            self.assertTrue(is_sharded(file.file.name))
+            self.assertEqual(b''.join(open_decrypted_file(file.id, file.file.path)), contents[file.filename])
+            self.assertFalse(os.path.exists(os.path.join(self.media_root, 'uploads', file.filename)))
+        self.assertEqual(File.objects.get(id=sharded.id).file.name, sharded.file.name)
+
+        # Rerunning has nothing left to do
+        out = StringIO()
+        call_command('shard_blobs', unlink_delay=0, stdout=out)
+        self.assertIn('Moved 0 blobs', out.getvalue())
+
+    def test_cached_file_lists_show_the_new_name(self):
+        file = self.create_flat_file('listed.txt', b"listed")
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        listed = lambda: client.get(reverse('handle_file_requests')).data['data'][0]['file']
+        before = listed()
+
+        call_command('shard_blobs', unlink_delay=0, stdout=StringIO())
+        file.refresh_from_db()
+        self.assertNotEqual(listed(), before)
+        self.assertEqual(listed(), file.file.url)
+
+    def test_leaves_legacy_blobs_in_place(self):
+        path = os.path.join(self.media_root, 'uploads', 'legacy.bin')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(64))
+        file = File.objects.create(owner=self.user, file='uploads/legacy.bin', filename='legacy.bin')
+
+        out = StringIO()
+        call_command('shard_blobs', unlink_delay=0, stdout=out)
+        self.assertIn('1 legacy', out.getvalue())
+        self.assertEqual(File.objects.get(id=file.id).file.name, 'uploads/legacy.bin')
@@ -1,12 +1,20 @@
-from django.test import TestCase
+import shutil
+import tempfile
+from django.test import TestCase, override_settings
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.contrib.auth import get_user_model
+from files.layout import is_sharded
 from files.models import File, SharedFile
 
 User = get_user_model()
 
 class FileModelTests(TestCase):
     def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        media_override = override_settings(MEDIA_ROOT=self.media_root)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
         self.user = User.objects.create_user(
             username='testuser',
             email='test@example.com',
@@ -31,6 +39,17 @@ class FileModelTests(TestCase):
         self.assertEqual(file.size, len(b"test content"))
         self.assertEqual(file.mime, 'text/plain')
 
+    def test_blob_name_is_opaque_and_sharded(self):
+        file = File.objects.create(owner=self.user, file=self.test_file, filename='test_file.txt')
+        other = File.objects.create(
+            owner=self.user,
+            file=SimpleUploadedFile("test_file.txt", b"other content"),
+            filename='test_file.txt'
+        )
+        self.assertTrue(is_sharded(file.file.name))
+        self.assertNotIn('test_file', file.file.name)
+        self.assertNotEqual(file.file.name, other.file.name)
+
     def test_create_shared_file(self):
         file = File.objects.create(
             owner=self.user,
@@ -0,0 +1,203 @@
+import io
+import json
+import logging
+import os
+import secrets
+import shutil
+import tempfile
+import unittest
+from io import StringIO
+from unittest.mock import patch
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from django.core.files.uploadedfile import SimpleUploadedFile
+from common import keystore
+from common.crypto import decrypt_stream, encrypt_stream, generate_encryption_key, store_encryption_key
+from files.layout import is_sharded, sharded_name
+from files.models import File
+from files.storage import S3Storage, S3RangeReader, boto3
+
+try:
+    from moto.server import ThreadedMotoServer
+except ImportError:
+    ThreadedMotoServer = None
+
+User = get_user_model()
+
+MiB = 1024 * 1024
+
+@unittest.skipUnless(boto3 and ThreadedMotoServer, "needs boto3 and moto[server] for a local S3 stand-in")
+class S3StorageTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)  # the stand-in's request log
+        cls.server = ThreadedMotoServer(port=0, verbose=False)
+        cls.server.start()
+        host, port = cls.server.get_host_and_port()
+        cls.s3_settings = override_settings(
+            S3_BUCKET='blobs',
+            S3_ENDPOINT_URL=f'http://{host}:{port}',
+            S3_REGION='us-east-1',
+            S3_ACCESS_KEY_ID='test',
+            S3_SECRET_ACCESS_KEY='test',
+            S3_PART_SIZE=5 * MiB
+        )
+        cls.s3_settings.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.s3_settings.disable()
+        cls.server.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.storage = S3Storage()
+        self.storage.client.create_bucket(Bucket='blobs')
+        self.addCleanup(self.empty_bucket)
+
+    def empty_bucket(self):
+        for name in self.storage.listdir('uploads')[1]:
+            self.storage.delete(f'uploads/{name}')
+        self.storage.client.delete_bucket(Bucket='blobs')
+
+    def test_save_streams_multipart_upload(self):
+        data = os.urandom(11 * MiB + 123)
+        with patch.object(self.storage.client, 'upload_part', wraps=self.storage.client.upload_part) as upload_part:
+            name = self.storage.save('uploads/big', ContentFile(data))
+        self.assertEqual(upload_part.call_count, 3)
+        self.assertEqual(self.storage.size(name), len(data))
+
+        with self.storage.open(name) as blob:
+            self.assertEqual(blob.read(), data)
+
+    def test_small_blob_is_single_put(self):
+        with patch.object(self.storage.client, 'create_multipart_upload') as create:
+            self.storage.save('uploads/small', ContentFile(b'small'))
+        create.assert_not_called()
+        self.assertTrue(self.storage.exists('uploads/small'))
+        self.assertFalse(self.storage.exists('uploads/missing'))
+
+    def test_failed_write_leaves_no_object(self):
+        with self.assertRaises(RuntimeError):
+            with self.storage.open('uploads/partial', 'wb') as writer:
+                writer.write(os.urandom(6 * MiB))
+                raise RuntimeError("client went away")
+        self.assertFalse(self.storage.exists('uploads/partial'))
+        self.assertEqual(self.storage.client.list_multipart_uploads(Bucket='blobs').get('Uploads', []), [])
+
+    def test_ranged_reads(self):
+        data = os.urandom(3 * MiB)
+        self.storage.save('uploads/ranged', ContentFile(data))
+        reader = S3RangeReader(self.storage.client, 'blobs', 'uploads/ranged', window=MiB)
+        with patch.object(self.storage.client, 'get_object', wraps=self.storage.client.get_object) as get_object:
+            reader.seek(2 * MiB + 10)
+            self.assertEqual(reader.read(100), data[2 * MiB + 10:2 * MiB + 110])
+            self.assertEqual(reader.read(100), data[2 * MiB + 110:2 * MiB + 210])
+            self.assertEqual(get_object.call_count, 1)
+
+            reader.seek(-5, io.SEEK_END)
+            self.assertEqual(reader.read(), data[-5:])
+            self.assertEqual(reader.read(), b'')
+        reader.close()
+
+    def test_upload_and_download_through_api(self):
+        user = User.objects.create_user(username='testuser', email='test@example.com', password='testpass123')
+        client = APIClient()
+        client.force_authenticate(user=user)
+        content = os.urandom(200 * 1024)
+
+        with override_settings(STORAGES={'default': {'BACKEND': 'files.storage.S3Storage'}}), \
+                patch('files.serializers.store_encryption_key') as store_key:
+            response = client.post(
+                reverse('handle_file_requests'),
+                {'file': SimpleUploadedFile('photo.jpg', content, content_type='image/jpeg')},
+                format='multipart'
+            )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            file = File.objects.get(owner=user)
+            key = store_key.call_args[0][1]
+
+            # Only ciphertext reached the bucket
+            with self.storage.open(file.file.name) as blob:
+                decrypted = io.BytesIO()
+                decrypt_stream(key, blob, decrypted)
+            self.assertEqual(decrypted.getvalue(), content)
+
+            with patch('common.crypto.get_encryption_key', return_value=key):
+                response = client.get(
+                    reverse('handle_file_requests') + f'?id={file.id}',
+                    HTTP_RANGE='bytes=100000-100999'
+                )
+                self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+                self.assertEqual(b''.join(response.streaming_content), content[100000:101000])
+
+            response = client.delete(reverse('handle_file_requests') + f'?id={file.id}')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertFalse(self.storage.exists(file.file.name))
+
+    @override_settings(
+        STORAGES={'default': {'BACKEND': 'files.storage.S3Storage'}},
+        KEY_STORE_BACKEND='common.keystore.MemoryKeyStore'
+    )
+    def test_maintenance_commands_read_through_storage(self):
+        keystore.reset_key_store()
+        self.addCleanup(keystore.reset_key_store)
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir)
+        self.addCleanup(self.delete_objects)
+        user = User.objects.create_user(username='testuser', email='test@example.com', password='testpass123')
+        contents = {}
+
+        def create_file(name, content):
+            file = File.objects.create(owner=user, file=name, filename='test.txt', size=len(content))
+            key = generate_encryption_key()
+            store_encryption_key(file.id, key)
+            ciphertext = io.BytesIO()
+            encrypt_stream(key, io.BytesIO(content), ciphertext)
+            self.storage.save(name, ContentFile(ciphertext.getvalue()))
+            contents[file.id] = (key, content)
+            return file
+
+        create_file(sharded_name(secrets.token_hex(16)), os.urandom(1000))
+        flat = create_file('uploads/flat-blob', os.urandom(1000))
+        self.storage.save(sharded_name(secrets.token_hex(16)), ContentFile(b'orphan'))
+
+        report = os.path.join(test_dir, 'scrub.json')
+        call_command('scrub_blobs', workers=1, report=report, stderr=StringIO())
+        with open(report) as f:
+            self.assertEqual(json.load(f)['statuses']['ok'], 2)
+
+        call_command('shard_blobs', unlink_delay=0, stdout=StringIO())
+        flat.refresh_from_db()
+        self.assertTrue(is_sharded(flat.file.name))
+        self.assertFalse(self.storage.exists('uploads/flat-blob'))
+        with self.storage.open(flat.file.name) as blob:
+            decrypted = io.BytesIO()
+            decrypt_stream(contents[flat.id][0], blob, decrypted)
+        self.assertEqual(decrypted.getvalue(), contents[flat.id][1])
+
+        out = StringIO()
+        call_command(
+            'reconcile_storage', fix=True, grace=0, stdout=out,
+            checkpoint=os.path.join(test_dir, 'checkpoint'), report=os.path.join(test_dir, 'report.jsonl')
+        )
+        self.assertIn('Reconciled: 1 orphan_blob, 1 orphan_blob_fixed', out.getvalue())
+        self.assertEqual(
+            sorted(entry['Key'] for entry in self.storage.client.list_objects_v2(Bucket='blobs')['Contents']),
+            sorted(file.file.name for file in File.objects.all())
+        )
+
+        # Legacy blobs are bound to local paths
+        with self.assertRaises(CommandError):
+            call_command('migrate_legacy_blobs', stdout=StringIO())
+
+    def delete_objects(self):
+        for entry in self.storage.client.list_objects_v2(Bucket='blobs').get('Contents', []):
+            self.storage.delete(entry['Key'])
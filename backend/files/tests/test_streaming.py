@@ -0,0 +1,29 @@
+from django.test import SimpleTestCase
+from files.streaming import parse_range_header, RangeNotSatisfiable
+
+class ParseRangeHeaderTests(SimpleTestCase):
+    def test_missing_or_malformed_header_serves_whole_body(self):
+        self.assertIsNone(parse_range_header(None, 100))
+        self.assertIsNone(parse_range_header('items=0-10', 100))
+        self.assertIsNone(parse_range_header('bytes=abc', 100))
+        self.assertIsNone(parse_range_header('bytes=20-10', 100))
+
+    def test_single_ranges(self):
+        self.assertEqual(parse_range_header('bytes=0-9', 100), [(0, 10)])
+        self.assertEqual(parse_range_header('bytes=90-', 100), [(90, 100)])
+        self.assertEqual(parse_range_header('bytes=-5', 100), [(95, 100)])
+        # Ranges past the end are clamped
+        self.assertEqual(parse_range_header('bytes=50-500', 100), [(50, 100)])
+        self.assertEqual(parse_range_header('bytes=-500', 100), [(0, 100)])
+
+    def test_multiple_ranges(self):
+        self.assertEqual(
+            parse_range_header('bytes=0-1, 10-19, 200-300', 100),
+            [(0, 2), (10, 20)]
+        )
+
+    def test_unsatisfiable_range(self):
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range_header('bytes=100-', 100)
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range_header('bytes=-0', 100)
@@ -1,15 +1,53 @@
-from django.test import TestCase
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from unittest import skipUnless
+from unittest.mock import patch
+from django.test import TestCase, override_settings
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
 from django.urls import reverse
+from django.utils.http import http_date
 from rest_framework.test import APIClient
 from rest_framework import status
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from django.core.files.uploadedfile import SimpleUploadedFile
-from files.models import File, SharedFile
+from django.db.models.fields.files import FieldFile
+from common import keystore
+from common.crypto import (
+    decrypt_stream,
+    encrypt_file,
+    encrypt_stream,
+    generate_encryption_key,
+    get_encryption_key,
+    is_container,
+    store_encryption_key
+)
+from files.changes import ChangeKind
+from files.models import File, FileChange, SharedFile
+from files.pagination import encode_cursor
+from files.serializers import FileSerializer
+from files.uploadhandlers import ConcurrentEncryptingUploadHandler, _new_encryptor as new_encryptor
+from users.role import UserRole
 
 User = get_user_model()
 
 class FileViewsTests(TestCase):
     def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        media_override = override_settings(MEDIA_ROOT=self.media_root)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
         self.client = APIClient()
         self.user = User.objects.create_user(
             username='testuser',
@@ -32,6 +70,101 @@ class FileViewsTests(TestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertTrue(File.objects.filter(owner=self.user).exists())
 
+    def test_upload_stores_only_ciphertext(self):
+        content = b"plaintext that must never reach the disk " * 100
+        upload = SimpleUploadedFile("report.csv", content, content_type="text/csv")
+
+        with patch('files.serializers.store_encryption_key') as store_key:
+            response = self.client.post(
+                reverse('handle_file_requests'),
+                {'file': upload},
+                format='multipart'
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        file = File.objects.get(owner=self.user)
+        self.assertEqual(file.filename, 'report.csv')
+        self.assertEqual(file.size, len(content))
+        self.assertEqual(file.digest, hashlib.sha256(content).hexdigest())
+
+        # Key is stored against the new row and decrypts the stored blob
+        file_id, key = store_key.call_args[0]
+        self.assertEqual(file_id, file.id)
+        with open(file.file.path, 'rb') as f:
+            self.assertTrue(is_container(f))
+            decrypted = io.BytesIO()
+            decrypt_stream(key, f, decrypted)
+        self.assertEqual(decrypted.getvalue(), content)
+
+    @override_settings(FILE_COMPRESSION='zlib')
+    def test_upload_compresses_text_and_serves_ranges(self):
+        content = b"".join(f"{i},user{i}@example.com\n".encode() for i in range(10000))
+        upload = SimpleUploadedFile("users.csv", content, content_type="text/csv")
+
+        with patch('files.serializers.store_encryption_key') as store_key:
+            response = self.client.post(
+                reverse('handle_file_requests'),
+                {'file': upload},
+                format='multipart'
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        file = File.objects.get(owner=self.user)
+        self.assertEqual(file.size, len(content))
+        self.assertLess(os.path.getsize(file.file.path), len(content) / 3)
+
+        key = store_key.call_args[0][1]
+        with patch('common.crypto.get_encryption_key', return_value=key):
+            response = self.client.get(reverse('handle_file_requests') + f'?id={file.id}')
+            self.assertEqual(response['Content-Length'], str(len(content)))
+            self.assertEqual(b''.join(response.streaming_content), content)
+
+            response = self.client.get(
+                reverse('handle_file_requests') + f'?id={file.id}',
+                HTTP_RANGE='bytes=100000-100099'
+            )
+            self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+            self.assertEqual(b''.join(response.streaming_content), content[100000:100100])
+
+    @override_settings(FILE_ENCRYPTION_ENVELOPE=True)
+    def test_upload_in_envelope_mode_skips_key_store(self):
+        kek = generate_encryption_key()
+        with patch('common.crypto.get_key_encryption_key', return_value=(1, kek)), \
+                patch('files.serializers.store_encryption_key') as store_key:
+            response = self.client.post(
+                reverse('handle_file_requests'),
+                {'file': self.test_file},
+                format='multipart'
+            )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            store_key.assert_not_called()
+
+            file = File.objects.get(owner=self.user)
+            response = self.client.get(reverse('handle_file_requests') + f'?id={file.id}')
+            self.assertEqual(b''.join(response.streaming_content), b"test content")
+
+    def test_upload_rolls_back_when_key_cannot_be_stored(self):
+        with patch('files.serializers.store_encryption_key', side_effect=Exception("vault down")):
+            with self.assertRaises(Exception):
+                self.client.post(
+                    reverse('handle_file_requests'),
+                    {'file': self.test_file},
+                    format='multipart'
+                )
+        self.assertFalse(File.objects.filter(owner=self.user).exists())
+
+    def test_delete_removes_blob_and_key(self):
+        file, key = self.create_encrypted_file(b"to be deleted")
+        path = file.file.path
+
+        with patch('files.views.delete_encryption_key') as delete_key:
+            response = self.client.delete(reverse('handle_file_requests') + f'?id={file.id}')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(File.objects.filter(id=file.id).exists())
+        self.assertFalse(os.path.exists(path))
+        delete_key.assert_called_once_with(str(file.id))
+
     def test_list_files(self):
         File.objects.create(
             owner=self.user,
@@ -44,6 +177,119 @@ class FileViewsTests(TestCase):
         self.assertEqual(len(response.data['data']), 1)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def _create_listed_files(self, count, **fields):
+        return [
+            File.objects.create(
+                owner=self.user, file=f'uploads/listed-{i}', filename=f'listed-{i}.txt',
+                size=fields.get('size', 100), mime=fields.get('mime', 'text/plain')
+            )
+            for i in range(count)
+        ]
+
+    def test_list_files_pages_with_cursor(self):
+        files = self._create_listed_files(5)
+        # Ties on uploaded_at must be broken by id, not skipped or repeated
+        File.objects.filter(id__in=[files[1].id, files[2].id]).update(uploaded_at=files[1].uploaded_at)
+        other = User.objects.create_user(username='other', email='other@example.com', password='testpass123')
+        File.objects.create(owner=other, file='uploads/other', filename='other.txt', size=1, mime='text/plain')
+
+        seen, cursor = [], None
+        while True:
+            params = {'limit': 2, **({'cursor': cursor} if cursor else {})}
+            response = self.client.get(reverse('handle_file_requests'), params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['data']), 2)
+            seen += [entry['id'] for entry in response.data['data']]
+            cursor = response.data['meta']['next_cursor']
+            if cursor is None:
+                break
+        expected = File.objects.filter(owner=self.user).order_by('uploaded_at', 'id').values_list('id', flat=True)
+        self.assertEqual(seen, list(expected))
+
+    @skipUnless(connection.vendor == 'sqlite', "reads SQLite's query plan")
+    @override_settings(LIST_CACHE_TIMEOUT=0)
+    def test_cursor_seeks_the_listing_index(self):
+        cursor = encode_cursor(timezone.now(), 1)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('handle_file_requests'), {'cursor': cursor})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        sql = next(query['sql'] for query in queries if 'ORDER BY' in query['sql'] and 'files_file' in query['sql'])
+        with connection.cursor() as db:
+            db.execute(f"EXPLAIN QUERY PLAN {sql}")
+            plan = ' '.join(str(row) for row in db.fetchall())
+        # The page starts at the cursor instead of scanning the owner's rows up to it
+        self.assertIn('uploaded_at>', plan)
+
+    def test_list_files_filters(self):
+        small_text, = self._create_listed_files(1, size=10, mime='text/plain')
+        large_image, = self._create_listed_files(1, size=5000, mime='image/png')
+        self._create_listed_files(1, size=50, mime='image/jpeg')
+
+        def listed(**params):
+            response = self.client.get(reverse('handle_file_requests'), params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return {entry['id'] for entry in response.data['data']}
+
+        self.assertEqual(listed(mime='text/plain'), {small_text.id})
+        self.assertEqual(len(listed(mime='image/')), 2)
+        self.assertEqual(listed(min_size=1000), {large_image.id})
+        self.assertEqual(listed(mime='image/*', max_size=100), listed(min_size=11, max_size=100))
+        self.assertEqual(len(listed(uploaded_after='2000-01-01')), 3)
+        self.assertEqual(listed(uploaded_before='2000-01-01'), set())
+
+    @override_settings(LIST_CACHE_TIMEOUT=0)
+    def test_list_files_query_count_is_fixed(self):
+        self.user.role = UserRole.ADMIN
+        self.user.save()
+        owners = [
+            User.objects.create_user(username=f'owner{i}', email=f'owner{i}@example.com', password='testpass123')
+            for i in range(3)
+        ]
+        for rows in (2, 40):
+            File.objects.bulk_create(
+                File(owner=owners[i % len(owners)], file=f'uploads/{rows}-{i}', filename=f'{i}.txt', size=i)
+                for i in range(rows)
+            )
+            # One SELECT joined to the owner, however many rows and owners are listed
+            with self.assertNumQueries(1):
+                response = self.client.get(reverse('handle_file_requests'), {'limit': 200})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_list_files_matches_file_serializer(self):
+        files = self._create_listed_files(1) + self._create_listed_files(1, mime=None)
+        File.objects.filter(id=files[0].id).update(integrity_status='ok', verified_at=files[0].uploaded_at)
+
+        response = self.client.get(reverse('handle_file_requests'))
+        expected = FileSerializer(File.objects.order_by('uploaded_at', 'id'), many=True).data
+        self.assertEqual([dict(entry) for entry in response.data['data']], [dict(entry) for entry in expected])
+        self.assertIsNone(response.data['data'][1]['type'])
+
+    def test_list_files_is_cached_until_files_change(self):
+        file, = self._create_listed_files(1)
+        self.assertEqual(self.client.get(reverse('handle_file_requests'))['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get(reverse('handle_file_requests'))['X-Cache'], 'HIT')
+
+        # Saves, shares and deletes all invalidate the owner's cached lists
+        file.filename = 'renamed.txt'
+        file.save()
+        response = self.client.get(reverse('handle_file_requests'))
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['data'][0]['filename'], 'renamed.txt')
+
+        SharedFile.objects.create(file=file, user=self.user)
+        self.assertEqual(self.client.get(reverse('handle_file_requests'))['X-Cache'], 'MISS')
+
+        file.delete()
+        response = self.client.get(reverse('handle_file_requests'))
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['data'], [])
+
+    def test_list_files_rejects_bad_parameters(self):
+        for params in ({'cursor': 'not-a-cursor'}, {'limit': 0}, {'min_size': 'big'}, {'uploaded_after': 'soon'}):
+            response = self.client.get(reverse('handle_file_requests'), params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, params)
+            self.assertFalse(response.data['success'])
+
     def test_share_file(self):
         file = File.objects.create(
             owner=self.user,
@@ -54,4 +300,553 @@ class FileViewsTests(TestCase):
             reverse('get_share_link') + '?id=1'
         )
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
-        self.assertTrue(SharedFile.objects.filter(file=file).exists()) 
\ No newline at end of file
+        self.assertTrue(SharedFile.objects.filter(file=file).exists())
+
+    def create_encrypted_file(self, content):
+        key = generate_encryption_key()
+        encrypted = io.BytesIO()
+        encrypt_stream(key, io.BytesIO(content), encrypted, chunk_size=16)
+        file = File.objects.create(
+            owner=self.user,
+            file=SimpleUploadedFile("test_file.txt", encrypted.getvalue()),
+            filename='test_file.txt',
+            size=len(content),
+            mime='text/plain',
+            digest=hashlib.sha256(content).hexdigest()
+        )
+        return file, key
+
+    def test_download_streams_plaintext_without_touching_blob(self):
+        content = b"streamed download content " * 10
+        file, key = self.create_encrypted_file(content)
+        with open(file.file.path, 'rb') as f:
+            stored = f.read()
+
+        with patch('common.crypto.get_encryption_key', return_value=key):
+            response = self.client.get(reverse('handle_file_requests') + f'?id={file.id}')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Length'], str(len(content)))
+        self.assertIn('test_file.txt', response['Content-Disposition'])
+        self.assertEqual(b''.join(response.streaming_content), content)
+
+        # Reads never rewrite the stored ciphertext
+        with open(file.file.path, 'rb') as f:
+            self.assertEqual(f.read(), stored)
+
+    def test_download_shared_file(self):
+        content = b"shared content"
+        file, key = self.create_encrypted_file(content)
+        shared_file = SharedFile.objects.create(file=file, user=self.user)
+
+        client = APIClient()
+        with patch('common.crypto.get_encryption_key', return_value=key):
+            response = client.get(reverse('get_shared_file', args=[shared_file.share_hash]))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), content)
+
+    def test_download_range(self):
+        content = bytes(range(100))
+        file, key = self.create_encrypted_file(content)
+
+        # Corrupt the first chunk: a range that doesn't cover it must not decrypt it
+        with open(file.file.path, 'r+b') as f:
+            f.seek(30)
+            f.write(b'\x00')
+
+        with patch('common.crypto.get_encryption_key', return_value=key):
+            response = self.client.get(
+                reverse('handle_file_requests') + f'?id={file.id}',
+                HTTP_RANGE='bytes=40-59'
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response['Content-Range'], 'bytes 40-59/100')
+        self.assertEqual(response['Content-Length'], '20')
+        self.assertEqual(b''.join(response.streaming_content), content[40:60])
+
+    def test_download_multiple_ranges(self):
+        content = bytes(range(100))
+        file, key = self.create_encrypted_file(content)
+
+        with patch('common.crypto.get_encryption_key', return_value=key):
+            response = self.client.get(
+                reverse('handle_file_requests') + f'?id={file.id}',
+                HTTP_RANGE='bytes=0-4,-5'
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges'))
+        body = b''.join(response.streaming_content)
+        self.assertEqual(len(body), int(response['Content-Length']))
+        self.assertIn(b'Content-Range: bytes 0-4/100\r\n\r\n' + content[:5], body)
+        self.assertIn(b'Content-Range: bytes 95-99/100\r\n\r\n' + content[95:], body)
+
+    def test_download_unsatisfiable_range(self):
+        file, key = self.create_encrypted_file(b"short")
+
+        with patch('common.crypto.get_encryption_key', return_value=key):
+            response = self.client.get(
+                reverse('handle_file_requests') + f'?id={file.id}',
+                HTTP_RANGE='bytes=10-'
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(response['Content-Range'], 'bytes */5')
+
+    def test_download_sends_validators(self):
+        content = b"cacheable content"
+        file, key = self.create_encrypted_file(content)
+
+        with patch('common.crypto.get_encryption_key', return_value=key):
+            response = self.client.get(reverse('handle_file_requests') + f'?id={file.id}')
+
+        self.assertEqual(response['ETag'], f'"{hashlib.sha256(content).hexdigest()}"')
+        self.assertEqual(response['Last-Modified'], http_date(int(file.uploaded_at.timestamp())))
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+
+    def test_conditional_download_skips_key_store_and_blob(self):
+        file, key = self.create_encrypted_file(b"unchanged")
+        etag = f'"{file.digest}"'
+        shared_file = SharedFile.objects.create(file=file, user=self.user)
+        urls = [
+            reverse('handle_file_requests') + f'?id={file.id}',
+            reverse('get_shared_file', args=[shared_file.share_hash]),
+        ]
+
+        with patch('common.crypto.get_encryption_key', side_effect=AssertionError("key fetched")), \
+                patch('files.streaming.open_blob', side_effect=AssertionError("blob opened")):
+            for url in urls:
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+                self.assertEqual(response['ETag'], etag)
+
+                response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 60))
+                self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        with patch('common.crypto.get_encryption_key', return_value=key):
+            response = self.client.get(urls[0], HTTP_IF_NONE_MATCH='"something-else"')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(b''.join(response.streaming_content), b"unchanged")
+
+    def test_stale_if_range_sends_whole_file(self):
+        content = bytes(range(100))
+        file, key = self.create_encrypted_file(content)
+        url = reverse('handle_file_requests') + f'?id={file.id}'
+
+        with patch('common.crypto.get_encryption_key', return_value=key):
+            response = self.client.get(url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=f'"{file.digest}"')
+            self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+            response.close()
+
+            response = self.client.get(url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"old-version"')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(b''.join(response.streaming_content), content)
+
+    def test_file_without_digest_gets_weak_etag(self):
+        file, key = self.create_encrypted_file(b"old upload")
+        File.objects.filter(id=file.id).update(digest=None)
+        file.refresh_from_db()
+
+        with patch('common.crypto.get_encryption_key', return_value=key):
+            response = self.client.get(reverse('handle_file_requests') + f'?id={file.id}')
+        self.assertTrue(response['ETag'].startswith('W/'))
+
+        response = self.client.get(reverse('handle_file_requests') + f'?id={file.id}', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_list_revalidates_with_weak_etag(self):
+        self._create_listed_files(1)
+        response = self.client.get(reverse('handle_file_requests'))
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        response = self.client.get(reverse('handle_file_requests'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self._create_listed_files(1)
+        response = self.client.get(reverse('handle_file_requests'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.data['data']), 2)
+
+    def archive(self, body, keys):
+        with patch('common.crypto.get_encryption_key', side_effect=lambda file_id: keys[file_id]) as get_key:
+            response = self.client.post(reverse('create_archive'), body, format='json')
+            content = b''.join(response.streaming_content) if response.streaming else None
+        return response, content, get_key
+
+    def test_archive_streams_zip_of_decrypted_files(self):
+        first, first_key = self.create_encrypted_file(b"first file " * 50)
+        second, second_key = self.create_encrypted_file(b"second file " * 50)
+        keys = {first.id: first_key, second.id: second_key}
+
+        response, content, get_key = self.archive({'ids': [second.id, first.id]}, keys)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertNotIn('Content-Length', response)
+        self.assertEqual(sorted(call.args[0] for call in get_key.call_args_list), sorted(keys))
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            self.assertIsNone(archive.testzip())
+            # Same filename twice: the later upload is renamed
+            self.assertEqual(archive.namelist(), ['test_file.txt', 'test_file (2).txt'])
+            self.assertEqual(archive.read('test_file.txt'), b"first file " * 50)
+            self.assertEqual(archive.read('test_file (2).txt'), b"second file " * 50)
+
+    @override_settings(KEY_STORE_BACKEND='common.keystore.MemoryKeyStore', FILE_ENCRYPTION_ENVELOPE=True)
+    def test_archive_fetches_no_keys_of_envelope_mode_files(self):
+        keystore.reset_key_store()
+        self.addCleanup(keystore.reset_key_store)
+        file = File.objects.create(
+            owner=self.user, file=SimpleUploadedFile("test_file.txt", b"enveloped"), filename='test_file.txt', size=9
+        )
+        encrypt_file(file.id, file.file.path)
+
+        response, content, get_key = self.archive({'ids': [file.id]}, {})
+
+        get_key.assert_not_called()
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            self.assertEqual(archive.read('test_file.txt'), b"enveloped")
+
+    def test_archive_all_covers_only_own_files(self):
+        mine, key = self.create_encrypted_file(b"mine")
+        other = User.objects.create_user(username='other', email='other@example.com', password='testpass123')
+        File.objects.create(owner=other, file=SimpleUploadedFile("theirs.txt", b"x"), filename='theirs.txt', size=1)
+
+        response, content, _ = self.archive({'all': True}, {mine.id: key})
+
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            self.assertEqual(archive.namelist(), ['test_file.txt'])
+            self.assertEqual(archive.read('test_file.txt'), b"mine")
+
+    def test_archive_lists_unreadable_files(self):
+        readable, key = self.create_encrypted_file(b"readable")
+        unreadable, _ = self.create_encrypted_file(b"no key")
+
+        response, content, _ = self.archive({'ids': [readable.id, unreadable.id]}, {readable.id: key})
+
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            self.assertEqual(archive.namelist(), ['test_file.txt', 'ERRORS.txt'])
+            self.assertIn(f'id {unreadable.id}', archive.read('ERRORS.txt').decode())
+
+    @override_settings(KEY_STORE_BACKEND='common.keystore.MemoryKeyStore', FILE_KEY_CACHE_SIZE=10)
+    def test_key_cache_stats_are_for_admins_only(self):
+        keystore.reset_key_store()
+        self.addCleanup(keystore.reset_key_store)
+        response = self.client.get(reverse('get_key_cache_stats'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.user.role = UserRole.ADMIN
+        self.user.save()
+        with patch('common.crypto._key_cache', None):
+            store_encryption_key(1, generate_encryption_key())
+            get_encryption_key(1)
+            response = self.client.get(reverse('get_key_cache_stats'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        stats = response.data['data']
+        self.assertEqual(stats['pid'], os.getpid())
+        self.assertEqual((stats['hits'], stats['size'], stats['max_entries']), (1, 1, 10))
+
+    def test_archive_rejects_bad_or_foreign_ids(self):
+        other = User.objects.create_user(username='other', email='other@example.com', password='testpass123')
+        theirs = File.objects.create(owner=other, file=SimpleUploadedFile("theirs.txt", b"x"), filename='theirs.txt', size=1)
+
+        for body in ({}, {'ids': []}, {'ids': ['1']}, {'all': 'yes'}):
+            response = self.client.post(reverse('create_archive'), body, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, body)
+        response = self.client.post(reverse('create_archive'), {'ids': [theirs.id + 100]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.post(reverse('create_archive'), {'ids': [theirs.id]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    @override_settings(KEY_STORE_BACKEND='common.keystore.MemoryKeyStore')
+    def test_bulk_upload_stores_every_file(self):
+        keystore.reset_key_store()
+        self.addCleanup(keystore.reset_key_store)
+        contents = {f'bulk-{i}.txt': f'bulk file {i} '.encode() * 500 for i in range(5)}
+        uploads = [SimpleUploadedFile(name, content, content_type='text/plain') for name, content in contents.items()]
+
+        response = self.client.post(reverse('post_files_bulk'), {'files': uploads}, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        results = response.data['data']
+        self.assertEqual([result['filename'] for result in results], list(contents))
+        self.assertTrue(all(result['success'] for result in results))
+        # The changes the skipped post_save signals would have logged
+        self.assertEqual(
+            sorted(FileChange.objects.filter(kind=ChangeKind.CREATED).values_list('file_id', flat=True)),
+            sorted(result['id'] for result in results)
+        )
+        for result in results:
+            file = File.objects.get(id=result['id'], owner=self.user)
+            content = contents[result['filename']]
+            self.assertEqual((file.size, file.digest), (len(content), hashlib.sha256(content).hexdigest()))
+            response = self.client.get(reverse('handle_file_requests') + f'?id={file.id}')
+            self.assertEqual(b''.join(response.streaming_content), content)
+
+    @override_settings(KEY_STORE_BACKEND='common.keystore.MemoryKeyStore')
+    def test_bulk_upload_reports_partial_failures(self):
+        keystore.reset_key_store()
+        self.addCleanup(keystore.reset_key_store)
+        uploads = [
+            SimpleUploadedFile('good.txt', b'good', content_type='text/plain'),
+            SimpleUploadedFile('unencryptable.txt', b'bad', content_type='application/x-broken'),
+            SimpleUploadedFile('unstorable.txt', b'bad', content_type='text/plain'),
+        ]
+        save_blob = FieldFile.save
+
+        def choose_codec(mime, sample):
+            if mime == 'application/x-broken':
+                raise ValueError('broken')
+            return None
+
+        def save_or_fail(field_file, name, content, save=True):
+            if name == 'unstorable.txt':
+                raise OSError('disk full')
+            return save_blob(field_file, name, content, save)
+
+        with patch('files.uploadhandlers.choose_codec', side_effect=choose_codec), \
+                patch.object(FieldFile, 'save', save_or_fail):
+            response = self.client.post(reverse('post_files_bulk'), {'files': uploads}, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.data['data']
+        self.assertEqual([result['success'] for result in results], [True, False, False])
+        self.assertEqual(results[1]['error'], 'Encryption failed')
+        self.assertEqual(results[2]['error'], 'Could not store file')
+        self.assertEqual(list(File.objects.values_list('filename', flat=True)), ['good.txt'])
+
+    def test_bulk_upload_keeps_no_rows_when_keys_cannot_be_stored(self):
+        uploads = [SimpleUploadedFile(f'{i}.txt', b'content', content_type='text/plain') for i in range(3)]
+        with patch('files.views.store_encryption_keys', side_effect=Exception('vault down')):
+            response = self.client.post(reverse('post_files_bulk'), {'files': uploads}, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertFalse(any(result['success'] for result in response.data['data']))
+        self.assertFalse(File.objects.exists())
+        self.assertFalse(FileChange.objects.exists())
+
+    def test_bulk_upload_reports_failure_when_blobs_cannot_be_cleaned_up(self):
+        uploads = [SimpleUploadedFile(f'{i}.txt', b'content', content_type='text/plain') for i in range(2)]
+        with patch('files.views.store_encryption_keys', side_effect=Exception('vault down')), \
+                patch('django.core.files.storage.FileSystemStorage.delete', side_effect=OSError('disk gone')):
+            response = self.client.post(reverse('post_files_bulk'), {'files': uploads}, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual([result['error'] for result in response.data['data']], ['Could not save file'] * 2)
+        self.assertFalse(File.objects.exists())
+
+    @override_settings(KEY_STORE_BACKEND='common.keystore.MemoryKeyStore')
+    def test_bulk_upload_saves_rows_one_by_one_without_bulk_insert_ids(self):
+        keystore.reset_key_store()
+        self.addCleanup(keystore.reset_key_store)
+        uploads = [SimpleUploadedFile(f'{i}.txt', b'content', content_type='text/plain') for i in range(3)]
+        with patch.object(type(connection.features), 'can_return_rows_from_bulk_insert', False):
+            response = self.client.post(reverse('post_files_bulk'), {'files': uploads}, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        ids = [result['id'] for result in response.data['data']]
+        self.assertEqual(File.objects.filter(id__in=ids, owner=self.user).count(), 3)
+        self.assertEqual(
+            sorted(FileChange.objects.filter(kind=ChangeKind.CREATED).values_list('file_id', flat=True)), sorted(ids)
+        )
+        for file_id in ids:
+            self.assertIsNotNone(keystore.get_key_store().get(file_id))
+
+    @override_settings(FILE_BULK_UPLOAD_WORKERS=1)
+    def test_bulk_upload_cut_off_before_a_part_was_picked_up(self):
+        release = threading.Event()
+
+        def slow_encryptor(*args):
+            release.wait(10)
+            return new_encryptor(*args)
+
+        handler = ConcurrentEncryptingUploadHandler()
+        with patch('files.uploadhandlers._new_encryptor', side_effect=slow_encryptor):
+            handler.new_file('files', 'first.txt', 'text/plain', None)
+            handler.receive_data_chunk(b'first', 0)
+            handler.file_complete(5)
+            # The only worker is still busy, so this part is queued when the request ends
+            handler.new_file('files', 'second.txt', 'text/plain', None)
+            handler.receive_data_chunk(b'sec', 0)
+            handler.upload_interrupted()
+            release.set()
+
+            completed = threading.Thread(target=handler.upload_complete, daemon=True)
+            completed.start()
+            completed.join(10)
+        self.assertFalse(completed.is_alive())
+
+    @override_settings(KEY_STORE_BACKEND='common.keystore.MemoryKeyStore')
+    def test_bulk_upload_cut_off_part_way_stores_nothing(self):
+        keystore.reset_key_store()
+        self.addCleanup(keystore.reset_key_store)
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        uploads = [
+            SimpleUploadedFile(f'cut-{i}.txt', f'cut file {i} '.encode() * 50000, content_type='text/plain')
+            for i in range(2)
+        ]
+        body = encode_multipart(BOUNDARY, {'files': uploads})
+        # End the body in the middle of the second file
+        body = body[:body.rindex(b'cut file 1 ') - 1000]
+
+        started = time.monotonic()
+        with override_settings(FILE_UPLOAD_TEMP_DIR=temp_dir):
+            response = self.client.post(reverse('post_files_bulk'), body, content_type=MULTIPART_CONTENT)
+
+        # Workers were stopped rather than left waiting out CHUNK_TIMEOUT for chunks
+        self.assertLess(time.monotonic() - started, 30)
+        results = response.data.get('data') or []
+        self.assertFalse(any(result['success'] for result in results))
+        self.assertFalse(File.objects.filter(owner=self.user).exists())
+        self.assertEqual(os.listdir(temp_dir), [])
+
+class FileSearchTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='testpass123')
+        self.client.force_authenticate(user=self.user)
+
+    def create(self, filename, owner=None):
+        return File.objects.create(
+            owner=owner or self.user, file=f'uploads/{filename}', filename=filename, size=1, mime='text/plain'
+        )
+
+    def search(self, query, **params):
+        response = self.client.get(reverse('search_files'), {'q': query, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def names(self, query, **params):
+        return [entry['filename'] for entry in self.search(query, **params).data['data']]
+
+    def test_matches_substrings_of_every_term(self):
+        self.create('Quarterly-Report-2024.pdf')
+        self.create('report_draft.docx')
+        self.create('holiday.jpg')
+
+        self.assertCountEqual(self.names('report'), ['Quarterly-Report-2024.pdf', 'report_draft.docx'])
+        self.assertEqual(self.names('port 2024'), ['Quarterly-Report-2024.pdf'])
+        # Terms too short for the trigram index still filter
+        self.assertEqual(self.names('report dr'), ['report_draft.docx'])
+        self.assertEqual(self.names('jp'), ['holiday.jpg'])
+        self.assertEqual(self.names('"quoted" OR'), [])
+
+    def test_ranks_better_matches_first(self):
+        self.create('notes about a budget and other budget things.txt')
+        self.create('budget.xlsx')
+        self.assertEqual(self.names('budget')[0], 'budget.xlsx')
+
+    def test_index_follows_rename_and_delete(self):
+        file = self.create('invoice.pdf')
+        File.objects.filter(id=file.id).update(filename='receipt.pdf')
+        self.assertEqual(self.names('invoice'), [])
+        self.assertEqual(self.names('receipt'), ['receipt.pdf'])
+
+        File.objects.filter(id=file.id).delete()
+        self.assertEqual(self.names('receipt'), [])
+
+    def test_only_admins_search_other_users_files(self):
+        other = User.objects.create_user(username='other', email='other@example.com', password='testpass123')
+        self.create('shared-plan.txt', owner=other)
+        self.assertEqual(self.names('plan'), [])
+
+        self.user.role = UserRole.ADMIN
+        self.user.save()
+        self.assertEqual(self.names('plan'), ['shared-plan.txt'])
+
+    def test_pages_with_cursor(self):
+        for i in range(5):
+            self.create(f'scan-{i}.png')
+
+        seen, cursor = [], None
+        while True:
+            response = self.search('scan', limit=2, **({'cursor': cursor} if cursor else {}))
+            seen += [entry['filename'] for entry in response.data['data']]
+            cursor = response.data['meta']['next_cursor']
+            if cursor is None:
+                break
+        self.assertCountEqual(seen, [f'scan-{i}.png' for i in range(5)])
+
+    def test_rejects_missing_query_and_bad_cursor(self):
+        for params in ({}, {'q': '  '}, {'q': 'scan', 'cursor': 'nope'}):
+            response = self.client.get(reverse('search_files'), params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, params)
+
+@override_settings(FILE_CHANGES_SETTLE_SECONDS=0)
+class FileChangeFeedTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='testpass123')
+        self.client.force_authenticate(user=self.user)
+
+    def create(self, filename, owner=None):
+        return File.objects.create(
+            owner=owner or self.user, file=f'uploads/{filename}', filename=filename, size=1, mime='text/plain'
+        )
+
+    def poll(self, since=None, **params):
+        response = self.client.get(reverse('get_file_changes'), {**({'since': since} if since else {}), **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_returns_only_changes_since_cursor(self):
+        kept = self.create('kept.txt')
+        cursor = self.poll()['meta']['cursor']
+
+        renamed = self.create('draft.txt')
+        renamed.filename = 'final.txt'
+        renamed.save()
+        removed_id = self.create('removed.txt').id
+        File.objects.filter(id=removed_id).delete()
+        SharedFile.objects.create(file=kept, user=self.user)
+
+        feed = self.poll(cursor)
+        changes = {entry['id']: entry for entry in feed['data']}
+        self.assertEqual(set(changes), {kept.id, renamed.id, removed_id})
+        self.assertEqual(changes[kept.id]['change'], 'shared')
+        self.assertEqual(changes[renamed.id]['change'], 'updated')
+        self.assertEqual(changes[renamed.id]['file']['filename'], 'final.txt')
+        self.assertEqual(changes[removed_id]['change'], 'deleted')
+        self.assertIsNone(changes[removed_id]['file'])
+        self.assertFalse(feed['meta']['has_more'])
+
+        self.assertEqual(self.poll(feed['meta']['cursor'])['data'], [])
+
+    def test_pages_through_changes(self):
+        cursor = self.poll()['meta']['cursor']
+        files = [self.create(f'{i}.txt') for i in range(5)]
+
+        seen = []
+        while True:
+            feed = self.poll(cursor, limit=2)
+            seen += [entry['id'] for entry in feed['data']]
+            cursor = feed['meta']['cursor']
+            if not feed['meta']['has_more']:
+                break
+        self.assertEqual(seen, [file.id for file in files])
+
+    def test_only_sees_own_changes(self):
+        cursor = self.poll()['meta']['cursor']
+        other = User.objects.create_user(username='other', email='other@example.com', password='testpass123')
+        self.create('theirs.txt', owner=other)
+        self.assertEqual(self.poll(cursor)['data'], [])
+
+    @override_settings(FILE_CHANGES_SETTLE_SECONDS=60)
+    def test_cursor_waits_for_changes_to_settle(self):
+        file = self.create('new.txt')
+        feed = self.poll('0')
+        # Delivered straight away, but polled again until older changes can no longer appear
+        self.assertEqual([entry['id'] for entry in feed['data']], [file.id])
+        self.assertEqual(feed['meta']['cursor'], '0')
+        self.assertEqual(self.poll()['meta']['cursor'], '0')
+
+    def test_rejects_bad_cursor(self):
+        for since in ('abc', '-1'):
+            response = self.client.get(reverse('get_file_changes'), {'since': since})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,176 @@
+import hashlib
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+
+from common.compression import choose_codec
+from common.crypto import ChunkEncryptor, envelope_enabled, envelope_extensions, generate_encryption_key
+
+logger = logging.getLogger(__name__)
+
+# A part whose next chunk doesn't arrive in this many seconds is taken as abandoned
+# (the request failed mid-parse), so its encryption thread doesn't wait forever
+CHUNK_TIMEOUT = 300
+
+class EncryptedUploadedFile(TemporaryUploadedFile):
+    """
+    An upload whose temporary file holds only ciphertext in the chunked container format.
+
+    `size` and `digest` describe the plaintext. Unless `key_in_header` is set (envelope
+    mode), `encryption_key` still has to be stored once the `File` row exists. `error` is
+    set when ConcurrentEncryptingUploadHandler could not encrypt it.
+    """
+
+    def __init__(self, name, content_type, size, charset, content_type_extra=None):
+        super().__init__(name, content_type, size, charset, content_type_extra)
+        self.encryption_key = generate_encryption_key()
+        self.key_in_header = envelope_enabled()
+        self.digest = None
+        self.error = None
+
+def _new_encryptor(file, content_type, sample):
+    return ChunkEncryptor(
+        file.encryption_key,
+        file,
+        extensions=envelope_extensions(file.encryption_key),
+        compression=choose_codec(content_type, sample)
+    )
+
+class EncryptingUploadHandler(TemporaryFileUploadHandler):
+    """
+    Encrypt each chunk as it arrives from the socket, so plaintext never touches disk.
+
+    The ciphertext lands in FILE_UPLOAD_TEMP_DIR and is renamed into storage when the
+    `File` row is saved; keep that directory on the same volume as MEDIA_ROOT so the
+    blob is written exactly once.
+
+    The encryptor is only set up once the first chunk has arrived, since whether to
+    compress depends on a sample of it.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super(TemporaryFileUploadHandler, self).new_file(*args, **kwargs)
+        self.file = EncryptedUploadedFile(
+            self.file_name, self.content_type, 0, self.charset, self.content_type_extra
+        )
+        self.encryptor = None
+        self.hasher = hashlib.sha256()
+
+    def _start_encryptor(self, sample):
+        self.encryptor = _new_encryptor(self.file, self.content_type, sample)
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.encryptor is None:
+            self._start_encryptor(raw_data)
+        self.encryptor.write(raw_data)
+        self.hasher.update(raw_data)
+
+    def file_complete(self, file_size):
+        if self.encryptor is None:
+            self._start_encryptor(b'')
+        self.encryptor.close()
+        self.file.flush()
+        self.file.seek(0)
+        self.file.size = file_size
+        self.file.digest = self.hasher.hexdigest()
+        return self.file
+
+class ConcurrentEncryptingUploadHandler(EncryptingUploadHandler):
+    """
+    EncryptingUploadHandler for requests carrying many files.
+
+    Each file is encrypted on a pool of FILE_BULK_UPLOAD_WORKERS threads while the parser
+    reads on, fed through a queue of at most FILE_BULK_UPLOAD_QUEUE_DEPTH chunks, so a
+    slow part doesn't hold up reading the next ones and memory stays bounded. Plaintext
+    still never touches disk. A file that fails to encrypt gets its `error` set instead of
+    failing the whole request; all files are finished when request.FILES is returned.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self._pool = ThreadPoolExecutor(max_workers=settings.FILE_BULK_UPLOAD_WORKERS)
+        self._pending = []
+        self._chunks = None
+        self._interrupted = threading.Event()
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self._chunks = queue.Queue(maxsize=settings.FILE_BULK_UPLOAD_QUEUE_DEPTH)
+        future = self._pool.submit(self._encrypt, self.file, self.content_type, self._chunks)
+        self._pending.append((self.file, future))
+
+    def _next_chunk(self, chunks):
+        """The next chunk of a part, or None at its end; raises queue.Empty once interrupted"""
+        data = chunks.get(timeout=CHUNK_TIMEOUT)
+        if self._interrupted.is_set():
+            raise queue.Empty
+        return data
+
+    def _encrypt(self, file, content_type, chunks):
+        encryptor, hasher = None, hashlib.sha256()
+        try:
+            while True:
+                data = self._next_chunk(chunks)
+                if data is None:
+                    break
+                if encryptor is None:
+                    encryptor = _new_encryptor(file, content_type, data)
+                encryptor.write(data)
+                hasher.update(data)
+            if encryptor is None:
+                encryptor = _new_encryptor(file, content_type, b'')
+            encryptor.close()
+            file.flush()
+            file.seek(0)
+            file.digest = hasher.hexdigest()
+            return
+        except queue.Empty:
+            file.error = 'Upload interrupted'
+        except Exception as e:
+            logger.warning("Encrypting upload %s failed: %s", file.name, str(e))
+            file.error = 'Encryption failed'
+            # Keep taking chunks, or the parser blocks on a full queue
+            try:
+                while self._next_chunk(chunks) is not None:
+                    pass
+            except queue.Empty:
+                pass
+        # Drops the temporary file, which may never make it into request.FILES
+        file.close()
+
+    def receive_data_chunk(self, raw_data, start):
+        self._chunks.put(raw_data)
+
+    def file_complete(self, file_size):
+        self._chunks.put(None)
+        self.file.size = file_size
+        return self.file
+
+    def upload_interrupted(self):
+        """
+        Called when the request ends part way through a file, and by the view when parsing
+        fails: every file is marked errored, workers stop at their next chunk and those
+        not yet started are cancelled, without waiting for any of them.
+        """
+        self._interrupted.set()
+        if self._chunks is not None:
+            # Wakes a worker waiting on the part being read; a full queue means it isn't
+            try:
+                self._chunks.put_nowait(None)
+            except queue.Full:
+                pass
+        for file, _ in self._pending:
+            file.error = 'Upload interrupted'
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        for file, future in self._pending:
+            if future.cancelled():
+                file.close()
+
+    def upload_complete(self):
+        # Futures cancelled by upload_interrupted() are never marked done: wait() would hang
+        wait([future for _, future in self._pending if not future.cancelled()])
+        self._pool.shutdown()
@@ -1,8 +1,22 @@
 from django.urls import path
 
-from files.views import handle_file_requests, get_share_link, get_shared_file
+from files.views import (
+    handle_file_requests,
+    create_archive,
+    post_files_bulk,
+    get_share_link,
+    get_shared_file,
+    get_file_changes,
+    get_key_cache_stats,
+    search_files
+)
 
 urlpatterns = [
+    path('archive/', create_archive, name='create_archive'),
+    path('bulk/', post_files_bulk, name='post_files_bulk'),
+    path('changes/', get_file_changes, name='get_file_changes'),
+    path('key-cache/', get_key_cache_stats, name='get_key_cache_stats'),
+    path('search/', search_files, name='search_files'),
     path('share/', get_share_link, name='get_share_link'),
     path('shared/<str:file_id>/', get_shared_file, name='get_shared_file'),
     path('', handle_file_requests, name='handle_file_requests'),
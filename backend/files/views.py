@@ -1,20 +1,40 @@
 from http import HTTPStatus
+import logging
+import os
 import secrets
-from django.http import FileResponse
+from datetime import timedelta
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated
-import os
-import tempfile
-import shutil
 from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.http import content_disposition_header
 
 from common.apiresponse import ApiResponse
-from common.crypto import generate_encryption_key, store_encryption_key, encrypt_file, decrypt_file, CryptoError
-from files.models import File, SharedFile
-from .serializers import FileSerializer
+from common.crypto import CryptoError, delete_encryption_key, key_cache_stats, store_encryption_keys
+from common.listcache import cached_list_response, invalidate
+from files.changes import ChangeKind
+from files.models import File, FileChange, SharedFile
+from users.permissions import IsAdmin
+from .archive import iter_zip_archive
+from .pagination import (
+    InvalidQuery,
+    decode_offset_cursor,
+    encode_offset_cursor,
+    filter_files,
+    page_size,
+    paginate_files
+)
+from .search import search_file_ids
+from .serializers import FILE_LIST_FIELDS, FileSerializer, file_list_data
+from .streaming import conditional_file_response, encrypted_file_response
+from .uploadhandlers import ConcurrentEncryptingUploadHandler, EncryptingUploadHandler
+
+logger = logging.getLogger(__name__)
 
 @api_view(['POST', 'GET', 'DELETE'])
 @permission_classes([IsAuthenticated])
@@ -23,7 +43,7 @@ def handle_file_requests(request):
     if request.method == 'GET':
         if 'id' in request.query_params:
             return get_file(request, request.query_params.get('id'))
-        return get_files_handler(request)
+        return cached_list_response('files', request, lambda: get_files_handler(request))
     elif request.method == 'POST':
         return post_file_handler(request)
     elif request.method == 'DELETE':
@@ -31,31 +51,264 @@ def handle_file_requests(request):
     return ApiResponse(success=False, message='Invalid request method', status=HTTPStatus.BAD_REQUEST)
 
 def get_files_handler(request):
-    """ Get all the files """
+    """ Get a page of files, oldest first; `meta.next_cursor` fetches the next one """
     user = request.user
     if user.is_admin:
         files = File.objects.all()
     else:
         files = File.objects.filter(owner=user)
-    serializer = FileSerializer(files, many=True)
+    try:
+        files = filter_files(files, request.query_params)
+        page, next_cursor = paginate_files(files.values(*FILE_LIST_FIELDS), request.query_params)
+    except InvalidQuery as e:
+        return ApiResponse(success=False, message=str(e), status_code=HTTPStatus.BAD_REQUEST)
     return ApiResponse(
             success=True,
             message='Files retrieved successfully',
-            data=serializer.data
+            data=file_list_data(page),
+            meta={'next_cursor': next_cursor}
+        )
+
+@api_view(['GET'])
+@permission_classes([IsAdmin])
+def get_key_cache_stats(request):
+    """
+    Counters of the data key cache, for sizing FILE_KEY_CACHE_SIZE. The cache is per
+    process, so they cover only the worker that served the request, named by `pid`.
+    """
+    return ApiResponse(
+        success=True,
+        message='Key cache stats retrieved successfully',
+        data={'pid': os.getpid(), 'enabled': settings.FILE_KEY_CACHE_SIZE > 0, **(key_cache_stats() or {})}
+    )
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def search_files(request):
+    """ Search files by filename, best match first; `meta.next_cursor` fetches the next page """
+    query = request.query_params.get('q', '').strip()
+    if not query:
+        return ApiResponse(success=False, message='q is required', status_code=HTTPStatus.BAD_REQUEST)
+    try:
+        limit = page_size(request.query_params)
+        cursor = request.query_params.get('cursor')
+        offset = decode_offset_cursor(cursor) if cursor else 0
+    except InvalidQuery as e:
+        return ApiResponse(success=False, message=str(e), status_code=HTTPStatus.BAD_REQUEST)
+
+    owner_id = None if request.user.is_admin else request.user.id
+    # One extra id tells whether another page follows
+    ids = search_file_ids(query, owner_id, limit + 1, offset)
+    next_cursor = encode_offset_cursor(offset + limit) if len(ids) > limit else None
+    rows = {row['id']: row for row in File.objects.filter(id__in=ids[:limit]).values(*FILE_LIST_FIELDS)}
+    return ApiResponse(
+            success=True,
+            message='Files retrieved successfully',
+            data=file_list_data(rows[file_id] for file_id in ids[:limit] if file_id in rows),
+            meta={'next_cursor': next_cursor}
+        )
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_file_changes(request):
+    """
+    Files created, updated, shared or deleted since the `since` cursor, oldest change first
+    and one entry per file. Without `since` no changes are returned, only the current
+    cursor: take it before fetching the full list, then poll with it.
+    """
+    changes = FileChange.objects.all() if request.user.is_admin else FileChange.objects.filter(owner=request.user)
+    settle_before = timezone.now() - timedelta(seconds=settings.FILE_CHANGES_SETTLE_SECONDS)
+
+    since = request.query_params.get('since')
+    if not since:
+        latest = changes.filter(changed_at__lte=settle_before).order_by('-id').values_list('id', flat=True).first()
+        return ApiResponse(
+            success=True,
+            message='Changes retrieved successfully',
+            data=[],
+            meta={'cursor': str(latest or 0), 'has_more': False}
+        )
+    try:
+        since = int(since)
+        if since < 0:
+            raise ValueError
+        limit = page_size(request.query_params)
+    except InvalidQuery as e:
+        return ApiResponse(success=False, message=str(e), status_code=HTTPStatus.BAD_REQUEST)
+    except ValueError:
+        return ApiResponse(success=False, message='Invalid cursor', status_code=HTTPStatus.BAD_REQUEST)
+
+    page = list(changes.filter(id__gt=since).order_by('id').values('id', 'file_id', 'kind', 'changed_at')[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+
+    # Advance only over the settled prefix: a younger change may still have an uncommitted
+    # predecessor. Changes past the cursor are sent again next time, which clients tolerate.
+    cursor = since
+    for change in page:
+        if change['changed_at'] > settle_before:
+            break
+        cursor = change['id']
+    # Paging on from a cursor held back would only return this page again
+    has_more = has_more and cursor == page[-1]['id']
+
+    latest = {}
+    for change in page:
+        latest.pop(change['file_id'], None)
+        latest[change['file_id']] = change['kind']
+    rows = {
+        row['id']: row
+        for row in File.objects.filter(id__in=[
+            file_id for file_id, kind in latest.items() if kind != ChangeKind.DELETED
+        ]).values(*FILE_LIST_FIELDS)
+    }
+    data = []
+    for file_id, kind in latest.items():
+        row = rows.get(file_id)
+        if row is None:
+            # Deleted by a change further on
+            data.append({'id': file_id, 'change': ChangeKind.DELETED, 'file': None})
+        else:
+            data.append({'id': file_id, 'change': kind, 'file': file_list_data([row])[0]})
+    return ApiResponse(
+            success=True,
+            message='Changes retrieved successfully',
+            data=data,
+            meta={'cursor': str(cursor), 'has_more': has_more}
         )
 
+def _archive_ids(data):
+    """The file ids named by an archive request body, or None for all of the caller's files"""
+    if not isinstance(data, dict):
+        raise InvalidQuery('Expected {"ids": [...]} or {"all": true}')
+    if data.get('all') is True:
+        return None
+    ids = data.get('ids')
+    if not isinstance(ids, list) or not ids:
+        raise InvalidQuery('Expected {"ids": [...]} or {"all": true}')
+    if len(ids) > settings.FILE_ARCHIVE_MAX_FILES:
+        raise InvalidQuery(f'At most {settings.FILE_ARCHIVE_MAX_FILES} files per archive')
+    if not all(isinstance(file_id, int) and not isinstance(file_id, bool) for file_id in ids):
+        raise InvalidQuery('ids must be integers')
+    return set(ids)
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def create_archive(request):
+    """ Stream a ZIP of the files named by `ids`, or of all the caller's files with `all` """
+    try:
+        ids = _archive_ids(request.data)
+    except InvalidQuery as e:
+        return ApiResponse(success=False, message=str(e), status_code=HTTPStatus.BAD_REQUEST)
+
+    if ids is None:
+        files = File.objects.filter(owner=request.user)
+    else:
+        files = File.objects.filter(id__in=ids)
+        found = dict(files.values_list('id', 'owner_id'))
+        missing = ids - found.keys()
+        if missing:
+            return ApiResponse(
+                success=False,
+                message=f'Files not found: {", ".join(map(str, sorted(missing)))}',
+                status_code=HTTPStatus.NOT_FOUND
+            )
+        if not request.user.is_admin and any(owner_id != request.user.id for owner_id in found.values()):
+            return ApiResponse(success=False, message='Permission denied', status_code=HTTPStatus.FORBIDDEN)
+
+    # Rows are read as the archive is sent, a chunk at a time
+    files = files.only('id', 'file', 'filename', 'size', 'mime', 'uploaded_at').order_by('uploaded_at', 'id')
+    response = StreamingHttpResponse(iter_zip_archive(files.iterator(chunk_size=100)), content_type='application/zip')
+    response['Content-Disposition'] = content_disposition_header(True, 'files.zip')
+    response['Cache-Control'] = 'private, no-store'
+    return response
+
 def post_file_handler(request):
     """ Upload a file """
+    # Encrypt chunks as they are read off the socket; must be set before request.data is parsed
+    request._request.upload_handlers = [EncryptingUploadHandler(request._request)]
     file_serializer = FileSerializer(context={'request': request}, data=request.data)
     if file_serializer.is_valid():
-        file_instance = file_serializer.save()
-        key = generate_encryption_key()
-        store_encryption_key(file_instance.id, key)  # Store the unique key for the file
-        encrypt_file(file_instance.id, file_instance.file.path)  # Encrypt the file after saving
+        file_serializer.save()
         return Response({'message': 'File uploaded successfully!'}, status=HTTPStatus.CREATED)
     else:
         return Response(file_serializer.errors, status=HTTPStatus.BAD_REQUEST)
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def post_files_bulk(request):
+    """
+    Upload many files in one multipart request, as repeated `files` parts. Responds with
+    one result per part, in order: 201 when every file was stored, 207 when only some were.
+    """
+    handler = ConcurrentEncryptingUploadHandler(request._request)
+    request._request.upload_handlers = [handler]
+    try:
+        uploads = request.FILES.getlist('files')
+    except Exception:
+        # The parser only tells the handler when the body ends early, not when reading it fails
+        handler.upload_interrupted()
+        raise
+    if not uploads:
+        return ApiResponse(success=False, message='No files in the request', status_code=HTTPStatus.BAD_REQUEST)
+
+    results = [{'filename': upload.name, 'success': False} for upload in uploads]
+    pending = []
+    for result, upload in zip(results, uploads):
+        if upload.error:
+            result['error'] = upload.error
+            continue
+        file = File(
+            owner=request.user, filename=upload.name, size=upload.size, mime=upload.content_type, digest=upload.digest
+        )
+        try:
+            # Moved into storage one by one, so a blob that can't be stored fails only its own file
+            file.file.save(upload.name, upload, save=False)
+        except Exception as e:
+            logger.warning("Storing bulk upload %s failed: %s", upload.name, str(e))
+            result['error'] = 'Could not store file'
+            continue
+        pending.append((result, upload, file))
+
+    if pending:
+        try:
+            with transaction.atomic():
+                files = [file for _, _, file in pending]
+                if connection.features.can_return_rows_from_bulk_insert:
+                    File.objects.bulk_create(files)
+                    # bulk_create sends no post_save, so record the changes files.signals would have
+                    FileChange.objects.bulk_create([
+                        FileChange(owner_id=request.user.id, file_id=file.id, kind=ChangeKind.CREATED) for file in files
+                    ])
+                else:
+                    # The ids are needed for the keys, and this backend doesn't return them from a bulk insert
+                    for file in files:
+                        file.save()
+                # Without its key a blob is unreadable: no key, no row
+                store_encryption_keys(
+                    (file.id, upload.encryption_key) for _, upload, file in pending if not upload.key_in_header
+                )
+        except Exception as e:
+            logger.warning("Saving a bulk upload of %d files failed: %s", len(pending), str(e))
+            for result, _, file in pending:
+                try:
+                    file.file.storage.delete(file.file.name)
+                except Exception as e:
+                    logger.warning("Deleting the blob of bulk upload %s failed: %s", file.filename, str(e))
+                result['error'] = 'Could not save file'
+        else:
+            invalidate('files', request.user.id)
+            for result, _, file in pending:
+                result.update(success=True, id=file.id)
+
+    stored = sum(result['success'] for result in results)
+    return ApiResponse(
+        success=stored == len(results),
+        message=f'{stored} of {len(results)} files uploaded',
+        data=results,
+        status_code=HTTPStatus.CREATED if stored == len(results) else HTTPStatus.MULTI_STATUS
+    )
+
 def delete_file_handler(request):
     """ Delete a file """
     file_id = request.query_params.get('id')
@@ -66,18 +319,21 @@ def delete_file_handler(request):
         return ApiResponse(success=False, message='Permission denied', status=HTTPStatus.FORBIDDEN)
 
     try:
-        # Get the file path before deleting the record
-        file_path = file.file.path
-        
         # Delete any associated shared files
         SharedFile.objects.filter(file=file).delete()
         
         # Delete the file record from database
         file.delete()
         
-        # Delete the physical file if it exists
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        # Delete the blob from whichever storage holds it (missing blobs are ignored)
+        file.file.storage.delete(file.file.name)
+
+        # The row and blob are gone, so a key left behind here is only a dangling
+        # secret; reconcile_storage sweeps those up
+        try:
+            delete_encryption_key(file_id)
+        except Exception:
+            pass
         
         return ApiResponse(
             success=True, 
@@ -98,19 +354,19 @@ def get_file(request, file_id):
     if not request.user.is_admin and file.owner != request.user:
         return ApiResponse(success=False, message='Permission denied', status=HTTPStatus.FORBIDDEN)
 
+    # A copy the client already holds is confirmed without touching the key store or blob
+    not_modified = conditional_file_response(request, file)
+    if not_modified is not None:
+        return not_modified
+
     try:
-        decrypt_file(file.id, file.file.path)  # Decrypt the file before sending
-        response = FileResponse(open(file.file.path, 'rb'), as_attachment=True)
-        response['Content-Disposition'] = f'attachment; filename="{file.file.name}"'
-        return response
+        return encrypted_file_response(request, file)
     except FileNotFoundError:
         return ApiResponse(
             success=False,
             message='File not found',
             status=HTTPStatus.NOT_FOUND
         )
-    finally:
-        encrypt_file(file.id, file.file.path)  # Re-encrypt the file after sending
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
@@ -149,27 +405,13 @@ def get_share_link(request):
 def get_shared_file(request, file_id):
     """Retrieve a shared file using its ID."""
     try:
-        shared_file = SharedFile.objects.get(share_hash=file_id)
+        shared_file = SharedFile.objects.select_related('file').get(share_hash=file_id)
         file = shared_file.file
 
-        # Decrypt to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            temp_file_path = temp_file.name
-            # Decrypt the content directly to the temporary file
-            decrypt_file(file.id, file.file.path, temp_output_path=temp_file_path)
-
-            # Serve the decrypted file from the temporary location
-            response = FileResponse(open(temp_file_path, 'rb'), as_attachment=True, filename=file.filename)
-
-            # Cleanup after file is downloaded
-            def cleanup_temp_file():
-                try:
-                    os.remove(temp_file_path)  # Delete the temp file
-                except Exception as e:
-                    print(f"Error during cleanup: {e}")
-
-            response.close_callback = cleanup_temp_file
-            return response
+        not_modified = conditional_file_response(request, file)
+        if not_modified is not None:
+            return not_modified
+        return encrypted_file_response(request, file)
 
     except SharedFile.DoesNotExist:
         return ApiResponse(success=False, message='Shared file not found', status_code=HTTPStatus.NOT_FOUND)
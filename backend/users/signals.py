@@ -0,0 +1,18 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from common.listcache import invalidate
+from users.models import User
+
+@receiver(post_save, sender=User)
+def invalidate_user_lists(sender, instance, raw=False, update_fields=None, **kwargs):
+    # Every login saves last_login, which no list shows
+    if raw or (update_fields is not None and set(update_fields) == {'last_login'}):
+        return
+    invalidate('users', instance.id)
+    invalidate('files', instance.id)  # file rows carry the owner's username
+
+@receiver(post_delete, sender=User)
+def invalidate_deleted_user_lists(sender, instance, **kwargs):
+    invalidate('users', instance.id)
+    invalidate('files', instance.id)
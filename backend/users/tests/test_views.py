@@ -171,4 +171,17 @@ class UserViewsTests(TestCase):
     def test_user_list_unauthorized(self):
         self.client.force_authenticate(user=self.user)
         response = self.client.get('/api/users/')
-        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN) 
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN) 
+
+    def test_user_list_is_cached_until_users_change(self):
+        self.client.force_authenticate(user=self.admin)
+        first = self.client.get('/api/users/')
+        self.assertEqual(first['X-Cache'], 'MISS')
+        second = self.client.get('/api/users/')
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(second.data, first.data)
+
+        User.objects.create_user(username='newcomer', email='new@example.com', password='newpass123')
+        third = self.client.get('/api/users/')
+        self.assertEqual(third['X-Cache'], 'MISS')
+        self.assertIn('newcomer', [user['username'] for user in third.data])
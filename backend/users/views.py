@@ -6,6 +6,7 @@ from rest_framework.permissions import AllowAny, IsAuthenticated
 from django.contrib.auth import authenticate
 
 from common.apiresponse import ApiResponse
+from common.listcache import cached_list_response
 from .models import User
 from .serializers import UserSerializer
 from common.jwt import generate_jwt_tokens, generate_access_token_from_refresh_token, generate_temp_token, decode_jwt_token
@@ -54,6 +55,9 @@ class UserViewSet(viewsets.ModelViewSet):
             }, status=status.HTTP_400_BAD_REQUEST)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    def list(self, request, *args, **kwargs):
+        return cached_list_response('users', request, lambda: super(UserViewSet, self).list(request, *args, **kwargs))
+
     def get_queryset(self):
         user = self.request.user
         if user.is_anonymous:
@@ -1,7 +1,7 @@
 import React from 'react';
 import { Dialog, DialogTrigger, DialogContent, DialogTitle, DialogDescription, DialogClose } from '@radix-ui/react-dialog';
 import { useAppDispatch } from '@/store';
-import { fetchFiles } from '@/store/slices/file.slice';
+import { syncFiles } from '@/store/slices/file.slice';
 import { Api } from '@/lib/api';
 import { Button } from '@/components/ui/button';
 import { Trash2Icon } from 'lucide-react';
@@ -19,7 +19,7 @@ export const DeleteFileDialog: React.FC<DeleteFileDialogProps> = ({ fileId, file
             await Api.delete(`files/?id=${fileId}`, {
                 withCredentials: true,
             });
-            dispatch(fetchFiles());
+            dispatch(syncFiles());
         } catch (error) {
             console.error('Error deleting file:', error);
         }
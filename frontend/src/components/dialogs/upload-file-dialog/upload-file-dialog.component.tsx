@@ -3,7 +3,7 @@ import { Button } from '../../ui/button';
 import React, { useState } from 'react';
 import { useToast } from '@/hooks/use-toast';
 import { useAppDispatch } from '@/store';
-import { fetchFiles } from '@/store/slices';
+import { syncFiles } from '@/store/slices';
 import { Api } from '@/lib/api';
 
 export const UploadFileDialog: React.FC = () => {
@@ -20,7 +20,7 @@ export const UploadFileDialog: React.FC = () => {
 
     const handleClose = () => {
         setDialogOpen(false);
-        dispatch(fetchFiles());
+        dispatch(syncFiles());
     }
 
     const handleFileUpload = async (event: React.FormEvent) => {
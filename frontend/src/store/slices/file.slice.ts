@@ -11,8 +11,15 @@ interface File {
   type: string;
 }
 
+interface FileChange {
+  id: number;
+  change: "created" | "updated" | "shared" | "deleted";
+  file: File | null;
+}
+
 interface FileState {
   files: File[];
+  cursor?: string;
   isPending: boolean;
   error?: string;
   isSuccess?: boolean;
@@ -25,10 +32,40 @@ const initialState: FileState = {
 };
 
 export const fetchFiles = createAsyncThunk("file/fetchFiles", async () => {
-  const response = await Api.get("files", {
-    withCredentials: true,
-  });
-  return response.data.data;
+  // Taken before the list so that changes made while it loads are picked up by syncFiles
+  const changes = await Api.get("files/changes/", { withCredentials: true });
+  const changeCursor: string = changes.data.meta.cursor;
+  const files: File[] = [];
+  let cursor: string | null = null;
+  do {
+    const response = await Api.get("files", {
+      withCredentials: true,
+      params: cursor ? { cursor } : {},
+    });
+    files.push(...response.data.data);
+    cursor = response.data.meta?.next_cursor ?? null;
+  } while (cursor);
+  return { files, cursor: changeCursor };
+});
+
+export const syncFiles = createAsyncThunk<
+  { changes: FileChange[]; cursor: string },
+  void,
+  { state: { file: FileState } }
+>("file/syncFiles", async (_, { getState }) => {
+  let cursor = getState().file.cursor ?? "0";
+  const changes: FileChange[] = [];
+  let hasMore = true;
+  while (hasMore) {
+    const response = await Api.get("files/changes/", {
+      withCredentials: true,
+      params: { since: cursor },
+    });
+    changes.push(...response.data.data);
+    cursor = response.data.meta.cursor;
+    hasMore = response.data.meta.has_more;
+  }
+  return { changes, cursor };
 });
 
 const fileSlice = createSlice({
@@ -40,8 +77,9 @@ const fileSlice = createSlice({
       .addCase(fetchFiles.pending, (state) => {
         state.isPending = true;
       })
-      .addCase(fetchFiles.fulfilled, (state, action: PayloadAction<File[]>) => {
-        state.files = action.payload;
+      .addCase(fetchFiles.fulfilled, (state, action: PayloadAction<{ files: File[]; cursor: string }>) => {
+        state.files = action.payload.files;
+        state.cursor = action.payload.cursor;
         state.isPending = false;
         state.isSuccess = true;
       })
@@ -49,6 +87,19 @@ const fileSlice = createSlice({
         state.error = action.error.message || "Failed to fetch files";
         state.isPending = false;
         state.isSuccess = false;
+      })
+      .addCase(syncFiles.fulfilled, (state, action) => {
+        for (const { id, change, file } of action.payload.changes) {
+          const index = state.files.findIndex((existing) => existing.id === id);
+          if (change === "deleted" || !file) {
+            if (index !== -1) state.files.splice(index, 1);
+          } else if (index !== -1) {
+            state.files[index] = file;
+          } else {
+            state.files.push(file);
+          }
+        }
+        state.cursor = action.payload.cursor;
       });
   },
 });